@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 import os
+from decimal import Decimal
 from dotenv import load_dotenv
 import cloudinary
 import cloudinary.uploader
@@ -91,6 +92,16 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Writers take the lock when their transaction starts and wait for it,
+        # so concurrent checkouts queue instead of failing with "database is locked"
+        'OPTIONS': {
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
+        # A file (not in-memory) test database so tests can use several connections
+        'TEST': {
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
     }
 }
 
@@ -157,6 +168,37 @@ BRAND_COLORS = {
     'white': '#ffffff',
 }
 
+# One cache shared by every process, the web workers and `manage.py run_tasks`
+# alike. The version counters in store/versions.py live here, and they are how
+# a change made in one process reaches the indexes held in the others, so a
+# per-process cache (LocMemCache) will not do. Redis when REDIS_URL is set,
+# otherwise a table in the database, created by migration 0046.
+if os.getenv('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'store_cache',
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        }
+    }
+
+# Seconds a process trusts the version numbers it read from that cache (store/versions.py),
+# so a change made by another process shows up within this long
+VERSION_CHECK_INTERVAL = 5
+# Rebuild in-process indexes (suggest, facets, similar products) on a background thread
+# when their version moves, serving the previous one meanwhile
+INDEX_REBUILD_IN_BACKGROUND = True
+
+# Seconds the header/mega-menu payload is cached (0 disables the cache)
+NAVIGATION_CACHE_TTL = 300
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -169,6 +211,56 @@ LOGOUT_REDIRECT_URL = '/'
 RP_KEY_ID= "rzp_live_RYXIOhLxjO9TQW"
 RP_KEY_SECRET= "92jwXShELOIzfNE71noJfSKY"
 
+# Razorpay adapter (store/payments.py). Point RAZORPAY_BASE_URL at
+# `manage.py fake_razorpay` to check out offline.
+RAZORPAY_BASE_URL = os.getenv('RAZORPAY_BASE_URL', 'https://api.razorpay.com')
+RAZORPAY_CONNECT_TIMEOUT = 3.05
+RAZORPAY_READ_TIMEOUT = 10
+RAZORPAY_MAX_RETRIES = 2
+# Consecutive failures that open the circuit, and seconds it stays open
+RAZORPAY_BREAKER_THRESHOLD = 5
+RAZORPAY_BREAKER_RESET = 30
+# Secret set on the webhook in the Razorpay dashboard
+RAZORPAY_WEBHOOK_SECRET = os.getenv('RAZORPAY_WEBHOOK_SECRET', '')
+# Failed attempts after which a webhook event is marked failed and no longer retried
+PAYMENT_EVENT_MAX_ATTEMPTS = 5
+
+# Background tasks (store/tasks.py, run by `manage.py run_tasks`)
+TASK_MAX_ATTEMPTS = 5
+# Seconds before the first retry; doubles with each failure
+TASK_RETRY_BASE = 30
+# Seconds after which a task still marked running is handed to another worker
+TASK_LOCK_TIMEOUT = 600
+DEFAULT_FROM_EMAIL = 'support@prachisorganics.com'
+
+# Shipping added to cash-on-delivery orders (store/pricing.py)
+COD_SHIPPING_CHARGE = Decimal('50.00')
+# Seconds a process keeps its coupon book before reloading it, even if no coupon changed
+COUPON_BOOK_TTL = 60
+
+# "Frequently bought together" (store/recommend.py, `manage.py train_recommendations`)
+RECOMMEND_TOP_K = 8
+# Shared orders at which a pair's score is damped by half
+RECOMMEND_SHRINKAGE = 2
+# Neighbours kept per product by the similar-products index (store/similar.py)
+SIMILAR_PRODUCTS_K = 12
+
+# "Recommended for you" (store/personalize.py, `manage.py build_user_recommendations` nightly)
+PERSONAL_TOP_N = 20
+# Bestsellers, the fallback for anyone without a list: orders over this many days, cached for an hour
+BESTSELLER_DAYS = 90
+BESTSELLER_CACHE_TTL = 3600
+# Review classifier (store/moderation.py, `manage.py train_review_classifier`): spam scores below
+# this approve a review, above the next hold it back for staff, as does text this far from its stars
+REVIEW_APPROVE_BELOW_SPAM = 0.1
+REVIEW_FLAG_ABOVE_SPAM = 0.5
+REVIEW_FLAG_RATING_MISMATCH = 0.6
+
+# Demand forecasts (store/forecast.py, `manage.py forecast_demand` nightly): days of orders fitted,
+# and how soon a product must be due to run out for staff to be emailed and the admin to flag it
+FORECAST_HISTORY_DAYS = 90
+STOCKOUT_ALERT_DAYS = 14
+
 
 import dj_database_url
 
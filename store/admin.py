@@ -1,10 +1,15 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.db import models
+from django.db.models import Prefetch
 from django.utils.html import format_html
+from django.utils import timezone
 from .models import (
     Category, Product, ComboDeal, Review, 
-    Cart, CartItem, Order, OrderItem, ContactMessage, SiteSettings, Offer, ShippingAddress, CustomUser, Coupon, CancellationRequest
+    Cart, CartItem, Order, OrderItem, ContactMessage, SiteSettings, Offer, ShippingAddress, CustomUser, Coupon, CancellationRequest, PaymentEvent, Task,
+    ModerationModel,
 )
+from .forecast import alert_days, at_risk
+from .tasks import process_payment_events
 
 @admin.register(CustomUser)
 class CustomUserAdmin(admin.ModelAdmin):
@@ -16,10 +21,27 @@ class CategoryAdmin(admin.ModelAdmin):
     list_display = ['name', 'slug']
     prepopulated_fields = {'slug': ('name',)}
 
+class RunsOutFilter(admin.SimpleListFilter):
+    title = 'runs out'
+    parameter_name = 'runs_out'
+
+    def lookups(self, request, model_admin):
+        return [('soon', f"Within {alert_days()} days"), ('month', "Within 30 days")]
+
+    def queryset(self, request, queryset):
+        if self.value() == 'soon':
+            return queryset.filter(forecast__in=at_risk())
+        if self.value() == 'month':
+            return queryset.filter(forecast__in=at_risk(30))
+        return queryset
+
+
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
-    list_display = ['name', 'category', 'price', 'sale_price', 'stock', 'is_available', 'what_makes_it_potent', 'how_to_use', 'ideal_for', 'consumer_studies']
-    list_filter = ['category', 'concern', 'is_available']
+    list_display = ['name', 'category', 'price', 'sale_price', 'stock', 'runs_out', 'is_available', 'what_makes_it_potent', 'how_to_use', 'ideal_for', 'consumer_studies']
+    list_filter = [RunsOutFilter, 'category', 'concern', 'is_available']
+    # The forecast is precomputed (store/forecast.py); the list only joins it
+    list_select_related = ['category', 'forecast']
     search_fields = ['name', 'description']
     prepopulated_fields = {'slug': ('name',)}
 
@@ -27,6 +49,28 @@ class ProductAdmin(admin.ModelAdmin):
         models.TextField: {'widget': admin.widgets.AdminTextareaWidget(attrs={'rows':4, 'cols':80})},   
     }
 
+    @admin.display(description='Runs out', ordering='forecast__days_until_stockout')
+    def runs_out(self, obj):
+        forecast = getattr(obj, 'forecast', None)
+        if forecast is None or forecast.days_until_stockout is None:
+            return '—'
+        text = f'{forecast.days_until_stockout:.0f} days ({forecast.daily_demand:.1f}/day)'
+        if forecast.days_until_stockout <= alert_days():
+            return format_html('<strong style="color: #ba2121;">{}</strong>', text)
+        return text
+
+    def changelist_view(self, request, extra_context=None):
+        if request.method == 'GET' and 'runs_out' not in request.GET:
+            running_low = at_risk().filter(product__is_available=True).count()
+            if running_low:
+                self.message_user(
+                    request,
+                    format_html('{} products will run out within {} days. <a href="?runs_out=soon">Show them</a>',
+                                running_low, alert_days()),
+                    messages.WARNING,
+                )
+        return super().changelist_view(request, extra_context)
+
 @admin.register(ComboDeal)
 class ComboDealAdmin(admin.ModelAdmin):
     list_display = ['name', 'original_price', 'discounted_price']
@@ -34,10 +78,31 @@ class ComboDealAdmin(admin.ModelAdmin):
 
 @admin.register(Review)
 class ReviewAdmin(admin.ModelAdmin):
-    list_display = ['product', 'user', 'rating', 'is_approved', 'created_at']
-    list_filter = ['rating', 'is_approved', 'created_at']
+    list_display = ['product', 'user', 'rating', 'is_approved', 'flagged', 'spam_score', 'sentiment_score', 'created_at']
+    list_filter = ['flagged', 'is_approved', 'is_spam', 'rating', 'created_at']
     search_fields = ['product__name', 'user__username', 'comment']
     list_editable = ['is_approved']
+    readonly_fields = ['sentiment_score', 'spam_score', 'model_version', 'scored_at']
+    actions = ['approve', 'mark_spam']
+
+    # One save() per review so the product rating counters follow
+    @admin.action(description="Approve selected reviews")
+    def approve(self, request, queryset):
+        for review in queryset:
+            review.is_approved = True
+            review.flagged = False
+            review.is_spam = False
+            review.save(update_fields=['is_approved', 'flagged', 'is_spam'])
+        self.message_user(request, f"{len(queryset)} reviews approved.")
+
+    @admin.action(description="Mark selected reviews as spam")
+    def mark_spam(self, request, queryset):
+        for review in queryset:
+            review.is_approved = False
+            review.flagged = False
+            review.is_spam = True
+            review.save(update_fields=['is_approved', 'flagged', 'is_spam'])
+        self.message_user(request, f"{len(queryset)} reviews marked as spam.")
 
 @admin.register(ContactMessage)
 class ContactMessageAdmin(admin.ModelAdmin):
@@ -51,8 +116,13 @@ class OrderItemInline(admin.TabularInline):
     extra = 0
     can_delete = False
 
+    # Product/combo dropdowns would load the whole catalog once per row
+    fields = ("item_name", "quantity", "price", "subtotal")
     readonly_fields = ("item_name", "quantity", "price", "subtotal")
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related("product", "combo_deal")
+
     def item_name(self, obj):
         """
         Safely show product or combo name
@@ -90,6 +160,9 @@ class OrderAdmin(admin.ModelAdmin):
         'created_at',
         'ordered_products',
     )
+    list_select_related = ('user',)
+    list_filter = ('status', 'payment_method', 'payment_status', 'created_at')
+    date_hierarchy = 'created_at'
 
     search_fields = (
         'razorpay_order_id',
@@ -108,6 +181,11 @@ class OrderAdmin(admin.ModelAdmin):
 
     inlines = [OrderItemInline]
 
+    def get_queryset(self, request):
+        # Every row's items with their product and combo, in one extra query
+        items = OrderItem.objects.select_related('product', 'combo_deal')
+        return super().get_queryset(request).prefetch_related(Prefetch('items', queryset=items))
+
     def ordered_products(self, obj):
         products = []
         for item in obj.items.all():
@@ -177,4 +255,41 @@ class CancellationRequestAdmin(admin.ModelAdmin):
             <a class='button' href='/admin/cancel/{obj.id}/reject/'>Reject</a>
             """
         )
-    
\ No newline at end of file
+    
+
+
+@admin.register(PaymentEvent)
+class PaymentEventAdmin(admin.ModelAdmin):
+    list_display = ['event_id', 'event', 'received_at', 'processed_at', 'failed_at', 'attempts']
+    list_filter = ['event', 'processed_at', 'failed_at']
+    search_fields = ['event_id']
+    readonly_fields = ['event_id', 'event', 'payload', 'received_at']
+    actions = ['retry']
+
+    @admin.action(description="Retry selected failed events")
+    def retry(self, request, queryset):
+        count = queryset.filter(processed_at__isnull=True).update(failed_at=None, attempts=0)
+        process_payment_events.delay()
+        self.message_user(request, f"{count} events queued for another try.")
+
+
+@admin.register(Task)
+class TaskAdmin(admin.ModelAdmin):
+    list_display = ['id', 'name', 'status', 'attempts', 'run_at', 'finished_at']
+    list_filter = ['status', 'name']
+    readonly_fields = ['name', 'kwargs', 'created_at', 'finished_at', 'locked_by', 'locked_at', 'last_error']
+    actions = ['requeue']
+
+    @admin.action(description="Requeue selected tasks")
+    def requeue(self, request, queryset):
+        count = queryset.exclude(status=Task.RUNNING).update(
+            status=Task.QUEUED, run_at=timezone.now(), attempts=0, finished_at=None,
+        )
+        self.message_user(request, f"{count} tasks requeued.")
+
+
+@admin.register(ModerationModel)
+class ModerationModelAdmin(admin.ModelAdmin):
+    list_display = ['version', 'is_active', 'examples', 'metrics', 'created_at']
+    exclude = ['weights']
+    readonly_fields = ['version', 'examples', 'metrics', 'created_at']
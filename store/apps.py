@@ -6,6 +6,9 @@ class StoreConfig(AppConfig):
     name = 'store'
 
     def ready(self):
+        # Connect the cache version, navigation, search index, cart merge and review scoring receivers
+        from . import carts, moderation, navigation, search, versions  # noqa: F401
+
         # Ensure a SiteSettings row exists after migrations
         try:
             from .models import SiteSettings
@@ -0,0 +1,375 @@
+# store/benchmarks.py
+"""
+Benchmarks run by `manage.py benchmark <name>`. Each one gets a throwaway
+test database, seeds what it needs and writes its report to `out`.
+"""
+import random
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connection, reset_queries, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from django.db.models import Q
+from django.utils import timezone
+
+from .facets import FacetIndex
+from .moderation import BATCH_SIZE, ReviewClassifier
+from .models import Cart, CartItem, Category, ComboDeal, CustomUser, Offer, Order, OrderItem, Product, SiteSettings
+from .navigation import BUILDERS, build_navigation_part
+from .orders import place_order
+from .pagination import encode_cursor, keyset_page
+from .search import rebuild_search_index, search_product_ids
+from .similar import CHUNK, SimilarityIndex
+from .suggest import SuggestIndex, get_suggest_index
+from .views import PRODUCT_SORTS, PRODUCTS_PER_PAGE
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def seed_catalog(products_per_category=8):
+    """A small storefront: the three mega-menu categories, offers and products."""
+    SiteSettings.objects.get_or_create(pk=1)
+    for i in range(3):
+        Offer.objects.create(title=f'Offer {i}', sort_order=i)
+    products = []
+    for name in ['Skin Care', 'Hair Care', 'Body Care']:
+        category = Category.objects.create(name=name)
+        products += [
+            Product(
+                name=f'{name} {i}', slug=f'{category.slug}-{i}', category=category,
+                description=f'{name} product {i}', price=Decimal('199.00'), stock=50,
+            )
+            for i in range(products_per_category)
+        ]
+    return Product.objects.bulk_create(products)
+
+
+INGREDIENTS = [
+    'aloe', 'neem', 'turmeric', 'saffron', 'sandalwood', 'rose', 'tulsi', 'amla', 'bhringraj', 'hibiscus',
+    'coconut', 'almond', 'jojoba', 'argan', 'shea', 'cocoa', 'honey', 'multani', 'kumkumadi', 'vetiver',
+    'lavender', 'tea', 'charcoal', 'oat', 'rice', 'papaya', 'cucumber', 'lemon', 'orange', 'ginger',
+]
+FORMATS = ['gel', 'serum', 'shampoo', 'oil', 'soap', 'cream', 'scrub', 'mask', 'toner', 'balm', 'wash', 'mist']
+FILLER = [
+    'gentle', 'nourishing', 'cold', 'pressed', 'handmade', 'organic', 'daily', 'repair', 'glow', 'hydrating',
+    'soothing', 'clarifying', 'strengthening', 'brightening', 'restoring', 'balancing', 'calming', 'pure',
+]
+
+
+def seed_synthetic_catalog(size, seed=42, batch_size=5000):
+    """`size` generated products spread over a handful of categories (no signals)."""
+    rng = random.Random(seed)
+    categories = [Category.objects.create(name=n) for n in ['Skin Care', 'Hair Care', 'Body Care', 'Lip Care']]
+    concerns = [value for value, _ in Product.CONCERN_CHOICES] + ['']
+    batch = []
+    for i in range(size):
+        ingredient, other = rng.sample(INGREDIENTS, 2)
+        name = f'{ingredient.title()} {rng.choice(FORMATS).title()} {i}'
+        words = rng.choices(FILLER + INGREDIENTS, k=30)
+        price = Decimal(rng.randrange(99, 1999))
+        batch.append(Product(
+            name=name, slug=f'p-{i}', category=rng.choice(categories),
+            description=' '.join(words), what_makes_it_potent=f'{other} extract and {rng.choice(FILLER)} oils',
+            ideal_for=rng.choice(['dry skin', 'oily skin', 'all hair types', 'sensitive skin']),
+            concern=rng.choice(concerns), price=price,
+            sale_price=price - 50 if rng.random() < 0.3 else None,
+            stock=rng.choice([0, 5, 20, 100]), is_available=rng.random() < 0.95,
+        ))
+        if len(batch) == batch_size:
+            Product.objects.bulk_create(batch)
+            batch = []
+    Product.objects.bulk_create(batch)
+    return categories
+
+
+def timed(func, repeat):
+    """(result of the last call, milliseconds per call)."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return result, (time.perf_counter() - start) * 1000 / repeat
+
+
+def measure_requests(client, url, repeat):
+    """(queries per request, milliseconds per request) for repeated GETs."""
+    client.get(url)  # warm up
+    with CaptureQueriesContext(connection) as ctx:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            client.get(url)
+        elapsed = time.perf_counter() - start
+    return len(ctx.captured_queries) / repeat, elapsed * 1000 / repeat
+
+
+def eager_site_settings(request):
+    """The original context processor: every part queried on every render."""
+    return {key: build_navigation_part(key) for key in BUILDERS}
+
+
+def with_context_processor(old, new):
+    templates = [dict(engine, OPTIONS=dict(engine['OPTIONS'])) for engine in settings.TEMPLATES]
+    for engine in templates:
+        engine['OPTIONS']['context_processors'] = [
+            new if processor == old else processor
+            for processor in engine['OPTIONS'].get('context_processors', [])
+        ]
+    return override_settings(TEMPLATES=templates)
+
+
+@benchmark('navigation')
+def navigation_benchmark(out, repeat=50, **options):
+    """Queries per request on the home and product pages, eager vs cached navigation."""
+    product = seed_catalog()[0]
+    pages = {'home': '/', 'product': f'/products/{product.slug}/'}
+    modes = {
+        'before': with_context_processor(
+            'store.context_processors.site_settings', 'store.benchmarks.eager_site_settings'
+        ),
+        'after': override_settings(NAVIGATION_CACHE_TTL=300),
+    }
+    client = Client()
+    out.write(f"{'page':<10}{'mode':<10}{'queries/req':>12}{'ms/req':>10}")
+    for page, url in pages.items():
+        for mode, overrides in modes.items():
+            with overrides:
+                queries, ms = measure_requests(client, url, repeat)
+            out.write(f"{page:<10}{mode:<10}{queries:>12.1f}{ms:>10.2f}")
+
+
+@benchmark('search')
+def search_benchmark(out, repeat=20, size=100_000, **options):
+    """Full-text index vs the old icontains scan over a synthetic catalog."""
+    start = time.perf_counter()
+    seed_synthetic_catalog(size)
+    out.write(f"seeded {size} products in {time.perf_counter() - start:.1f}s")
+    start = time.perf_counter()
+    rebuild_search_index()
+    out.write(f"built search index in {time.perf_counter() - start:.1f}s")
+
+    def legacy(query):
+        products = Product.objects.filter(is_available=True).filter(
+            Q(name__icontains=query) | Q(description__icontains=query) | Q(category__name__icontains=query)
+        )
+        if products.count() == 1:
+            return [products.first().pk]
+        return list(products.values_list('pk', flat=True))
+
+    out.write(f"{'query':<18}{'legacy hits':>12}{'legacy ms':>11}{'index hits':>12}{'index ms':>10}")
+    for query in ['neem', 'aloe gel', 'shamp', 'kumkumadi serum', 'turmerc', 'hair care oil']:
+        legacy_ids, legacy_ms = timed(lambda: legacy(query), repeat)
+        index_ids, index_ms = timed(lambda: search_product_ids(query), repeat)
+        out.write(f"{query:<18}{len(legacy_ids):>12}{legacy_ms:>11.2f}{len(index_ids):>12}{index_ms:>10.2f}")
+
+
+@benchmark('suggest')
+def suggest_benchmark(out, repeat=200, size=100_000, **options):
+    """Autocomplete index build time and per-keystroke latency over a synthetic catalog."""
+    seed_synthetic_catalog(size)
+    _, build_ms = timed(SuggestIndex.build, 1)
+    out.write(f"built suggest index over {size} products in {build_ms:.0f}ms")
+
+    index = get_suggest_index()
+    keystrokes = [word[:n] for word in ['neem', 'kumkumadi', 'hair care', 'saffron gel', 'zzz'] for n in range(1, len(word) + 1)]
+    with CaptureQueriesContext(connection) as ctx:
+        samples = []
+        for _ in range(repeat):
+            for prefix in keystrokes:
+                start = time.perf_counter()
+                index.suggest(prefix)
+                samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    p50 = samples[len(samples) // 2]
+    p99 = samples[int(len(samples) * 0.99)]
+    out.write(f"{len(samples)} lookups: p50 {p50:.3f}ms, p99 {p99:.3f}ms, max {samples[-1]:.3f}ms, "
+              f"{len(ctx.captured_queries)} queries")
+
+
+
+@benchmark('listing')
+def listing_benchmark(out, repeat=20, size=100_000, **options):
+    """Deep /products/ pages: OFFSET pagination vs the keyset cursors the listing uses."""
+    seed_synthetic_catalog(size)
+    listing = Product.objects.filter(is_available=True)
+    out.write(f"{'sort':<12}{'page':>6}{'offset ms':>11}{'keyset ms':>11}")
+    for sort, ordering in PRODUCT_SORTS.items():
+        ordered = listing.order_by(*[f"-{f}" if desc else f for f, desc in ordering])
+        for page in [1, 100, 1000]:
+            offset = (page - 1) * PRODUCTS_PER_PAGE
+            cursor = None
+            if offset:
+                last = ordered[offset - 1]
+                cursor = encode_cursor([getattr(last, field) for field, _ in ordering])
+            offset_rows, offset_ms = timed(lambda: list(ordered[offset:offset + PRODUCTS_PER_PAGE]), repeat)
+            keyset_rows, keyset_ms = timed(lambda: keyset_page(listing, ordering, cursor, PRODUCTS_PER_PAGE).items, repeat)
+            assert [p.pk for p in offset_rows] == [p.pk for p in keyset_rows]
+            out.write(f"{sort:<12}{page:>6}{offset_ms:>11.2f}{keyset_ms:>11.2f}")
+
+
+@benchmark('facets')
+def facets_benchmark(out, repeat=200, size=100_000, **options):
+    """Facet index build time and sidebar counting over a synthetic catalog."""
+    seed_synthetic_catalog(size)
+    index, build_ms = timed(FacetIndex.build, 1)
+    out.write(f"built facet index over {index.size} available products in {build_ms:.0f}ms")
+
+    selections = [
+        {},
+        {'category': [index.facets[0][2][0].key]},
+        {'concern': ['acne', 'dry_skin'], 'price': ['250-500'], 'stock': ['in-stock']},
+        {'category': [v.key for v in index.facets[0][2][:2]], 'sale': ['on-sale'], 'rating': ['unrated']},
+    ]
+    out.write(f"{'facets ticked':<15}{'matches':>9}{'ms':>8}")
+    for selection in selections:
+        with CaptureQueriesContext(connection) as ctx:
+            result, ms = timed(lambda: index.counts(selection), repeat)
+        assert not ctx.captured_queries
+        ticked = sum(len(keys) for keys in selection.values())
+        out.write(f"{ticked:<15}{result['total']:>9}{ms:>8.3f}")
+
+
+@benchmark('similar')
+def similar_benchmark(out, repeat=5, size=50_000, **options):
+    """Similar-products index: full build, neighbour lists, and refreshing a few edited products."""
+    seed_synthetic_catalog(size)
+    # Seeding counts as long ago, so the refreshes below only see the edits
+    Product.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+    index, build_ms = timed(SimilarityIndex.build, 1)
+    out.write(f"built TF-IDF vectors for {size} products in {build_ms:.0f}ms")
+
+    rng = random.Random(7)
+    ids = list(index.rows)
+    rows = [index.rows[pk] for pk in rng.sample(ids, 4 * CHUNK)]
+    _, batch_ms = timed(lambda: index.compute(rows), 1)
+    per_product = batch_ms / len(rows)
+    out.write(f"neighbour lists for {len(rows)} products in batches of {CHUNK}: {per_product:.2f}ms each "
+              f"(all {size}: ~{per_product * size / 1000:.0f}s)")
+    lookups = [pk for pk in rng.sample(ids, repeat) if not index.ready[index.rows[pk]]]
+    _, lookup_ms = timed(lambda: index.similar(lookups.pop()), len(lookups))
+    out.write(f"first lookup of an uncomputed product: {lookup_ms:.1f}ms")
+
+    out.write(f"{'edited':>7}{'refresh ms':>12}{'lists kept':>12}")
+    for edited in [1, 10, 100]:
+        changed = rng.sample(ids, edited)
+        Product.objects.filter(pk__in=changed).update(
+            description='neem tulsi clarifying face wash for oily skin', updated_at=timezone.now(),
+        )
+        fresh, refresh_ms = timed(index.refresh, 1)
+        out.write(f"{edited:>7}{refresh_ms:>12.0f}{int(fresh.ready.sum()):>12}")
+        index = fresh
+        Product.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+        index.synced_at = timezone.now()
+
+
+PRAISE = ['love', 'amazing', 'great', 'soft', 'glowing', 'works', 'recommend', 'gentle', 'best', 'fresh']
+COMPLAINTS = ['broke', 'rash', 'sticky', 'smells', 'waste', 'itchy', 'dry', 'worst', 'greasy', 'disappointed']
+SPAM = ['click', 'www.cheap-deals.com', 'offer', 'win', 'free', 'call 98765 43210', 'cash', 'FOLLOW', 'whatsapp']
+
+
+def synthetic_reviews(size, seed=42):
+    """(texts, sentiment labels, spam labels) of `size` generated reviews, a tenth of them spam."""
+    rng = random.Random(seed)
+    texts, sentiment, spam = [], [], []
+    for _ in range(size):
+        words = rng.choices(FILLER + INGREDIENTS + FORMATS, k=rng.randrange(4, 40))
+        if rng.random() < 0.1:
+            words += rng.choices(SPAM, k=4)
+            sentiment.append(None)
+            spam.append(1)
+        else:
+            positive = rng.random() < 0.7
+            words += rng.choices(PRAISE if positive else COMPLAINTS, k=3)
+            sentiment.append(int(positive))
+            spam.append(0)
+        rng.shuffle(words)
+        texts.append(' '.join(words))
+    return texts, sentiment, spam
+
+
+@benchmark('reviews')
+def reviews_benchmark(out, size=100_000, **options):
+    """Review classifier: training, then scoring `size` reviews on CPU, one at a time and in batches (each once)."""
+    texts, sentiment, spam = synthetic_reviews(size)
+    train_size = min(size, 20_000)
+    classifier, train_ms = timed(
+        lambda: ReviewClassifier.train(texts[:train_size], sentiment[:train_size], spam[:train_size]), 1,
+    )
+    out.write(f"trained on {train_size} reviews in {train_ms:.0f}ms")
+
+    out.write(f"{'batch':>7}{'reviews/s':>12}{'ms per 100k':>13}")
+    for batch in [1, 100, BATCH_SIZE, 5000]:
+        # One review at a time is slow; a sample is enough to measure it
+        sample = texts[:2000] if batch == 1 else texts
+
+        def score_all():
+            for start in range(0, len(sample), batch):
+                classifier.score(sample[start:start + batch])
+
+        _, elapsed = timed(score_all, 1)
+        rate = len(sample) / elapsed * 1000
+        out.write(f"{batch:>7}{rate:>12.0f}{100_000 / rate * 1000:>13.0f}")
+
+
+def legacy_place_order(user, items, **fields):
+    """The per-line loop every checkout path used to run."""
+    order = Order.objects.create(user=user, **fields)
+    for item in items:
+        if item.combo_deal:
+            OrderItem.objects.create(order=order, combo_deal=item.combo_deal,
+                                     price=item.combo_deal.discounted_price, quantity=item.quantity)
+            for product in item.combo_deal.products.all():
+                if product.stock >= item.quantity:
+                    product.stock -= item.quantity
+                    product.save()
+        else:
+            OrderItem.objects.create(order=order, product=item.product,
+                                     price=item.unit_price or item.product.get_display_price(), quantity=item.quantity)
+            if item.product.stock >= item.quantity:
+                item.product.stock -= item.quantity
+                item.product.save()
+    CartItem.objects.filter(pk__in=[item.pk for item in items]).delete()
+    return order
+
+
+@benchmark('checkout')
+def checkout_benchmark(out, repeat=20, size=30, **options):
+    """Turning a `size`-line cart (a fifth of them combos) into an order."""
+    products = seed_catalog(products_per_category=max(size, 8))
+    Product.objects.update(stock=1_000_000)
+    combos = []
+    for i in range(max(size // 5, 1)):
+        combo = ComboDeal.objects.create(name=f'Kit {i}', description='Kit', original_price='500', discounted_price='399')
+        combo.products.set(products[i * 3:i * 3 + 3])
+        combos.append(combo)
+    user = CustomUser.objects.create_user(username='benchmark', password='benchmark')
+    cart = Cart.objects.create(user=user)
+
+    def fill_cart():
+        lines = [CartItem(cart=cart, combo_deal=combo, quantity=1) for combo in combos]
+        lines += [CartItem(cart=cart, product=p, quantity=2) for p in products[:size - len(lines)]]
+        CartItem.objects.bulk_create(lines)
+        return list(cart.items.select_related('product', 'combo_deal'))
+
+    out.write(f"{'implementation':<16}{'lines':>7}{'queries':>9}{'ms':>9}")
+    for label, place in [('per-line loop', legacy_place_order), ('place_order', place_order)]:
+        queries, elapsed = 0, 0.0
+        for _ in range(repeat):
+            items = fill_cart()
+            reset_queries()
+            with CaptureQueriesContext(connection) as ctx:
+                start = time.perf_counter()
+                with transaction.atomic():
+                    place(user, items, first_name='Bench', paid_amount=Decimal('1.00'))
+                elapsed += time.perf_counter() - start
+            queries += len(ctx.captured_queries)
+        out.write(f"{label:<16}{len(items):>7}{queries / repeat:>9.0f}{elapsed * 1000 / repeat:>9.2f}")
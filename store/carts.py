@@ -0,0 +1,149 @@
+# store/carts.py
+"""
+Carts.
+
+A signed-in customer has one active cart, their cart that is not yet
+paid (the cart_one_active_per_user constraint). A visitor who has not
+signed in gets a cart with no user, remembered by id in their session.
+Signing in folds that cart into the customer's own.
+
+Cart lines are unique per product and per combo (CartItem.Meta), and
+add_line() is one INSERT ... ON CONFLICT DO UPDATE that raises the
+existing line's quantity. Adding to the cart is therefore a single
+statement, and concurrent adds cannot create duplicate lines.
+
+Every change to a cart's lines goes through changing(), which bumps
+Cart.version in the same transaction. A client that sends back the
+version it last saw (the JSON cart API does) has its change refused with
+StaleCart if the cart moved on in between, say in another tab.
+"""
+from contextlib import contextmanager
+
+from django.contrib.auth.signals import user_logged_in
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.dispatch import receiver
+
+from .models import Cart, CartItem
+from .utils import store_cart_summary
+
+SESSION_KEY = 'cart_id'
+
+# Backends that support INSERT ... ON CONFLICT (cols) WHERE ... DO UPDATE
+UPSERT_VENDORS = ('sqlite', 'postgresql')
+
+
+class StaleCart(Exception):
+    """The cart is no longer at the version the client last saw."""
+
+
+def active_cart(user):
+    """The user's active cart, created if they have none."""
+    cart, _ = Cart.objects.get_or_create(user=user, is_paid=False)
+    return cart
+
+
+def current_cart(request, create=False):
+    """
+    The cart for this request: the user's active cart, or for visitors the
+    one their session points at. None if there is none and not `create`.
+    """
+    if request.user.is_authenticated:
+        if create:
+            return active_cart(request.user)
+        return Cart.objects.filter(user=request.user, is_paid=False).first()
+    cart_id = request.session.get(SESSION_KEY)
+    cart = None
+    if cart_id:
+        cart = Cart.objects.filter(pk=cart_id, user__isnull=True, is_paid=False).first()
+    if cart is None and create:
+        cart = Cart.objects.create()
+        request.session[SESSION_KEY] = cart.pk
+    return cart
+
+
+@contextmanager
+def changing(cart, version=None):
+    """
+    A transaction for changing `cart`'s lines. Bumps its version first,
+    which also locks the row, raising StaleCart if it was not `version`.
+    """
+    with transaction.atomic():
+        carts = Cart.objects.filter(pk=cart.pk)
+        if version is not None:
+            carts = carts.filter(version=version)
+        if not carts.update(version=F('version') + 1):
+            raise StaleCart(f'Cart #{cart.pk} has changed')
+        if version is not None:
+            cart.version = version + 1
+        else:
+            cart.version = Cart.objects.values_list('version', flat=True).get(pk=cart.pk)
+        yield cart
+
+
+def _upsert_sql(column, select=False):
+    """
+    INSERT of a line (or, with `select`, of another cart's lines) that adds
+    to the quantity of a line already there for the same product/combo.
+    """
+    qn = connection.ops.quote_name
+    table = qn(CartItem._meta.db_table)
+    cart, item, quantity, unit_price = (
+        qn(CartItem._meta.get_field(name).column) for name in ('cart', column, 'quantity', 'unit_price')
+    )
+    if select:
+        source = f'SELECT %s, {item}, {quantity}, {unit_price} FROM {table} WHERE {cart} = %s AND {item} IS NOT NULL'
+    else:
+        source = 'VALUES (%s, %s, %s, NULL)'
+    return (
+        f'INSERT INTO {table} ({cart}, {item}, {quantity}, {unit_price}) {source} '
+        f'ON CONFLICT ({cart}, {item}) WHERE {item} IS NOT NULL '
+        f'DO UPDATE SET {quantity} = {table}.{quantity} + excluded.{quantity}'
+    )
+
+
+def add_line(cart, product=None, combo_deal=None, quantity=1):
+    """Add `quantity` of a product or a combo to `cart`, in one statement."""
+    column, target = ('product', product) if product is not None else ('combo_deal', combo_deal)
+    if connection.vendor in UPSERT_VENDORS:
+        with connection.cursor() as cursor:
+            cursor.execute(_upsert_sql(column), [cart.pk, target.pk, quantity])
+        return
+    lines = CartItem.objects.filter(cart=cart, **{column: target})
+    if lines.update(quantity=F('quantity') + quantity):
+        return
+    try:
+        with transaction.atomic():
+            CartItem.objects.create(cart=cart, quantity=quantity, **{column: target})
+    except IntegrityError:
+        lines.update(quantity=F('quantity') + quantity)
+
+
+def merge_carts(source, target):
+    """Move every line of `source` into `target`, adding up quantities, and delete `source`."""
+    with changing(target):
+        if connection.vendor in UPSERT_VENDORS:
+            with connection.cursor() as cursor:
+                for column in ('product', 'combo_deal'):
+                    cursor.execute(_upsert_sql(column, select=True), [target.pk, source.pk])
+        else:
+            for line in source.items.all():
+                add_line(target, line.product, line.combo_deal, line.quantity)
+        source.delete()
+
+
+#Fold a visitor's cart into their own when they sign in. The badge is
+#recomputed either way: the session may still hold a visitor's summary
+#whose cart is gone.
+@receiver(user_logged_in)
+def merge_session_cart(sender, request, user, **kwargs):
+    if request is None:
+        return
+    guest_id = request.session.pop(SESSION_KEY, None)
+    guest = Cart.objects.filter(pk=guest_id, user__isnull=True, is_paid=False).first() if guest_id else None
+    if guest is not None:
+        cart = active_cart(user)
+        merge_carts(guest, cart)
+    else:
+        cart = Cart.objects.filter(user=user, is_paid=False).first()
+    store_cart_summary(request, cart)
@@ -1,46 +1,24 @@
-from .models import SiteSettings, Offer, Category, Product
-from django.db.models import Sum
-from .utils import get_or_create_cart
+from decimal import Decimal
+from django.utils.functional import SimpleLazyObject
+from .navigation import BUILDERS, get_request_navigation_part
+from .utils import get_cart_summary
 
 
 def cart_count(request):
-    try:
-        cart = get_or_create_cart(request)
-        count = cart.items.aggregate(
-            total=Sum('quantity')
-        )['total'] or 0
-    except Exception:
-        count = 0
-
-    return {'cart_count': count}
-
-def site_settings(request):
-    settings_obj = None
-    try:
-        settings_obj = SiteSettings.objects.first()
-    except Exception:
-        settings_obj = None
-    try:
-        offers = list(Offer.objects.filter(is_active=True)[:3])
-    except Exception:
-        offers = []
-    try:
-        categories = list(Category.objects.all())
-    except Exception:
-        categories = []
-    try:
-        face_products = list(Product.objects.filter(category__slug__iexact='skin-care')[:8])
-        hair_products = list(Product.objects.filter(category__slug__iexact='hair-care')[:8])
-        body_products = list(Product.objects.filter(category__slug__iexact='body-care')[:8])
-    except Exception:
-        face_products = hair_products = body_products = []
+    """Cart badge values, read from the session summary kept by the cart views."""
+    summary = get_cart_summary(request)
     return {
-        'site_settings': settings_obj,
-        'header_offers': offers,
-        'nav_categories': categories,
-        'nav_face_products': face_products,
-        'nav_hair_products': hair_products,
-        'nav_body_products': body_products,
+        'cart_count': summary['count'],
+        'cart_subtotal': Decimal(summary['subtotal']),
     }
 
+def site_settings(request):
+    """
+    Header/footer/mega-menu data. Each value is lazy, so responses that never
+    touch it (JSON, redirects, pages without a menu) cost nothing, and the
+    ones that do read each part from the versioned cache once per request.
+    """
+    def lazy(key):
+        return SimpleLazyObject(lambda: get_request_navigation_part(request, key))
 
+    return {key: lazy(key) for key in BUILDERS}
@@ -0,0 +1,189 @@
+# store/facets.py
+"""
+Faceted browsing over the available products.
+
+Values within a facet are ORed and facets are ANDed, so ticking two
+categories shows both. The count beside each value is what the listing
+would show if that value were ticked too. That means each facet is counted
+against the selection on every *other* facet.
+
+Counts come from an in-process bitmap index. Every product gets a bit
+position and every facet value a Python int with the bits of its products
+set, so a count is a few ANDs and one bit_count(). The index is rebuilt from
+one query, in the background, whenever the catalog version moves, which
+makes the sidebar free for warm processes however many facets there are. The listing itself still
+filters in SQL through each value's Q.
+"""
+from collections import namedtuple
+from decimal import Decimal
+
+from django.db.models import Q
+
+from .models import Category, Product
+from .versions import CATALOG, VersionedIndex
+
+FacetValue = namedtuple('FacetValue', ['key', 'label', 'q', 'test'])
+
+PRICE_BUCKETS = [
+    ('under-250', 'Under ₹250', None, Decimal('250')),
+    ('250-500', '₹250 – ₹500', Decimal('250'), Decimal('500')),
+    ('500-1000', '₹500 – ₹1000', Decimal('500'), Decimal('1000')),
+    ('1000-up', '₹1000 & above', Decimal('1000'), None),
+]
+RATING_BANDS = [
+    ('4-up', '4★ & above', 4, None),
+    ('3-4', '3★ – 4★', 3, 4),
+    ('under-3', 'Below 3★', None, 3),
+]
+
+# Columns the index reads for every product
+FIELDS = ['id', 'category_id', 'concern', 'listing_price', 'sale_price', 'stock', 'listing_rating', 'rating_count']
+
+
+def _between(field, low, high):
+    lookups = {}
+    if low is not None:
+        lookups[f'{field}__gte'] = low
+    if high is not None:
+        lookups[f'{field}__lt'] = high
+    return Q(**lookups)
+
+
+def _in_range(value, low, high):
+    return (low is None or value >= low) and (high is None or value < high)
+
+
+def price_values():
+    return [
+        FacetValue(key, label, _between('listing_price', low, high),
+                   lambda row, low=low, high=high: _in_range(row['listing_price'], low, high))
+        for key, label, low, high in PRICE_BUCKETS
+    ]
+
+
+def rating_values():
+    values = [
+        FacetValue(key, label, Q(rating_count__gt=0) & _between('listing_rating', low, high),
+                   lambda row, low=low, high=high: row['rating_count'] > 0 and _in_range(row['listing_rating'], low, high))
+        for key, label, low, high in RATING_BANDS
+    ]
+    values.append(FacetValue('unrated', 'Not yet rated', Q(rating_count=0), lambda row: row['rating_count'] == 0))
+    return values
+
+
+def build_facets():
+    """(name, label, [FacetValue]) for every facet, in sidebar order."""
+    categories = Category.objects.order_by('name').values_list('pk', 'slug', 'name')
+    return [
+        ('category', 'Category', [
+            FacetValue(slug, name, Q(category_id=pk), lambda row, pk=pk: row['category_id'] == pk)
+            for pk, slug, name in categories
+        ]),
+        ('concern', 'Concern', [
+            FacetValue(key, label, Q(concern=key), lambda row, key=key: row['concern'] == key)
+            for key, label in Product.CONCERN_CHOICES
+        ]),
+        ('price', 'Price', price_values()),
+        ('sale', 'Offers', [
+            FacetValue('on-sale', 'On sale', Q(sale_price__isnull=False), lambda row: row['sale_price'] is not None),
+        ]),
+        ('stock', 'Availability', [
+            FacetValue('in-stock', 'In stock', Q(stock__gt=0), lambda row: row['stock'] > 0),
+        ]),
+        ('rating', 'Rating', rating_values()),
+    ]
+
+
+def _bitmap(positions, size):
+    bits = bytearray((size + 7) // 8)
+    for position in positions:
+        bits[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(bits, 'little')
+
+
+class FacetIndex:
+    def __init__(self, facets, rows):
+        self.facets = facets
+        self.size = len(rows)
+        self.positions = {row['id']: i for i, row in enumerate(rows)}
+        self.everything = (1 << self.size) - 1
+        self.bitmaps = {
+            name: {
+                value.key: _bitmap([i for i, row in enumerate(rows) if value.test(row)], self.size)
+                for value in values
+            }
+            for name, label, values in facets
+        }
+
+    @classmethod
+    def build(cls):
+        rows = list(Product.objects.filter(is_available=True).values(*FIELDS))
+        return cls(build_facets(), rows)
+
+    def subset(self, product_ids):
+        """A bitmap of the given products, to count within e.g. search results."""
+        return _bitmap([self.positions[pk] for pk in product_ids if pk in self.positions], self.size)
+
+    def clean(self, params):
+        """{facet: [keys]} of the known values ticked in `params`, a QueryDict."""
+        selection = {}
+        for name, bitmaps in self.bitmaps.items():
+            keys = [key for key in dict.fromkeys(params.getlist(name)) if key in bitmaps]
+            if keys:
+                selection[name] = keys
+        return selection
+
+    def filter(self, selection):
+        """A Q selecting the products that match `selection`."""
+        condition = Q()
+        for name, label, values in self.facets:
+            keys = selection.get(name)
+            if keys:
+                condition &= Q.create([value.q for value in values if value.key in keys], connector=Q.OR)
+        return condition
+
+    def _mask(self, name, keys):
+        mask = 0
+        for key in keys:
+            mask |= self.bitmaps[name][key]
+        return mask
+
+    def counts(self, selection, within=None):
+        """
+        The sidebar for `selection`: total matches, then per facet a list of
+        {key, label, count, selected}. `within` limits counting to a subset().
+        """
+        universe = self.everything if within is None else within
+        masks = {name: self._mask(name, keys) for name, keys in selection.items()}
+        total = universe
+        for mask in masks.values():
+            total &= mask
+        facets = []
+        for name, label, values in self.facets:
+            others = universe
+            for other, mask in masks.items():
+                if other != name:
+                    others &= mask
+            selected = selection.get(name, ())
+            facets.append({
+                'name': name,
+                'label': label,
+                'values': [
+                    {
+                        'key': value.key,
+                        'label': value.label,
+                        'count': (self.bitmaps[name][value.key] & others).bit_count(),
+                        'selected': value.key in selected,
+                    }
+                    for value in values
+                ],
+            })
+        return {'total': total.bit_count(), 'facets': facets}
+
+
+_index = VersionedIndex(CATALOG, FacetIndex.build)
+
+
+def get_facet_index():
+    """This process's index; while the catalog version has moved, the previous one as it is rebuilt."""
+    return _index.get()
@@ -0,0 +1,125 @@
+# store/fake_gateway.py
+"""
+A local stand-in for the parts of the Razorpay API the store uses, for
+working and testing offline. Run it with `manage.py fake_razorpay` and set
+RAZORPAY_BASE_URL to the URL it prints.
+
+It can also misbehave on purpose. `fail_next` answers that many requests
+with a 500, and `delay` sleeps before every answer, so timeouts, retries
+and the circuit breaker can be exercised.
+"""
+import itertools
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _error(code, description):
+    return {'error': {'code': code, 'description': description}}
+
+
+class FakeRazorpayHandler(BaseHTTPRequestHandler):
+    # Keep connections open between requests, as the real API does
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _respond(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _misbehave(self):
+        """Apply any configured delay or failure. True if the request was answered."""
+        server = self.server
+        # Always drain the body, or it would be read as the next request on this connection
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length)
+        # Which client port asked, so tests can tell whether connections were reused
+        server.requests.append((self.command, self.path, self.client_address[1]))
+        if server.delay:
+            time.sleep(server.delay)
+        with server.lock:
+            if server.fail_next > 0:
+                server.fail_next -= 1
+                failing = True
+            else:
+                failing = False
+        if failing:
+            self._respond(500, _error('SERVER_ERROR', 'Simulated gateway failure'))
+        return failing
+
+    def do_POST(self):
+        if self._misbehave():
+            return
+        if self.path.rstrip('/') != '/v1/orders':
+            return self._respond(404, _error('BAD_REQUEST_ERROR', 'The requested URL was not found on the server.'))
+        data = json.loads(self.body or b'{}')
+        if not isinstance(data.get('amount'), int) or data['amount'] < 100:
+            return self._respond(400, _error('BAD_REQUEST_ERROR', 'The amount must be atleast INR 1.00'))
+        order = {
+            'id': f'order_fake{next(self.server.ids):010d}',
+            'entity': 'order',
+            'amount': data['amount'],
+            'amount_paid': 0,
+            'amount_due': data['amount'],
+            'currency': data.get('currency', 'INR'),
+            'receipt': data.get('receipt'),
+            'notes': data.get('notes', {}),
+            'status': 'created',
+            'attempts': 0,
+            'created_at': int(time.time()),
+        }
+        self.server.orders[order['id']] = order
+        self._respond(200, order)
+
+    def do_GET(self):
+        if self._misbehave():
+            return
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if len(parts) == 3 and parts[:2] == ['v1', 'orders'] and parts[2] in self.server.orders:
+            return self._respond(200, self.server.orders[parts[2]])
+        if len(parts) == 3 and parts[:2] == ['v1', 'payments'] and parts[2] in self.server.payments:
+            return self._respond(200, self.server.payments[parts[2]])
+        self._respond(400, _error('BAD_REQUEST_ERROR', 'The id provided does not exist'))
+
+
+class FakeRazorpayServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), verbose=False):
+        super().__init__(address, FakeRazorpayHandler)
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.orders = {}
+        self.payments = {}
+        self.requests = []
+        self.fail_next = 0
+        self.delay = 0
+
+    def handle_error(self, request, client_address):
+        # A client that timed out and hung up is expected here, not an error
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        """Serve from a background thread; returns the server."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,162 @@
+# store/forecast.py
+"""
+Demand forecasts and low-stock alerts.
+
+`manage.py forecast_demand`, run nightly, turns the last
+FORECAST_HISTORY_DAYS of orders into one daily sales series per product.
+A combo line counts as its quantity of each product in the combo.
+Cancelled and failed orders are left out, and today, not yet over, is too.
+
+Every series is fitted at once with simple exponential smoothing, as
+numpy operations over a products x days matrix. Each product gets the
+smoothing factor from ALPHAS with the least one-day-ahead squared error.
+The final smoothed level is its forecast daily demand. Stock divided by
+that gives the days until it runs out.
+
+The results go into StockForecast, one row per product, which the
+product admin reads for its "Runs out" column and filter. Staff are
+emailed about products that will run out within STOCKOUT_ALERT_DAYS. A
+product is only alerted once, until it is out of danger again.
+"""
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import ComboDeal, CustomUser, OrderItem, Product, StockForecast
+from .tasks import send_email
+
+DEFAULTS = {
+    'FORECAST_HISTORY_DAYS': 90,
+    'STOCKOUT_ALERT_DAYS': 14,
+}
+
+ALPHAS = np.array([0.05, 0.1, 0.2, 0.3, 0.5, 0.7])
+# Days averaged for a series' starting level
+WARMUP_DAYS = 7
+# Forecast demand below this many units a day counts as none
+MIN_DEMAND = 0.01
+WRITE_BATCH = 1000
+
+
+def _setting(name):
+    return getattr(settings, name, DEFAULTS[name])
+
+
+def _midnight(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def daily_sales(product_ids, start, days):
+    """Units of each product in `product_ids` (rows) sold on each of `days` days from `start` (columns)."""
+    rows = {pk: i for i, pk in enumerate(product_ids)}
+    combos = defaultdict(list)
+    for combo_id, product_id in ComboDeal.products.through.objects.values_list('combodeal_id', 'product_id'):
+        combos[combo_id].append(product_id)
+    lines = (
+        OrderItem.objects
+        .filter(order__created_at__gte=_midnight(start), order__created_at__lt=_midnight(start + timedelta(days=days)))
+        .exclude(order__status='cancelled')
+        .exclude(order__payment_status='failed')
+        .annotate(day=TruncDate('order__created_at'))
+        .values('day', 'product_id', 'combo_deal_id')
+        .annotate(units=Sum('quantity'))
+        .values_list('day', 'product_id', 'combo_deal_id', 'units')
+        .order_by()
+    )
+    sales = np.zeros((len(product_ids), days))
+    for day, product_id, combo_id, units in lines:
+        column = (day - start).days
+        for member in ([product_id] if product_id else []) + combos.get(combo_id, []):
+            if member in rows:
+                sales[rows[member], column] += units
+    return sales
+
+
+def smooth(sales, alphas=ALPHAS):
+    """The forecast of every row of `sales` by simple exponential smoothing, each with its best alpha."""
+    alphas = alphas[:, None]
+    level = np.repeat(sales[:, :WARMUP_DAYS].mean(axis=1, keepdims=True).T, len(alphas), axis=0)
+    error = np.zeros_like(level)
+    for day in sales.T:
+        miss = day - level
+        error += miss ** 2
+        level += alphas * miss
+    return level[error.argmin(axis=0), np.arange(sales.shape[0])]
+
+
+def build_forecasts(today=None):
+    """Forecast every product's demand and stockout. Returns the number of products forecast."""
+    today = today or timezone.localdate()
+    days = _setting('FORECAST_HISTORY_DAYS')
+    products = list(Product.objects.order_by('id').values_list('id', 'stock'))
+    ids = [pk for pk, _ in products]
+    stock = np.array([units for _, units in products], dtype=np.float64)
+    demand = smooth(daily_sales(ids, today - timedelta(days=days), days))
+    selling = demand >= MIN_DEMAND
+    days_left = np.divide(stock, demand, out=np.full(len(ids), np.nan), where=selling)
+
+    now = timezone.now()
+    forecasts = [
+        StockForecast(
+            product_id=pk,
+            daily_demand=float(rate) if sells else 0.0,
+            days_until_stockout=float(left) if sells else None,
+            # Capped: a product selling once a year is "never" for any date we could show
+            stockout_on=today + timedelta(days=int(left)) if sells and left < 3650 else None,
+            stock=int(units),
+            computed_at=now,
+        )
+        for pk, units, rate, sells, left in zip(ids, stock, demand, selling, days_left)
+    ]
+    with transaction.atomic():
+        StockForecast.objects.bulk_create(
+            forecasts,
+            batch_size=WRITE_BATCH,
+            update_conflicts=True,
+            unique_fields=['product'],
+            update_fields=['daily_demand', 'days_until_stockout', 'stockout_on', 'stock', 'computed_at'],
+        )
+    return len(forecasts)
+
+
+def alert_days():
+    return _setting('STOCKOUT_ALERT_DAYS')
+
+
+def at_risk(days=None):
+    """Forecasts of products that run out within `days` (STOCKOUT_ALERT_DAYS by default)."""
+    return StockForecast.objects.filter(days_until_stockout__lte=days or alert_days())
+
+
+def send_stockout_alerts():
+    """Email staff about products newly at risk of running out. Returns how many were in the email."""
+    # Out of danger again, so alerted afresh if it comes back
+    StockForecast.objects.filter(alerted_at__isnull=False).exclude(pk__in=at_risk().values('pk')).update(alerted_at=None)
+    fresh = list(
+        at_risk().filter(alerted_at__isnull=True, product__is_available=True)
+        .select_related('product').order_by('days_until_stockout')
+    )
+    recipients = list(
+        CustomUser.objects.filter(is_staff=True, is_active=True).exclude(email='').values_list('email', flat=True)
+    )
+    if not fresh or not recipients:
+        return 0
+    lines = '\n'.join(
+        f'{forecast.product.name}: {forecast.stock} left, selling about {forecast.daily_demand:.1f} a day'
+        + (f', out by {forecast.stockout_on:%d %b}' if forecast.stockout_on else '')
+        for forecast in fresh
+    )
+    with transaction.atomic():
+        send_email.delay(
+            subject=f'{len(fresh)} products running low',
+            message=f'These products will run out within {alert_days()} days:\n\n{lines}',
+            recipient_list=recipients,
+        )
+        StockForecast.objects.filter(pk__in=[forecast.pk for forecast in fresh]).update(alerted_at=timezone.now())
+    return len(fresh)
@@ -0,0 +1,75 @@
+# store/inventory.py
+"""
+Stock reservation shared by every order path.
+
+reserve_stock() takes all the units an order needs in one conditional
+UPDATE. The UPDATE only matches rows that still hold enough stock, so two
+checkouts racing for the last unit cannot both win, and nothing is read
+into Python and written back. Either every line is reserved or
+OutOfStock is raised and nothing changes. Call it inside the transaction
+that creates the order, so a failure later in that transaction hands the
+stock back.
+"""
+from collections import Counter, defaultdict
+
+from django.db import connection, transaction
+from django.db.models import Case, F, IntegerField, Value, When
+
+from .models import ComboDeal, Product
+from .versions import CATALOG, bump_version
+
+
+class OutOfStock(Exception):
+    def __init__(self, shortages):
+        # {product name: units still available}
+        self.shortages = shortages
+        names = ', '.join(f'{name} ({available} left)' for name, available in shortages.items())
+        super().__init__(f'Not enough stock for: {names}')
+
+
+def stock_requirements(items):
+    """
+    {product id: units} needed for cart or order lines, with each combo
+    line expanded into the products it contains.
+    """
+    needed = Counter()
+    combo_lines = []
+    for item in items:
+        if item.combo_deal_id:
+            combo_lines.append(item)
+        elif item.product_id:
+            needed[item.product_id] += item.quantity
+    if combo_lines:
+        members = defaultdict(list)
+        through = ComboDeal.products.through.objects.filter(
+            combodeal_id__in={item.combo_deal_id for item in combo_lines}
+        )
+        for combo_id, product_id in through.values_list('combodeal_id', 'product_id'):
+            members[combo_id].append(product_id)
+        for item in combo_lines:
+            for product_id in members[item.combo_deal_id]:
+                needed[product_id] += item.quantity
+    return dict(needed)
+
+
+def reserve_stock(needed):
+    """Take `needed` ({product id: units}) out of stock, all or nothing."""
+    if not needed:
+        return
+    ids = sorted(needed)
+    with transaction.atomic():
+        if connection.features.has_select_for_update:
+            # Lock in primary key order so concurrent checkouts queue up
+            # instead of deadlocking on each other's rows
+            list(Product.objects.select_for_update().filter(pk__in=ids).order_by('pk').values_list('pk'))
+        units = Case(*[When(pk=pk, then=Value(n)) for pk, n in needed.items()], output_field=IntegerField())
+        reserved = Product.objects.filter(pk__in=ids, stock__gte=units).update(stock=F('stock') - units)
+        if reserved != len(ids):
+            shortages = {}
+            for pk, name, stock in Product.objects.filter(pk__in=ids).values_list('pk', 'name', 'stock'):
+                if stock < needed[pk]:
+                    shortages[name] = stock
+            raise OutOfStock(shortages)
+        # Availability facets only change when something sells out
+        if Product.objects.filter(pk__in=ids, stock=0).exists():
+            transaction.on_commit(lambda: bump_version(CATALOG))
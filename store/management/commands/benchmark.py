@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from store.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = "Run a store benchmark against a throwaway test database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', choices=sorted(BENCHMARKS))
+        parser.add_argument('--repeat', type=int, default=50, help="Iterations per measurement")
+        parser.add_argument('--size', type=int, default=None, help="Synthetic data size, where the benchmark takes one")
+
+    def handle(self, *args, name, **options):
+        kwargs = {'repeat': options['repeat']}
+        if options['size'] is not None:
+            kwargs['size'] = options['size']
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            BENCHMARKS[name](self.stdout, **kwargs)
+        except Exception as e:
+            raise CommandError(f"Benchmark {name} failed: {e}") from e
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
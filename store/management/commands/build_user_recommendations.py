@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from store.personalize import build_user_recommendations
+
+
+class Command(BaseCommand):
+    help = "Recompute every customer's \"recommended for you\" list (run nightly, after train_recommendations)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help="Users scored per batch")
+
+    def handle(self, *args, **options):
+        users = build_user_recommendations(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f"✅ Built recommendations for {users} customers"))
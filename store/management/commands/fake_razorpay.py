@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from store.fake_gateway import FakeRazorpayServer
+
+
+class Command(BaseCommand):
+    help = "Serve a local fake of the Razorpay orders/payments API for offline checkout"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--fail', type=int, default=0, help="Answer the first N requests with a 500")
+        parser.add_argument('--delay', type=float, default=0, help="Seconds to wait before every answer")
+
+    def handle(self, *args, **options):
+        server = FakeRazorpayServer((options['host'], options['port']), verbose=True)
+        server.fail_next = options['fail']
+        server.delay = options['delay']
+        self.stdout.write(self.style.SUCCESS(f"✅ Fake Razorpay on {server.base_url} (set RAZORPAY_BASE_URL to this)"))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from store.forecast import at_risk, build_forecasts, send_stockout_alerts
+
+
+class Command(BaseCommand):
+    help = "Forecast every product's demand and stockout date, and email staff about products running low"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--no-alerts', action='store_true', help="Forecast without emailing staff")
+
+    def handle(self, *args, **options):
+        products = build_forecasts()
+        alerted = 0 if options['no_alerts'] else send_stockout_alerts()
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ Forecast {products} products, {at_risk().count()} running low, alerted staff about {alerted}"
+        ))
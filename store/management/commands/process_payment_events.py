@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from store.webhooks import process_pending
+
+
+class Command(BaseCommand):
+    help = "Apply queued Razorpay webhook events to orders"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Drain the inbox once and exit")
+        parser.add_argument('--interval', type=float, default=2, help="Seconds to wait when the inbox is empty")
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        while True:
+            done, failed = process_pending(limit=options['batch_size'])
+            if done or failed:
+                self.stdout.write(self.style.SUCCESS(f"✅ Processed {done} payment events ({failed} failed)"))
+            if options['once']:
+                return
+            if done + failed < options['batch_size']:
+                time.sleep(options['interval'])
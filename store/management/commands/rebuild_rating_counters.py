@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from store.ratings import rebuild_rating_counters
+
+
+class Command(BaseCommand):
+    help = "Rebuild the denormalized Product rating counters from approved reviews"
+
+    def handle(self, *args, **kwargs):
+        total = rebuild_rating_counters()
+        self.stdout.write(self.style.SUCCESS(f"✅ Rebuilt rating counters for {total} products"))
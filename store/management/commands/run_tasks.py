@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from store.tasks import run_pending
+
+
+class Command(BaseCommand):
+    help = "Run queued background tasks (emails, cache warmups, payment events)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=4, help="Tasks to run at the same time")
+        parser.add_argument('--batch-size', type=int, default=50, help="Tasks to claim at a time")
+        parser.add_argument('--interval', type=float, default=1, help="Seconds to wait when nothing is due")
+        parser.add_argument('--once', action='store_true', help="Run what is due now and exit")
+
+    def handle(self, *args, **options):
+        while True:
+            statuses = run_pending(limit=options['batch_size'], threads=options['threads'])
+            if statuses:
+                failed = len(statuses) - statuses.count('done')
+                self.stdout.write(self.style.SUCCESS(f"✅ Ran {len(statuses)} tasks ({failed} failed)"))
+            if options['once']:
+                return
+            if len(statuses) < options['batch_size']:
+                time.sleep(options['interval'])
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from store.recommend import train
+
+
+class Command(BaseCommand):
+    help = "Update the \"frequently bought together\" recommendations from orders placed since the last run"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help="Start over from every order")
+        parser.add_argument('--batch-size', type=int, default=5000, help="Orders read per query")
+
+    def handle(self, *args, **options):
+        orders, products = train(full=options['full'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"✅ Trained on {orders} orders, refreshed {products} products"))
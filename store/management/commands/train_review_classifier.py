@@ -0,0 +1,38 @@
+import csv
+
+from django.core.management.base import BaseCommand, CommandError
+
+from store.moderation import ReviewClassifier, accuracy, save_classifier, training_examples
+
+
+def _label(value):
+    value = (value or '').strip()
+    return int(value) if value else None
+
+
+class Command(BaseCommand):
+    help = "Train the review sentiment and spam classifier on the reviews so far and make it the active one"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--data', help="A CSV of extra examples with columns text, sentiment and spam (1, 0 or blank)",
+        )
+
+    def handle(self, *args, **options):
+        texts, sentiment, spam = training_examples()
+        if options['data']:
+            with open(options['data'], newline='', encoding='utf-8') as f:
+                for row in csv.DictReader(f):
+                    texts.append(row['text'])
+                    sentiment.append(_label(row.get('sentiment')))
+                    spam.append(_label(row.get('spam')))
+        try:
+            classifier = ReviewClassifier.train(texts, sentiment, spam)
+        except ValueError as e:
+            raise CommandError(str(e))
+        metrics = accuracy(classifier, texts, sentiment, spam)
+        save_classifier(classifier, len(texts), metrics)
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ Trained classifier {classifier.version} on {len(texts)} examples "
+            f"(sentiment {metrics['sentiment']:.0%}, spam {metrics['spam']:.0%} right on them)"
+        ))
@@ -0,0 +1,77 @@
+# Generated by Django 5.2.6 on 2026-10-18 00:53
+
+from collections import defaultdict
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def populate_rating_counters(apps, schema_editor):
+    Product = apps.get_model('store', 'Product')
+    Review = apps.get_model('store', 'Review')
+    fields = ['rating_count', 'rating_sum', 'rating_1', 'rating_2', 'rating_3', 'rating_4', 'rating_5']
+    grouped = (
+        Review.objects.filter(is_approved=True)
+        .order_by()
+        .values_list('product_id', 'rating')
+        .annotate(n=Count('id'))
+    )
+    counters = defaultdict(lambda: dict.fromkeys(fields, 0))
+    for product_id, rating, n in grouped:
+        row = counters[product_id]
+        row['rating_count'] += n
+        row['rating_sum'] += rating * n
+        if 1 <= rating <= 5:
+            row[f'rating_{rating}'] += n
+    # Only products with approved reviews need writing; the rest keep the defaults
+    products = [product for product in Product.objects.only('pk') if product.pk in counters]
+    for product in products:
+        for field, value in counters[product.pk].items():
+            setattr(product, field, value)
+    Product.objects.bulk_update(products, fields, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0029_order_payment_method_order_payment_status_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='rating_1',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_2',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_3',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_4',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_5',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(populate_rating_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,72 @@
+from django.db import migrations
+
+
+SQLITE_SCHEMA = [
+    "CREATE VIRTUAL TABLE store_product_fts USING fts5("
+    "name, keywords, body, tokenize='porter unicode61 remove_diacritics 2')",
+    "CREATE VIRTUAL TABLE store_product_fts_vocab USING fts5vocab(store_product_fts, 'row')",
+]
+SQLITE_DROP = [
+    "DROP TABLE IF EXISTS store_product_fts_vocab",
+    "DROP TABLE IF EXISTS store_product_fts",
+]
+POSTGRES_SCHEMA = [
+    "CREATE TABLE store_product_search ("
+    "product_id bigint PRIMARY KEY REFERENCES store_product (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+    "document tsvector NOT NULL)",
+    "CREATE INDEX store_product_search_document ON store_product_search USING GIN (document)",
+]
+POSTGRES_DROP = [
+    "DROP TABLE IF EXISTS store_product_search",
+]
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    statements = {'sqlite': SQLITE_SCHEMA, 'postgresql': POSTGRES_SCHEMA}.get(vendor, [])
+    for sql in statements:
+        schema_editor.execute(sql)
+    if not statements:
+        return
+
+    Product = apps.get_model('store', 'Product')
+    concern_labels = dict(Product._meta.get_field('concern').choices)
+    rows = [
+        (
+            p.pk,
+            p.name,
+            ' '.join([p.category.name, concern_labels.get(p.concern, ''), p.ideal_for]),
+            ' '.join([p.description, p.what_makes_it_potent]),
+        )
+        for p in Product.objects.select_related('category')
+    ]
+    with schema_editor.connection.cursor() as cursor:
+        if vendor == 'sqlite':
+            cursor.executemany(
+                "INSERT INTO store_product_fts (rowid, name, keywords, body) VALUES (%s, %s, %s, %s)", rows
+            )
+        else:
+            cursor.executemany(
+                "INSERT INTO store_product_search (product_id, document) VALUES (%s, "
+                "setweight(to_tsvector('english', %s), 'A') || "
+                "setweight(to_tsvector('english', %s), 'B') || "
+                "setweight(to_tsvector('english', %s), 'C'))",
+                rows,
+            )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    for sql in {'sqlite': SQLITE_DROP, 'postgresql': POSTGRES_DROP}.get(vendor, []):
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0030_product_rating_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.6 on 2026-10-18 01:11
+
+import django.db.models.expressions
+import django.db.models.functions.comparison
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0031_product_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='listing_price',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.functions.comparison.Coalesce('sale_price', 'price'), output_field=models.DecimalField(decimal_places=2, max_digits=10)),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='listing_rating',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.functions.comparison.Coalesce(django.db.models.expressions.CombinedExpression(django.db.models.expressions.CombinedExpression(models.F('rating_sum'), '*', models.Value(1.0)), '/', django.db.models.functions.comparison.NullIf('rating_count', 0)), 0.0), output_field=models.FloatField()),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['listing_price', 'id'], name='product_listing_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['listing_rating', 'rating_count', 'id'], name='product_listing_rating_idx'),
+        ),
+    ]
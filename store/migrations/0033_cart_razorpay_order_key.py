@@ -0,0 +1,23 @@
+# Generated by Django 5.2.6 on 2026-10-18 01:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0032_product_listing_sort_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='razorpay_order_amount',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='razorpay_order_key',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
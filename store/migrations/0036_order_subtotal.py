@@ -0,0 +1,24 @@
+# Generated by Django 5.2.6 on 2026-10-18 01:34
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0035_task_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='subtotal',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AlterField(
+            model_name='coupon',
+            name='valid_from',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
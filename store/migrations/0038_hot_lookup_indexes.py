@@ -0,0 +1,61 @@
+# Generated by Django 5.2.6 on 2026-10-18 01:39
+
+import django.db.models.functions.text
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_cart_lines(apps, schema_editor):
+    """Fold repeated product/combo lines in a cart into the oldest one."""
+    CartItem = apps.get_model('store', 'CartItem')
+    for field in ('product', 'combo_deal'):
+        duplicates = (
+            CartItem.objects.filter(**{f'{field}__isnull': False})
+            .order_by()
+            .values('cart_id', f'{field}_id')
+            .annotate(lines=Count('id'), keep=Min('id'), quantity=Sum('quantity'))
+            .filter(lines__gt=1)
+        )
+        for row in duplicates:
+            lines = CartItem.objects.filter(cart_id=row['cart_id'], **{f'{field}_id': row[f'{field}_id']})
+            lines.exclude(pk=row['keep']).delete()
+            lines.filter(pk=row['keep']).update(quantity=row['quantity'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0037_order_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_cart_lines, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['razorpay_order_id'], name='order_razorpay_order_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(('is_available', True)), fields=['-id'], name='product_available_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['concern', 'is_available'], name='product_concern_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(condition=models.Q(('is_approved', True)), fields=['product', '-created_at', '-id'], name='review_product_visible_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(condition=models.Q(('product__isnull', False)), fields=('cart', 'product'), name='cartitem_unique_product'),
+        ),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(condition=models.Q(('combo_deal__isnull', False)), fields=('cart', 'combo_deal'), name='cartitem_unique_combo'),
+        ),
+        migrations.AddConstraint(
+            model_name='coupon',
+            constraint=models.UniqueConstraint(django.db.models.functions.text.Lower('code'), name='coupon_code_ci_unique', violation_error_message='A coupon with this code already exists.'),
+        ),
+    ]
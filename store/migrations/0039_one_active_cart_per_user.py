@@ -0,0 +1,50 @@
+# Generated by Django 5.2.6 on 2026-10-18 01:42
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def merge_active_carts(apps, schema_editor):
+    """Fold each user's unpaid carts into their newest one."""
+    Cart = apps.get_model('store', 'Cart')
+    CartItem = apps.get_model('store', 'CartItem')
+    users = (
+        Cart.objects.filter(is_paid=False).order_by().values('user_id')
+        .annotate(carts=Count('id')).filter(carts__gt=1).values_list('user_id', flat=True)
+    )
+    for user_id in users:
+        keep, *others = Cart.objects.filter(user_id=user_id, is_paid=False).order_by('-created_at', '-id')
+        lines = {(line.product_id, line.combo_deal_id): line for line in keep.items.all()}
+        for line in CartItem.objects.filter(cart__in=others).order_by('id'):
+            key = (line.product_id, line.combo_deal_id)
+            if key in lines:
+                lines[key].quantity += line.quantity
+                lines[key].save(update_fields=['quantity'])
+                line.delete()
+            else:
+                line.cart = keep
+                line.save(update_fields=['cart'])
+                lines[key] = line
+        Cart.objects.filter(pk__in=[cart.pk for cart in others]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0038_hot_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_active_carts, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='cart',
+            name='user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='carts', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='cart',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_paid', False)), fields=('user',), name='cart_one_active_per_user'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.6 on 2026-10-18 02:53
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0044_review_moderation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockForecast',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('daily_demand', models.FloatField(default=0)),
+                ('days_until_stockout', models.FloatField(blank=True, null=True)),
+                ('stockout_on', models.DateField(blank=True, null=True)),
+                ('stock', models.PositiveIntegerField(default=0)),
+                ('computed_at', models.DateTimeField()),
+                ('alerted_at', models.DateTimeField(blank=True, null=True)),
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='forecast', to='store.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['days_until_stockout'], name='forecast_stockout_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.6 on 2026-10-18 03:14
+
+from django.db import migrations, models
+from django.db.models import Case, Count, IntegerField, Value, When
+
+
+def unlink_duplicate_payment_orders(apps, schema_editor):
+    """
+    Leave each Razorpay order on one Order: the paid one, else the oldest.
+    The others keep their razorpay_payment_id but lose the order id.
+    """
+    Order = apps.get_model('store', 'Order')
+    Order.objects.filter(razorpay_order_id='').update(razorpay_order_id=None)
+    duplicates = (
+        Order.objects.filter(razorpay_order_id__isnull=False).order_by().values('razorpay_order_id')
+        .annotate(orders=Count('id')).filter(orders__gt=1).values_list('razorpay_order_id', flat=True)
+    )
+    for razorpay_order_id in duplicates:
+        keep = (
+            Order.objects.filter(razorpay_order_id=razorpay_order_id)
+            .annotate(unpaid=Case(When(payment_status='paid', then=Value(0)), default=Value(1), output_field=IntegerField()))
+            .order_by('unpaid', 'created_at', 'id')
+            .values_list('id', flat=True)
+            .first()
+        )
+        Order.objects.filter(razorpay_order_id=razorpay_order_id).exclude(pk=keep).update(razorpay_order_id=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0048_order_backordered_status'),
+    ]
+
+    operations = [
+        migrations.RunPython(unlink_duplicate_payment_orders, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='order',
+            name='order_razorpay_order_idx',
+        ),
+        migrations.AddField(
+            model_name='paymentevent',
+            name='failed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(condition=models.Q(('razorpay_order_id__isnull', False)), fields=('razorpay_order_id',), name='order_razorpay_order_unique'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.6 on 2026-10-18 03:20
+
+from django.db import migrations
+from django.utils import timezone
+
+
+def mark_existing_reviews_scored(apps, schema_editor):
+    # Reviews from before the classifier keep the verdicts staff gave them;
+    # only reviews written from here on are scored
+    Review = apps.get_model('store', 'Review')
+    Review.objects.filter(scored_at__isnull=True).update(scored_at=timezone.now(), model_version='legacy')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0049_payment_integrity'),
+    ]
+
+    operations = [
+        migrations.RunPython(mark_existing_reviews_scored, migrations.RunPython.noop),
+    ]
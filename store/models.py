@@ -1,12 +1,14 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
+from django.utils import timezone
 from django.utils.text import slugify
-from django.db.models.signals import post_save, pre_save
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 import datetime 
 import cloudinary
 from cloudinary.models import CloudinaryField
-from django.db.models import Avg, Count
+from django.db.models import Avg, Count, F, Q
+from django.db.models.functions import Coalesce, Lower, NullIf
 
 
 
@@ -42,6 +44,9 @@ class Category(models.Model):
 
 
 
+RATING_STARS = range(1, 6)
+
+
 class Product(models.Model):
     CONCERN_CHOICES = [
         ('acne', 'Acne'),
@@ -66,6 +71,43 @@ class Product(models.Model):
     how_to_use = models.TextField(blank=True)
     ideal_for = models.TextField(blank=True)
     consumer_studies = models.TextField(blank=True)
+    # Tells the similar-products index (store/similar.py) which rows to re-read
+    updated_at = models.DateTimeField(auto_now=True)
+
+    # Denormalized counters over approved reviews, kept current by the Review
+    # signals below and rebuilt with `manage.py rebuild_rating_counters`.
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    rating_1 = models.PositiveIntegerField(default=0, editable=False)
+    rating_2 = models.PositiveIntegerField(default=0, editable=False)
+    rating_3 = models.PositiveIntegerField(default=0, editable=False)
+    rating_4 = models.PositiveIntegerField(default=0, editable=False)
+    rating_5 = models.PositiveIntegerField(default=0, editable=False)
+
+    # Sort keys of the product listing, computed and stored by the database
+    # so they can be indexed and used directly by keyset pagination.
+    listing_price = models.GeneratedField(
+        expression=Coalesce('sale_price', 'price'),
+        output_field=models.DecimalField(max_digits=10, decimal_places=2),
+        db_persist=True,
+    )
+    listing_rating = models.GeneratedField(
+        expression=Coalesce(F('rating_sum') * 1.0 / NullIf('rating_count', 0), 0.0),
+        output_field=models.FloatField(),
+        db_persist=True,
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['listing_price', 'id'], name='product_listing_price_idx'),
+            models.Index(fields=['listing_rating', 'rating_count', 'id'], name='product_listing_rating_idx'),
+            # Partial indexes over available products only. Django renders
+            # is_available=True as a bare boolean, which SQLite cannot seek on
+            # as an index column but can match against an index's condition.
+            models.Index(fields=['-id'], condition=Q(is_available=True), name='product_available_idx'),
+            models.Index(fields=['concern', 'is_available'], name='product_concern_idx'),
+            models.Index(fields=['updated_at'], name='product_updated_idx'),
+        ]
 
     def save(self, *args, **kwargs):
         if not self.slug:
@@ -74,15 +116,24 @@ class Product(models.Model):
 
     def get_display_price(self):
         return self.sale_price if self.sale_price is not None else self.price
-    
+
+    @property
+    def rating_mean(self):
+        if not self.rating_count:
+            return 0
+        return self.rating_sum / self.rating_count
+
     @property
     def average_rating(self):
-        result = self.reviews.filter(is_approved=True).aggregate(avg=Avg('rating'))['avg']
-        return round(result or 0)
+        return round(self.rating_mean)
 
     @property
     def total_reviews(self):
-        return self.reviews.filter(is_approved=True).count()
+        return self.rating_count
+
+    @property
+    def rating_distribution(self):
+        return {star: getattr(self, f'rating_{star}') for star in RATING_STARS}
 
     def __str__(self) -> str:
         return self.name
@@ -91,9 +142,18 @@ class Coupon(models.Model):
     code = models.CharField(max_length=50, unique=True)
     discount_percentage = models.PositiveIntegerField(help_text="Enter discount percentage (e.g., 10 for 10%)")
     active = models.BooleanField(default=True)
-    valid_from = models.DateTimeField(default=datetime.datetime.now)
+    valid_from = models.DateTimeField(default=timezone.now)
     valid_to = models.DateTimeField(null = True, blank = True)
 
+    class Meta:
+        constraints = [
+            # Codes are matched case-insensitively (store/pricing.py)
+            models.UniqueConstraint(
+                Lower('code'), name='coupon_code_ci_unique',
+                violation_error_message='A coupon with this code already exists.',
+            ),
+        ]
+
     def __str__(self):
         return f"{self.code} - {self.discount_percentage}%"
 
@@ -126,25 +186,100 @@ class Review(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     is_approved = models.BooleanField(default=True)
     photo = models.ImageField(upload_to='reviews/', blank=True, null=True)
+    # Set by the review classifier (store/moderation.py) from the background queue
+    sentiment_score = models.FloatField(blank=True, null=True, editable=False)
+    spam_score = models.FloatField(blank=True, null=True, editable=False)
+    model_version = models.CharField(max_length=40, blank=True, editable=False)
+    scored_at = models.DateTimeField(blank=True, null=True, editable=False)
+    # Held back by the classifier for staff to look at
+    flagged = models.BooleanField(default=False)
+    # Staff's verdict, which the classifier learns from
+    is_spam = models.BooleanField(default=False)
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # A product's approved reviews, newest first
+            models.Index(
+                fields=['product', '-created_at', '-id'], condition=Q(is_approved=True),
+                name='review_product_visible_idx',
+            ),
+            models.Index(fields=['id'], condition=Q(scored_at__isnull=True), name='review_unscored_idx'),
+        ]
 
     def __str__(self) -> str:
         return f"{self.product.name} - {self.rating}"
 
 
+def _shift_rating_counters(product_id, rating, step):
+    """Add (step=1) or remove (step=-1) one approved rating on a product."""
+    changes = {
+        'rating_count': F('rating_count') + step,
+        'rating_sum': F('rating_sum') + step * rating,
+    }
+    if rating in RATING_STARS:
+        field = f'rating_{rating}'
+        changes[field] = F(field) + step
+    Product.objects.filter(pk=product_id).update(**changes)
+
+
+#Remember what the stored review counted for before it changes
+@receiver(pre_save, sender=Review)
+def remember_counted_rating(sender, instance, **kwargs):
+    instance._counted_rating = None
+    if instance.pk:
+        instance._counted_rating = (
+            sender._default_manager
+            .filter(pk=instance.pk, is_approved=True)
+            .values_list('product_id', 'rating')
+            .first()
+        )
+
+
+#Keep Product rating counters in step with review create/approve/unapprove
+@receiver(post_save, sender=Review)
+def update_rating_counters(sender, instance, created, **kwargs):
+    before = None if created else getattr(instance, '_counted_rating', None)
+    after = (instance.product_id, instance.rating) if instance.is_approved else None
+    # Read by store/versions.py, which only bumps the catalog when counters moved
+    instance._moved_rating_counters = before != after
+    if before == after:
+        return
+    if before:
+        _shift_rating_counters(*before, step=-1)
+    if after:
+        _shift_rating_counters(*after, step=1)
+
+
+@receiver(post_delete, sender=Review)
+def discount_deleted_rating(sender, instance, **kwargs):
+    instance._moved_rating_counters = instance.is_approved
+    if instance.is_approved:
+        _shift_rating_counters(instance.product_id, instance.rating, step=-1)
+
+
 class Cart(models.Model):
-    user = models.ForeignKey('CustomUser', on_delete=models.CASCADE, related_name='carts')
+    # No user for a visitor's cart; store/carts.py keeps it in their session
+    user = models.ForeignKey('CustomUser', on_delete=models.CASCADE, related_name='carts', blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     razorpay_order_id = models.CharField(max_length=100, blank=True, null=True)
     razorpay_payment_id = models.CharField(max_length=100, blank=True, null=True)
     razorpay_payment_signature = models.CharField(max_length=100, blank=True, null=True)
+    # What razorpay_order_id was created for: a fingerprint of the lines and the amount charged
+    razorpay_order_key = models.CharField(max_length=64, blank=True, default='')
+    razorpay_order_amount = models.PositiveIntegerField(blank=True, null=True)
     is_paid = models.BooleanField(default=False)
+    # Bumped on every change to the lines (store/carts.py changing())
+    version = models.PositiveIntegerField(default=0)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user'], condition=Q(is_paid=False), name='cart_one_active_per_user'),
+        ]
 
     def __str__(self) -> str:
-        return f"Cart #{self.id} for {self.user.username}"
+        owner = self.user.username if self.user_id else 'a guest'
+        return f"Cart #{self.id} for {owner}"
 
 
 class CartItem(models.Model):
@@ -154,6 +289,17 @@ class CartItem(models.Model):
     quantity = models.PositiveIntegerField(default=1)
     unit_price = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True)
 
+    class Meta:
+        # One line per product and per combo; adding again raises the quantity
+        constraints = [
+            models.UniqueConstraint(
+                fields=['cart', 'product'], condition=Q(product__isnull=False), name='cartitem_unique_product',
+            ),
+            models.UniqueConstraint(
+                fields=['cart', 'combo_deal'], condition=Q(combo_deal__isnull=False), name='cartitem_unique_combo',
+            ),
+        ]
+
     def line_total(self):
         if self.combo_deal:
             return self.combo_deal.discounted_price * self.quantity
@@ -180,6 +326,8 @@ class CartItem(models.Model):
 class Order(models.Model):
     STATUS_CHOICES = [
         ('processing', 'Processing'),
+        # Paid for, but stock ran out before it was placed: restock or refund
+        ('backordered', 'Backordered'),
         ('shipped', 'Shipped'),
         ('delivered', 'Delivered'),
         ('cancelled', 'Cancelled'),
@@ -193,6 +341,7 @@ class Order(models.Model):
     PAYMENT_STATUS = [
         ('pending', 'Pending'),
         ('paid', 'Paid'),
+        ('failed', 'Failed'),
     ]
 
     user = models.ForeignKey('CustomUser', on_delete=models.CASCADE, related_name='orders')
@@ -202,6 +351,7 @@ class Order(models.Model):
     address = models.TextField()
     zipcode = models.CharField(max_length=20)
     city = models.CharField(max_length=100)
+    subtotal = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     paid_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     shipping_charge = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     payment_method = models.CharField(
@@ -220,6 +370,22 @@ class Order(models.Model):
     razorpay_payment_id = models.CharField(max_length=100, blank=True, null=True)
     razorpay_payment_status = models.CharField(max_length=50, blank=True, null=True)
 
+    class Meta:
+        # Backing the admin's date drill-down and its status/payment filters
+        indexes = [
+            models.Index(fields=['created_at'], name='order_created_idx'),
+            models.Index(fields=['status', 'created_at'], name='order_status_created_idx'),
+            models.Index(fields=['payment_method', 'created_at'], name='order_method_created_idx'),
+        ]
+        constraints = [
+            # One order per Razorpay order, however the browser callback and the
+            # webhook race; it also indexes the lookups both make
+            models.UniqueConstraint(
+                fields=['razorpay_order_id'], condition=models.Q(razorpay_order_id__isnull=False),
+                name='order_razorpay_order_unique',
+            ),
+        ]
+
     def __str__(self):
         return f"Order #{self.id} - {self.user.username}"
 
@@ -326,4 +492,160 @@ class CancellationRequest(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
-        return f"Cancellation for Order #{self.order.id}"
\ No newline at end of file
+        return f"Cancellation for Order #{self.order.id}"
+
+
+class StagedUpload(models.Model):
+    """An uploaded file waiting for the task worker to move it into storage (store/uploads.py)."""
+    # app_label.model_name of the row the file belongs to
+    model = models.CharField(max_length=100)
+    object_id = models.PositiveBigIntegerField()
+    field = models.CharField(max_length=50)
+    name = models.CharField(max_length=255)
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.name} for {self.model} #{self.object_id}"
+
+
+class PaymentEvent(models.Model):
+    """A Razorpay webhook delivery, stored as received and processed later."""
+    event_id = models.CharField(max_length=100, unique=True)
+    event = models.CharField(max_length=50)
+    payload = models.JSONField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+    # Set once it has failed PAYMENT_EVENT_MAX_ATTEMPTS times; left for staff
+    failed_at = models.DateTimeField(blank=True, null=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['processed_at', 'id'], name='paymentevent_pending_idx')]
+
+    def __str__(self):
+        return f"{self.event} ({self.event_id})"
+
+
+class Task(models.Model):
+    """A queued call to a function registered with store.tasks.task."""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    DEAD = 'dead'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (DEAD, 'Dead'),
+    ]
+
+    name = models.CharField(max_length=200)
+    kwargs = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    run_at = models.DateTimeField()
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'run_at', 'id'], name='task_due_idx')]
+
+    def __str__(self):
+        return f"{self.name} #{self.id} ({self.status})"
+
+
+class TrainingState(models.Model):
+    """How far an incrementally trained model has read, by the last order id it took in."""
+    name = models.CharField(max_length=50, unique=True)
+    high_water_mark = models.PositiveBigIntegerField(default=0)
+    trained_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"{self.name} up to order #{self.high_water_mark}"
+
+
+class CoPurchase(models.Model):
+    """
+    How many orders held both products: one cell of the co-purchase matrix
+    (store/recommend.py). Only product <= other is stored, and
+    product == other counts the orders that held the product.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    other = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    orders = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['product', 'other'], name='copurchase_pair_unique')]
+
+
+class ProductRecommendation(models.Model):
+    """One of a product's precomputed "frequently bought together" neighbours, best at rank 0."""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='recommendations')
+    recommended = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='recommended_in')
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['product', 'rank'], name='recommendation_rank_unique')]
+
+    def __str__(self):
+        return f"{self.product} → {self.recommended} (#{self.rank})"
+
+
+class UserRecommendation(models.Model):
+    """One product of a customer's precomputed "recommended for you" list, best at rank 0."""
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='recommendations')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='recommended_to')
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['user', 'rank'], name='userrecommendation_rank_unique')]
+
+    def __str__(self):
+        return f"{self.user} → {self.product} (#{self.rank})"
+
+
+class ModerationModel(models.Model):
+    """A trained review classifier (store/moderation.py); the active one scores new reviews."""
+    version = models.CharField(max_length=40, unique=True)
+    weights = models.BinaryField()
+    examples = models.PositiveIntegerField(default=0)
+    metrics = models.JSONField(default=dict, blank=True)
+    is_active = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['is_active'], condition=Q(is_active=True), name='moderationmodel_one_active'),
+        ]
+
+    def __str__(self):
+        return f"Review classifier {self.version}{' (active)' if self.is_active else ''}"
+
+
+class StockForecast(models.Model):
+    """A product's forecast demand and when its stock runs out, from `manage.py forecast_demand` (store/forecast.py)."""
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, related_name='forecast')
+    # Units a day, by exponential smoothing of recent daily sales
+    daily_demand = models.FloatField(default=0)
+    # Null when nothing is selling
+    days_until_stockout = models.FloatField(blank=True, null=True)
+    stockout_on = models.DateField(blank=True, null=True)
+    # Stock when the forecast was made
+    stock = models.PositiveIntegerField(default=0)
+    computed_at = models.DateTimeField()
+    # When staff were last emailed about it; cleared once it is out of danger
+    alerted_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['days_until_stockout'], name='forecast_stockout_idx')]
+
+    def __str__(self):
+        return f"{self.product}: {self.daily_demand:.1f}/day"
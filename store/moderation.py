@@ -0,0 +1,325 @@
+# store/moderation.py
+"""
+Review moderation with a text classifier.
+
+Two logistic regressions over the same features score each review:
+- sentiment: how positive the text reads, from 0 to 1
+- spam: how likely it is spam or abuse, from 0 to 1
+
+Features are word unigrams and bigrams plus a few cues: links, phone
+numbers, shouting, repeated characters, and very short or very long text.
+They are hashed into a fixed number of columns and L2 normalized.
+
+`manage.py train_review_classifier` trains offline with L-BFGS. Sentiment
+learns from star ratings, with 4-5 as positive and 1-2 as negative. Spam
+learns from staff verdicts: reviews marked as spam are positive, and
+approved reviews not marked as spam are negative. A CSV of extra labelled
+examples can be added. Each run is saved as a ModerationModel row and
+becomes the active one.
+
+Scoring never happens in the request. Saving a new review queues the
+score_reviews task (store/tasks.py), which scores unscored reviews in
+batches with the active model. It stores the scores and the model
+version on each review and then:
+- approves a review whose spam score is below REVIEW_APPROVE_BELOW_SPAM
+- holds back and flags for staff one whose spam score is above
+  REVIEW_FLAG_ABOVE_SPAM, or whose text reads far from its star rating
+- leaves the rest as they were, which under review moderation means
+  waiting for staff as before
+
+With no trained model nothing is scored and moderation works as it did.
+Reviews written before the classifier were marked scored as 'legacy' by
+migration 0050, so it never second-guesses what staff already decided.
+"""
+import hashlib
+import io
+import re
+import threading
+import zlib
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from scipy import optimize, sparse
+
+from .models import ModerationModel, Review
+
+DEFAULTS = {
+    'REVIEW_APPROVE_BELOW_SPAM': 0.1,
+    'REVIEW_FLAG_ABOVE_SPAM': 0.5,
+    'REVIEW_FLAG_RATING_MISMATCH': 0.6,
+}
+
+COLUMNS = 1 << 18
+BATCH_SIZE = 500
+L2 = 1e-4
+
+URL_RE = re.compile(r'https?://|www\.|\.(com|in|net|org)\b', re.I)
+# Ten digits or more, with at most a space or dash between any two
+PHONE_RE = re.compile(r'\d(?:[\s-]?\d){9,}')
+# A batch is scanned as one string with a NUL after each text, which
+# neither pattern above can match across; the NULs come back as tokens
+END = '\x00'
+BATCH_TOKEN_RE = re.compile(r'\w+|\x00')
+LETTER_RE = re.compile(r'[^\W\d_]')
+UPPER_RE = re.compile(r'[A-Z]')
+
+_columns = {}
+
+
+def _setting(name):
+    return getattr(settings, name, DEFAULTS[name])
+
+
+def _column(term):
+    value = _columns.get(term)
+    if value is None:
+        value = _columns[term] = zlib.crc32(term.encode()) & (COLUMNS - 1)
+    return value
+
+
+def _texts_matching(pattern, text, ends):
+    """Indexes of the texts whose span of `text` (ending at `ends`) `pattern` matches."""
+    starts = np.fromiter((match.start() for match in pattern.finditer(text)), dtype=np.int64)
+    return np.unique(np.searchsorted(ends, starts))
+
+
+def features(texts):
+    """
+    Hashed, L2-normalized binary features of `texts`, one row each, plus a bias column.
+
+    The features of a text are its lowercased words and word pairs, plus
+    cue terms for links, phone numbers, repeated characters, shouting
+    (mostly capitals among 8+ letters) and length. The whole batch is
+    built at once: one regex pass over the joined texts, a hash per
+    distinct word and word pair, and numpy for the rest.
+    """
+    n = len(texts)
+    if not n:
+        return sparse.csr_matrix((0, COLUMNS + 1), dtype=np.float32)
+    joined = END.join((text or '').replace(END, ' ') for text in texts) + END
+    tokens = BATCH_TOKEN_RE.findall(joined)
+
+    # Number each distinct token; only those are lowercased, measured and hashed
+    vocabulary = {}
+    ids = np.array([vocabulary.setdefault(token, len(vocabulary)) for token in tokens], dtype=np.int64)
+    words = list(vocabulary)
+    is_end = ids == vocabulary[END]
+    row = np.cumsum(is_end) - is_end
+    ids, row = ids[~is_end], row[~is_end]
+    lowered = [word.lower() for word in words]
+    word_columns = np.array([_column(word) for word in lowered], dtype=np.int64)
+    letters = np.array([len(LETTER_RE.findall(word)) for word in words], dtype=np.int64)
+    capitals = np.array([len(UPPER_RE.findall(word)) for word in words], dtype=np.int64)
+
+    # Word pairs within a text, each distinct pair hashed once
+    follows = np.flatnonzero(row[1:] == row[:-1])
+    pairs, pair_ids = np.unique(ids[follows] * len(words) + ids[follows + 1], return_inverse=True)
+    pair_columns = np.array(
+        [_column(f'{lowered[pair // len(words)]} {lowered[pair % len(words)]}') for pair in pairs.tolist()],
+        dtype=np.int64,
+    )
+
+    length = np.bincount(row, minlength=n)
+    letter_count = np.bincount(row, weights=letters[ids], minlength=n)
+    capital_count = np.bincount(row, weights=capitals[ids], minlength=n)
+    chars = np.frombuffer(joined.encode('utf-32-le'), dtype=np.uint32)
+    ends = np.flatnonzero(chars == 0)
+    # The same character four times running, newlines aside: (.)\1{3,}
+    same = chars[1:] == chars[:-1]
+    repeats = np.flatnonzero(same[:-2] & same[1:-1] & same[2:] & (chars[:-3] != 0) & (chars[:-3] != 10))
+    cue_rows = [
+        _texts_matching(URL_RE, joined, ends),
+        _texts_matching(PHONE_RE, joined, ends),
+        np.unique(np.searchsorted(ends, repeats)),
+        np.flatnonzero((letter_count >= 8) & (capital_count > 0.6 * letter_count)),
+    ]
+    cue_columns = [_column(term) for term in ('__link__', '__phone__', '__repeat__', '__shouting__')]
+    size_columns = np.array([_column(term) for term in ('__short__', '__medium__', '__long__')], dtype=np.int64)
+
+    # Every text also has one size term and the bias column
+    rows = np.concatenate([row, row[follows], *cue_rows, np.arange(n), np.arange(n)])
+    columns = np.concatenate([
+        word_columns[ids],
+        pair_columns[pair_ids.ravel()],
+        *[np.full(len(hit), column, dtype=np.int64) for hit, column in zip(cue_rows, cue_columns)],
+        size_columns[(length >= 4).astype(np.int64) + (length > 150)],
+        np.full(n, COLUMNS, dtype=np.int64),
+    ])
+    # Each text's distinct columns in order, weighted by 1/sqrt(how many it has) but the bias
+    cells = np.sort(rows * (COLUMNS + 1) + columns)
+    cells = cells[np.concatenate([[True], cells[1:] != cells[:-1]])]
+    rows, columns = np.divmod(cells, COLUMNS + 1)
+    per_row = np.bincount(rows, minlength=n)
+    data = np.where(columns == COLUMNS, 1.0, 1 / np.sqrt(per_row - 1)[rows]).astype(np.float32)
+    return sparse.csr_matrix(
+        (data, columns, np.concatenate([[0], np.cumsum(per_row)])), shape=(n, COLUMNS + 1),
+    )
+
+
+def _sigmoid(z):
+    return 1 / (1 + np.exp(-np.clip(z, -30, 30)))
+
+
+def fit_logistic(x, y, l2=L2):
+    """Weights of an L2-regularized logistic regression of labels `y` (0/1) on features `x`."""
+    n = x.shape[0]
+    y = np.asarray(y, dtype=np.float64)
+
+    def loss(w):
+        z = x @ w
+        p = _sigmoid(z)
+        eps = 1e-12
+        value = -np.mean(y * np.log(p + eps) + (1 - y) * np.log(1 - p + eps)) + l2 / 2 * w[:-1] @ w[:-1]
+        grad = x.T @ (p - y) / n
+        grad[:-1] += l2 * w[:-1]
+        return value, grad
+
+    result = optimize.minimize(loss, np.zeros(x.shape[1]), jac=True, method='L-BFGS-B', options={'maxiter': 200})
+    return result.x.astype(np.float32)
+
+
+class ReviewClassifier:
+    def __init__(self, sentiment, spam):
+        self.sentiment = sentiment
+        self.spam = spam
+        self.version = hashlib.sha1(sentiment.tobytes() + spam.tobytes()).hexdigest()[:12]
+
+    @classmethod
+    def train(cls, texts, sentiment_labels, spam_labels):
+        """Fit both heads; a label of None leaves that example out of that head."""
+        x = features(texts)
+        heads = []
+        for labels in (sentiment_labels, spam_labels):
+            known = np.array([label is not None for label in labels])
+            y = np.array([label or 0 for label in labels], dtype=np.float64)[known]
+            if len(set(y.tolist())) < 2:
+                raise ValueError('Each classifier needs labelled examples of both kinds')
+            heads.append(fit_logistic(x[known], y))
+        return cls(*heads)
+
+    def score(self, texts):
+        """(sentiment, spam) probabilities for `texts`, as two arrays."""
+        x = features(texts)
+        return _sigmoid(x @ self.sentiment), _sigmoid(x @ self.spam)
+
+    def dumps(self):
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, sentiment=self.sentiment, spam=self.spam)
+        return buffer.getvalue()
+
+    @classmethod
+    def loads(cls, data):
+        arrays = np.load(io.BytesIO(bytes(data)))
+        return cls(arrays['sentiment'], arrays['spam'])
+
+
+def training_examples():
+    """(texts, sentiment labels, spam labels) from the reviews in the database."""
+    texts, sentiment, spam = [], [], []
+    for comment, rating, approved, is_spam in Review.objects.values_list('comment', 'rating', 'is_approved', 'is_spam'):
+        texts.append(comment)
+        sentiment.append(1 if rating >= 4 else 0 if rating <= 2 else None)
+        spam.append(1 if is_spam else 0 if approved else None)
+    return texts, sentiment, spam
+
+
+def accuracy(classifier, texts, sentiment_labels, spam_labels):
+    """The share of labelled examples each head gets right, by name."""
+    scores = dict(zip(('sentiment', 'spam'), classifier.score(texts)))
+    result = {}
+    for name, labels in (('sentiment', sentiment_labels), ('spam', spam_labels)):
+        pairs = [(score > 0.5, bool(label)) for score, label in zip(scores[name].tolist(), labels) if label is not None]
+        result[name] = sum(a == b for a, b in pairs) / len(pairs) if pairs else 0.0
+    return result
+
+
+def save_classifier(classifier, examples, metrics=None):
+    """Store `classifier` and make it the active one."""
+    with transaction.atomic():
+        ModerationModel.objects.filter(is_active=True).update(is_active=False)
+        model, _ = ModerationModel.objects.update_or_create(
+            version=classifier.version,
+            defaults={'weights': classifier.dumps(), 'examples': examples, 'metrics': metrics or {}, 'is_active': True},
+        )
+    return model
+
+
+_lock = threading.Lock()
+_current = None
+
+
+def get_classifier():
+    """The active classifier, loaded once per version; None if none is trained."""
+    global _current
+    version = ModerationModel.objects.filter(is_active=True).values_list('version', flat=True).first()
+    if version is None:
+        return None
+    current = _current
+    if current is None or current.version != version:
+        with _lock:
+            current = _current
+            if current is None or current.version != version:
+                weights = ModerationModel.objects.values_list('weights', flat=True).get(version=version)
+                current = _current = ReviewClassifier.loads(weights)
+    return current
+
+
+def verdict(rating, sentiment, spam):
+    """True to approve, False to hold back for staff, None to leave as is."""
+    if spam > _setting('REVIEW_FLAG_ABOVE_SPAM'):
+        return False
+    # Five stars on a scathing text, or one star on a glowing one
+    if abs(sentiment - (rating - 1) / 4) > _setting('REVIEW_FLAG_RATING_MISMATCH'):
+        return False
+    if spam < _setting('REVIEW_APPROVE_BELOW_SPAM'):
+        return True
+    return None
+
+
+def score_pending(limit=BATCH_SIZE):
+    """Score up to `limit` unscored reviews and act on them. Returns how many were scored."""
+    classifier = get_classifier()
+    if classifier is None:
+        return 0
+    reviews = list(
+        Review.objects.filter(scored_at__isnull=True).order_by('id')
+        .only('id', 'product_id', 'rating', 'comment', 'is_approved', 'flagged')[:limit]
+    )
+    if not reviews:
+        return 0
+    sentiment, spam = classifier.score([review.comment for review in reviews])
+    now = timezone.now()
+    decided = []
+    for review, positive, junk in zip(reviews, sentiment.tolist(), spam.tolist()):
+        review.sentiment_score = positive
+        review.spam_score = junk
+        review.model_version = classifier.version
+        review.scored_at = now
+        approve = verdict(review.rating, positive, junk)
+        if approve is not None and approve != review.is_approved:
+            review.is_approved = approve
+            review.flagged = not approve
+            decided.append(review)
+        elif approve is False:
+            review.flagged = True
+    with transaction.atomic():
+        Review.objects.bulk_update(
+            reviews, ['sentiment_score', 'spam_score', 'model_version', 'scored_at', 'flagged'], batch_size=BATCH_SIZE,
+        )
+        # Approval goes through save() so the rating counters and catalog version follow
+        for review in decided:
+            review.save(update_fields=['is_approved'])
+    return len(reviews)
+
+
+#Queue scoring for new reviews, once however many arrive before a worker runs
+@receiver(post_save, sender=Review)
+def queue_review_scoring(sender, instance, created, **kwargs):
+    from .tasks import score_reviews
+
+    if created:
+        score_reviews.delay_once()
@@ -0,0 +1,99 @@
+# store/navigation.py
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import SiteSettings, Offer, Category, Product
+from .versions import bump_version, get_version
+
+NAVIGATION = 'navigation'
+MENU_CATEGORIES = {
+    'nav_face_products': 'skin-care',
+    'nav_hair_products': 'hair-care',
+    'nav_body_products': 'body-care',
+}
+
+
+def _menu_products(slug):
+    return lambda: list(Product.objects.filter(category__slug__iexact=slug)[:8])
+
+
+# Each part of the header/footer/mega-menu payload and how to query it. Parts
+# are built and cached independently so a page only pays for what it shows.
+BUILDERS = {
+    'site_settings': lambda: SiteSettings.objects.first(),
+    'header_offers': lambda: list(Offer.objects.filter(is_active=True)[:3]),
+    'nav_categories': lambda: list(Category.objects.all()),
+    **{key: _menu_products(slug) for key, slug in MENU_CATEGORIES.items()},
+}
+EMPTY = {'site_settings': None}
+
+
+def build_navigation_part(key):
+    try:
+        return BUILDERS[key]()
+    except Exception:
+        return EMPTY.get(key, [])
+
+
+# (navigation version, {key: part}): the parts this process already has
+_parts = (None, {})
+
+
+def get_navigation_part(key):
+    """One navigation value, from this process or the versioned cache when possible."""
+    # Saving any model the payload is built from bumps the version, so the
+    # TTL only bounds staleness across processes that do not share a cache
+    # backend. NAVIGATION_CACHE_TTL = 0 turns caching off.
+    global _parts
+    ttl = getattr(settings, 'NAVIGATION_CACHE_TTL', 300)
+    if not ttl:
+        return build_navigation_part(key)
+    version = get_version(NAVIGATION)
+    if _parts[0] != version:
+        _parts = (version, {})
+    parts = _parts[1]
+    if key not in parts:
+        cache_key = f'store:navigation:{version}:{key}'
+        # Wrapped in a tuple so a cached None (no SiteSettings row) is still a hit
+        cached = cache.get(cache_key)
+        if cached is None:
+            cached = (build_navigation_part(key),)
+            cache.set(cache_key, cached, ttl)
+        parts[key] = cached[0]
+    return parts[key]
+
+
+def get_request_navigation_part(request, key):
+    """get_navigation_part() memoized on the request for the rest of the render."""
+    parts = request.__dict__.setdefault('_store_navigation', {})
+    if key not in parts:
+        parts[key] = get_navigation_part(key)
+    return parts[key]
+
+
+def get_site_settings(request=None):
+    if request is not None:
+        return get_request_navigation_part(request, 'site_settings')
+    return get_navigation_part('site_settings')
+
+
+def invalidate_navigation():
+    from .tasks import warm_navigation_cache
+
+    bump_version(NAVIGATION)
+    # Rebuild the parts in the worker so the next page view finds them cached
+    warm_navigation_cache.delay_once()
+
+
+@receiver(post_save, sender=SiteSettings)
+@receiver(post_save, sender=Offer)
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=SiteSettings)
+@receiver(post_delete, sender=Offer)
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=Product)
+def navigation_changed(sender, **kwargs):
+    invalidate_navigation()
@@ -0,0 +1,52 @@
+# store/orders.py
+from django.db import transaction
+
+from .inventory import OutOfStock, reserve_stock, stock_requirements
+from .models import CartItem, Order, OrderItem
+from .tasks import send_backorder_alert, send_order_confirmation
+
+
+def order_item_for(line):
+    """An unsaved OrderItem for one cart line, priced the way the cart shows it."""
+    if line.combo_deal_id:
+        return OrderItem(combo_deal=line.combo_deal, price=line.combo_deal.discounted_price, quantity=line.quantity)
+    price = line.unit_price if line.unit_price is not None else line.product.get_display_price()
+    return OrderItem(product=line.product, price=price, quantity=line.quantity)
+
+
+def place_order(user, items, backorder=False, **fields):
+    """
+    Turn cart `items` into an Order for `user`, with `fields` set on it.
+
+    Stock for every line (combos included) is reserved, the order and all
+    its items are written and the ordered lines are removed from the cart,
+    all in one transaction, which also queues the confirmation email. The
+    query count is the same for any cart size.
+    Raises OutOfStock, having written nothing, if a product runs short.
+
+    Pass `backorder=True` for a payment already captured: a shortage then
+    still places the order, without taking any stock, as 'backordered',
+    and queues an email asking staff to restock or refund it.
+
+    `items` should come with select_related('product', 'combo_deal').
+    """
+    items = list(items)
+    with transaction.atomic():
+        shortage = None
+        try:
+            reserve_stock(stock_requirements(items))
+        except OutOfStock as e:
+            if not backorder:
+                raise
+            shortage = e
+            fields['status'] = 'backordered'
+        order = Order.objects.create(user=user, **fields)
+        order_items = [order_item_for(line) for line in items]
+        for order_item in order_items:
+            order_item.order = order
+        OrderItem.objects.bulk_create(order_items)
+        CartItem.objects.filter(pk__in=[line.pk for line in items]).delete()
+        send_order_confirmation.delay(order_id=order.pk)
+        if shortage:
+            send_backorder_alert.delay(order_id=order.pk, shortage=str(shortage))
+    return order
@@ -0,0 +1,84 @@
+# store/pagination.py
+"""
+Keyset (cursor) pagination. Instead of OFFSET, each page continues from the
+sort key of the previous page's last row, so deep pages cost the same as
+the first one and rows inserted meanwhile never shift or duplicate results.
+"""
+import base64
+import json
+from collections import namedtuple
+from functools import reduce
+from operator import or_
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+KeysetPage = namedtuple('KeysetPage', ['items', 'next_cursor'])
+
+
+def encode_cursor(values):
+    raw = json.dumps([str(value) for value in values]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, length):
+    """The key values in a cursor, or None if it is missing or malformed."""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list) or len(values) != length:
+        return None
+    return values
+
+
+def after_key(ordering, values):
+    """
+    Rows strictly after `values` in `ordering`, a list of (field, descending)
+    pairs ending in a unique field: (a > x) OR (a = x AND b > y) OR ...
+    """
+    branches = []
+    for i, (field, descending) in enumerate(ordering):
+        equal = {f: v for (f, _), v in zip(ordering[:i], values)}
+        lookup = f"{field}__{'lt' if descending else 'gt'}"
+        branches.append(Q(**equal, **{lookup: values[i]}))
+    return reduce(or_, branches)
+
+
+def cursor_values(model, ordering, values):
+    """
+    The cursor's `values` as the ordering fields' Python values, or None if
+    any is not a valid value of its field (a tampered cursor).
+    """
+    cleaned = []
+    for (name, _), value in zip(ordering, values):
+        field = model._meta.get_field(name)
+        # A generated column holds values of its output field
+        field = getattr(field, 'output_field', field)
+        try:
+            cleaned.append(field.clean(value, None))
+        except (ValidationError, ValueError, TypeError):
+            return None
+    return cleaned
+
+
+def keyset_page(queryset, ordering, cursor=None, size=24):
+    """
+    One page of `queryset` in `ordering`, plus the cursor for the next one.
+    A missing, malformed or tampered cursor gives the first page.
+    """
+    queryset = queryset.order_by(*[f"-{f}" if desc else f for f, desc in ordering])
+    values = decode_cursor(cursor, len(ordering))
+    if values is not None:
+        values = cursor_values(queryset.model, ordering, values)
+    if values is not None:
+        queryset = queryset.filter(after_key(ordering, values))
+    items = list(queryset[:size + 1])
+    next_cursor = None
+    if len(items) > size:
+        items = items[:size]
+        next_cursor = encode_cursor([getattr(items[-1], field) for field, _ in ordering])
+    return KeysetPage(items, next_cursor)
@@ -0,0 +1,235 @@
+# store/payments.py
+"""
+Razorpay gateway adapter.
+
+Each process keeps one gateway whose razorpay.Client shares a pooled
+keep-alive requests.Session, so checkouts reuse open TLS connections
+instead of handshaking on every call. Every request has connect and read
+timeouts. Idempotent calls (fetches) are retried with jittered
+exponential backoff. Creating an order is retried only when the
+connection was never made, because then the request cannot have reached
+Razorpay.
+
+A circuit breaker counts consecutive transport and server failures. Once
+there are RAZORPAY_BREAKER_THRESHOLD of them in a row, calls fail
+immediately with GatewayUnavailable for RAZORPAY_BREAKER_RESET seconds.
+After that one trial call is let through. If it succeeds the breaker
+closes, otherwise it opens again.
+
+Signature checks are local HMACs and never touch the network or the
+breaker.
+
+gateway_order_for() keeps one Razorpay order per cart. It is reused for
+as long as the cart's lines and the amount charged stay the same, so
+reloading checkout does not call Razorpay at all.
+"""
+import hashlib
+import random
+import threading
+import time
+
+import razorpay
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from .models import Cart
+
+DEFAULTS = {
+    'RAZORPAY_BASE_URL': 'https://api.razorpay.com',
+    'RAZORPAY_CONNECT_TIMEOUT': 3.05,
+    'RAZORPAY_READ_TIMEOUT': 10,
+    'RAZORPAY_MAX_RETRIES': 2,
+    'RAZORPAY_POOL_SIZE': 10,
+    'RAZORPAY_BREAKER_THRESHOLD': 5,
+    'RAZORPAY_BREAKER_RESET': 30,
+}
+
+
+def _setting(name):
+    return getattr(settings, name, DEFAULTS[name])
+
+
+class GatewayUnavailable(Exception):
+    """Razorpay is unreachable or failing; checkout should not wait on it."""
+
+
+class TimeoutSession(requests.Session):
+    """A Session that applies a default (connect, read) timeout to every request."""
+
+    def __init__(self, timeout, pool_size):
+        super().__init__()
+        self.timeout = timeout
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+class CircuitBreaker:
+    def __init__(self, threshold, reset_after, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self.clock() - self.opened_at >= self.reset_after:
+            return 'half-open'
+        return 'open'
+
+    def before_call(self):
+        with self.lock:
+            state = self.state
+            if state == 'open' or (state == 'half-open' and self.trial_running):
+                raise GatewayUnavailable('Payment gateway is temporarily unavailable')
+            if state == 'half-open':
+                self.trial_running = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.threshold:
+                self.opened_at = self.clock()
+            self.trial_running = False
+
+
+# Failures that say nothing about the request itself, only about the gateway
+GATEWAY_FAILURES = (requests.RequestException, razorpay.errors.ServerError, razorpay.errors.GatewayError)
+
+
+class PaymentGateway:
+    def __init__(self, key_id, key_secret, base_url, connect_timeout, read_timeout,
+                 max_retries=2, pool_size=10, breaker=None, sleep=time.sleep):
+        self.session = TimeoutSession((connect_timeout, read_timeout), pool_size)
+        self.client = razorpay.Client(session=self.session, auth=(key_id, key_secret), base_url=base_url)
+        self.max_retries = max_retries
+        self.breaker = breaker or CircuitBreaker(threshold=5, reset_after=30)
+        self.sleep = sleep
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            settings.RP_KEY_ID, settings.RP_KEY_SECRET,
+            base_url=_setting('RAZORPAY_BASE_URL'),
+            connect_timeout=_setting('RAZORPAY_CONNECT_TIMEOUT'),
+            read_timeout=_setting('RAZORPAY_READ_TIMEOUT'),
+            max_retries=_setting('RAZORPAY_MAX_RETRIES'),
+            pool_size=_setting('RAZORPAY_POOL_SIZE'),
+            breaker=CircuitBreaker(_setting('RAZORPAY_BREAKER_THRESHOLD'), _setting('RAZORPAY_BREAKER_RESET')),
+        )
+
+    def _backoff(self, attempt):
+        # Full jitter: anywhere between 0 and 0.2s, 0.4s, 0.8s, ...
+        return random.uniform(0, 0.2 * 2 ** attempt)
+
+    def _call(self, func, *args, idempotent):
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            try:
+                result = func(*args)
+            except razorpay.errors.BadRequestError:
+                # Razorpay answered; the request was at fault, not the gateway
+                self.breaker.record_success()
+                raise
+            except GATEWAY_FAILURES as e:
+                self.breaker.record_failure()
+                retryable = idempotent or isinstance(e, requests.ConnectTimeout)
+                if not retryable or attempt >= self.max_retries or self.breaker.state == 'open':
+                    raise GatewayUnavailable(f'Payment gateway error: {e}') from e
+                self.sleep(self._backoff(attempt))
+                attempt += 1
+            else:
+                self.breaker.record_success()
+                return result
+
+    def create_order(self, amount, currency='INR', **extra):
+        """A Razorpay order for `amount` paise."""
+        data = {'amount': amount, 'currency': currency, 'payment_capture': 1, **extra}
+        return self._call(self.client.order.create, data, idempotent=False)
+
+    def fetch_order(self, order_id):
+        return self._call(self.client.order.fetch, order_id, idempotent=True)
+
+    def fetch_payment(self, payment_id):
+        return self._call(self.client.payment.fetch, payment_id, idempotent=True)
+
+    def verify_payment_signature(self, order_id, payment_id, signature):
+        """Raises razorpay.errors.SignatureVerificationError on a mismatch."""
+        return self.client.utility.verify_payment_signature({
+            'razorpay_order_id': order_id,
+            'razorpay_payment_id': payment_id,
+            'razorpay_signature': signature,
+        })
+
+
+def order_fingerprint(items, amount):
+    """A digest of cart `items` and the `amount` in paise charged for them."""
+    lines = sorted(
+        (item.product_id or 0, item.combo_deal_id or 0, item.quantity, str(item.unit_price))
+        for item in items
+    )
+    return hashlib.sha256(repr((lines, amount)).encode()).hexdigest()
+
+
+def gateway_order_for(cart, items, amount):
+    """
+    The Razorpay order ({'id', 'amount', 'currency'}) to pay `amount` paise
+    for `cart`. The cart's current order is reused when it was created for
+    the same lines and amount; otherwise a new one is created and recorded.
+    Raises GatewayUnavailable if one is needed and Razorpay is down.
+    """
+    key = order_fingerprint(items, amount)
+    if cart.razorpay_order_id and cart.razorpay_order_key == key:
+        return {'id': cart.razorpay_order_id, 'amount': cart.razorpay_order_amount, 'currency': 'INR'}
+    order = get_gateway().create_order(amount)
+    cart.razorpay_order_id = order['id']
+    cart.razorpay_order_key = key
+    cart.razorpay_order_amount = amount
+    Cart.objects.filter(pk=cart.pk).update(
+        razorpay_order_id=order['id'], razorpay_order_key=key, razorpay_order_amount=amount,
+    )
+    return order
+
+
+def forget_gateway_order(cart):
+    """Stop reusing the cart's Razorpay order, e.g. once it has been paid."""
+    cart.razorpay_order_key = ''
+    Cart.objects.filter(pk=cart.pk).update(razorpay_order_key='')
+
+
+_lock = threading.Lock()
+_gateway = None
+
+
+def get_gateway():
+    """This process's shared gateway, created on first use."""
+    global _gateway
+    if _gateway is None:
+        with _lock:
+            if _gateway is None:
+                _gateway = PaymentGateway.from_settings()
+    return _gateway
+
+
+def reset_gateway():
+    """Drop the shared gateway, e.g. after its settings change."""
+    global _gateway
+    with _lock:
+        _gateway = None
@@ -0,0 +1,239 @@
+# store/personalize.py
+"""
+"Recommended for you": a per-user ranking of products.
+
+`manage.py build_user_recommendations`, run nightly, scores every product
+for every customer who has ordered or reviewed something. It blends five
+signals, each scaled to 0..1 per user, with WEIGHTS:
+
+- co_purchase: what is frequently bought with what they bought, taken
+  from the neighbour lists in store/recommend.py
+- concern: the concerns of products they reviewed, weighted by how they
+  rated them, so a concern they rated badly counts against
+- category: the categories they buy from and rate well
+- popularity: orders over the last BESTSELLER_DAYS, for everyone
+- repeat: products they have bought before, to buy again
+
+All of it is numpy over sparse user x product matrices, a chunk of users
+at a time. Each user's top PERSONAL_TOP_N are stored in
+UserRecommendation, replacing the previous night's lists in one
+transaction.
+
+The widgets read a user's list with one query, which also drops products
+that have since gone out of stock or been taken off sale. Anyone with no
+list gets the bestsellers, whose ids are cached for
+BESTSELLER_CACHE_TTL seconds.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Max
+from django.utils import timezone
+from scipy import sparse
+
+from .models import ComboDeal, Order, OrderItem, Product, ProductRecommendation, Review, TrainingState, UserRecommendation
+
+DEFAULTS = {
+    'PERSONAL_TOP_N': 20,
+    'BESTSELLER_DAYS': 90,
+    'BESTSELLER_CACHE_TTL': 3600,
+}
+
+WEIGHTS = {
+    'co_purchase': 0.35,
+    'concern': 0.2,
+    'category': 0.15,
+    'popularity': 0.2,
+    'repeat': 0.1,
+}
+
+STATE_NAME = 'personal_feed'
+BESTSELLERS_KEY = 'store:bestsellers'
+# What the product strip template shows
+STRIP_FIELDS = ['id', 'name', 'slug', 'image', 'price', 'sale_price']
+
+
+def _setting(name):
+    return getattr(settings, name, DEFAULTS[name])
+
+
+def in_stock(products):
+    return products.filter(is_available=True, stock__gt=0)
+
+
+def bestseller_ids(limit=None):
+    """Ids of the most ordered products lately, best first, cached."""
+    limit = limit or _setting('PERSONAL_TOP_N')
+    ids = cache.get(BESTSELLERS_KEY)
+    if ids is None:
+        since = timezone.now() - timedelta(days=_setting('BESTSELLER_DAYS'))
+        ids = list(
+            in_stock(Product.objects)
+            .filter(orderitem__order__created_at__gte=since)
+            .exclude(orderitem__order__status='cancelled')
+            .annotate(ordered=Count('orderitem__order', distinct=True))
+            .order_by('-ordered', 'id')
+            .values_list('id', flat=True)[:_setting('PERSONAL_TOP_N')]
+        )
+        cache.set(BESTSELLERS_KEY, ids, _setting('BESTSELLER_CACHE_TTL'))
+    return ids[:limit]
+
+
+def bestsellers(limit=8):
+    ids = bestseller_ids()
+    found = in_stock(Product.objects.filter(pk__in=ids)).only(*STRIP_FIELDS).in_bulk()
+    return [found[pk] for pk in ids if pk in found][:limit]
+
+
+def recommended_for(user, limit=8):
+    """Up to `limit` in-stock products for `user`, best first; bestsellers for anyone without a list."""
+    if user.is_authenticated:
+        products = list(
+            in_stock(Product.objects.filter(recommended_to__user=user))
+            .only(*STRIP_FIELDS)
+            .order_by('recommended_to__rank')[:limit]
+        )
+        if products:
+            return products
+    return bestsellers(limit)
+
+
+def _scaled(matrix):
+    """`matrix` (dense) with each row divided by its largest absolute value."""
+    peak = np.abs(matrix).max(axis=1, keepdims=True)
+    peak[peak == 0] = 1
+    return matrix / peak
+
+
+def _one_hot(values, width):
+    """A len(values) x width indicator matrix; -1 values get an empty row."""
+    rows = np.flatnonzero(values >= 0)
+    return sparse.csr_matrix((np.ones(len(rows)), (rows, values[rows])), shape=(len(values), width))
+
+
+class Signals:
+    """Everything the scores are made of, as user x product and product x feature matrices."""
+
+    def __init__(self):
+        products = list(Product.objects.order_by('id').values_list('id', 'category_id', 'concern', 'is_available', 'stock'))
+        self.product_ids = np.array([row[0] for row in products], dtype=np.int64)
+        column = {pk: i for i, pk in enumerate(self.product_ids.tolist())}
+        size = len(products)
+
+        categories = {pk: i for i, pk in enumerate(sorted({row[1] for row in products}))}
+        concerns = {key: i for i, (key, _) in enumerate(Product.CONCERN_CHOICES)}
+        self.categories = _one_hot(np.array([categories[row[1]] for row in products], dtype=np.int64), len(categories))
+        self.concerns = _one_hot(np.array([concerns.get(row[2], -1) for row in products], dtype=np.int64), len(concerns))
+        self.buyable = np.array([row[3] and row[4] > 0 for row in products], dtype=bool)
+
+        combos = defaultdict(list)
+        for combo_id, product_id in ComboDeal.products.through.objects.values_list('combodeal_id', 'product_id'):
+            combos[combo_id].append(product_id)
+        purchases = set()
+        lines = (
+            OrderItem.objects
+            .exclude(order__status='cancelled')
+            .exclude(order__payment_status='failed')
+            .values_list('order__user_id', 'order_id', 'product_id', 'combo_deal_id')
+        )
+        for user_id, order_id, product_id, combo_id in lines:
+            for member in ([product_id] if product_id else []) + combos.get(combo_id, []):
+                if member in column:
+                    purchases.add((user_id, order_id, column[member]))
+        reviews = [
+            (user_id, column[product_id], rating)
+            for user_id, product_id, rating in Review.objects.values_list('user_id', 'product_id', 'rating')
+            if product_id in column
+        ]
+
+        self.user_ids = np.array(sorted({row[0] for row in purchases} | {row[0] for row in reviews}), dtype=np.int64)
+        row = {pk: i for i, pk in enumerate(self.user_ids.tolist())}
+        shape = (len(self.user_ids), size)
+        # Orders each user placed holding each product
+        self.bought = sparse.csr_matrix(
+            (np.ones(len(purchases)), ([row[u] for u, _, _ in purchases], [p for _, _, p in purchases])), shape=shape,
+        )
+        # Ratings mapped from 1..5 onto -1..1
+        self.rated = sparse.csr_matrix(
+            ([(r - 3) / 2 for _, _, r in reviews], ([row[u] for u, _, _ in reviews], [p for _, p, _ in reviews])),
+            shape=shape,
+        )
+
+        neighbours = [
+            (column[a], column[b], score)
+            for a, b, score in ProductRecommendation.objects.values_list('product_id', 'recommended_id', 'score')
+            if a in column and b in column
+        ]
+        self.bought_with = sparse.csr_matrix(
+            ([s for _, _, s in neighbours], ([a for a, _, _ in neighbours], [b for _, b, _ in neighbours])),
+            shape=(size, size),
+        )
+
+        since = timezone.now() - timedelta(days=_setting('BESTSELLER_DAYS'))
+        recent = np.zeros(size)
+        for product_id, ordered in (
+            OrderItem.objects.filter(order__created_at__gte=since).exclude(order__status='cancelled')
+            .values_list('product_id').annotate(n=Count('order', distinct=True)).values_list('product_id', 'n')
+        ):
+            if product_id in column:
+                recent[column[product_id]] = ordered
+        self.popularity = np.log1p(recent) / max(np.log1p(recent).max(), 1)
+
+    def scores(self, rows):
+        """Blended scores of every product for users at `rows`: a dense len(rows) x products array."""
+        bought = self.bought[rows]
+        has_bought = (bought > 0).astype(np.float64)
+        liked = self.rated[rows].maximum(0)
+        # Interest in a category: buying from it, and rating its products well
+        interest = has_bought + liked
+
+        parts = {
+            'co_purchase': _scaled((has_bought @ self.bought_with).toarray()),
+            'concern': _scaled((self.rated[rows] @ self.concerns @ self.concerns.T).toarray()),
+            'category': _scaled((interest @ self.categories @ self.categories.T).toarray()),
+            'popularity': np.broadcast_to(self.popularity, (len(rows), len(self.product_ids))),
+            'repeat': _scaled(np.log1p(bought.toarray())),
+        }
+        return sum(WEIGHTS[name] * part for name, part in parts.items())
+
+
+def top_n(scores, buyable, n):
+    """(columns, scores) of the best n buyable products per row, best first."""
+    scores = np.where(buyable, scores, -np.inf)
+    n = min(n, int(buyable.sum()))
+    if n == 0:
+        return np.empty((len(scores), 0), dtype=np.int64), np.empty((len(scores), 0))
+    top = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+    best = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-best, axis=1, kind='stable')
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(best, order, axis=1)
+
+
+def build_user_recommendations(chunk_size=500):
+    """Recompute every user's list. Returns the number of users with a list."""
+    started = timezone.now()
+    last_order = Order.objects.aggregate(last=Max('id'))['last'] or 0
+    signals = Signals()
+    n = _setting('PERSONAL_TOP_N')
+    lists = []
+    for start in range(0, len(signals.user_ids), chunk_size):
+        rows = np.arange(start, min(start + chunk_size, len(signals.user_ids)))
+        columns, scores = top_n(signals.scores(rows), signals.buyable, n)
+        for user_id, products, values in zip(signals.user_ids[rows], columns, scores):
+            lists += [
+                UserRecommendation(user_id=int(user_id), product_id=int(signals.product_ids[p]), rank=rank, score=float(s))
+                for rank, (p, s) in enumerate(zip(products, values))
+                if s > 0
+            ]
+    with transaction.atomic():
+        UserRecommendation.objects.all().delete()
+        UserRecommendation.objects.bulk_create(lists, batch_size=1000)
+        TrainingState.objects.update_or_create(
+            name=STATE_NAME, defaults={'high_water_mark': last_order, 'trained_at': started},
+        )
+    cache.delete(BESTSELLERS_KEY)
+    return len(signals.user_ids)
@@ -0,0 +1,124 @@
+# store/pricing.py
+"""
+The one place an order's amounts are worked out.
+
+quote() prices cart lines once: subtotal, coupon discount, shipping and
+total. Checkout, the online payment callbacks and cash on delivery all
+charge from it and save its breakdown on the order, so the page, the
+gateway and the order agree.
+
+Coupons are matched on their code with case and surrounding spaces
+ignored. They come from an in-process book of active coupons keyed on
+that normalized code. The book is rebuilt from one query when the coupon
+version moves, which saving or deleting a Coupon does, so applying a
+coupon does not touch the database. It is also rebuilt once it is older
+than COUPON_BOOK_TTL seconds, so a version bump lost with the cache
+cannot keep a retired coupon alive. The valid_from/valid_to window is
+checked at lookup time.
+"""
+import threading
+import time
+from collections import namedtuple
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Coupon
+from .versions import COUPONS, get_version
+
+CENT = Decimal('0.01')
+ZERO = Decimal('0.00')
+
+CouponRule = namedtuple('CouponRule', ['code', 'percentage', 'valid_from', 'valid_to'])
+
+
+def normalize_code(code):
+    return (code or '').strip().upper()
+
+
+class CouponBook:
+    def __init__(self, coupons):
+        """`coupons` are CouponRules; on a normalized clash the first one wins."""
+        self.rules = {}
+        for rule in coupons:
+            self.rules.setdefault(normalize_code(rule.code), rule)
+
+    @classmethod
+    def build(cls):
+        return cls(
+            CouponRule(*row)
+            for row in Coupon.objects.filter(active=True).order_by('id')
+            .values_list('code', 'discount_percentage', 'valid_from', 'valid_to')
+        )
+
+    def find(self, code, now=None):
+        """The coupon `code` names if it is usable at `now`, else None."""
+        rule = self.rules.get(normalize_code(code))
+        if rule is None:
+            return None
+        now = now or timezone.now()
+        if rule.valid_from and rule.valid_from > now:
+            return None
+        if rule.valid_to and rule.valid_to < now:
+            return None
+        return rule
+
+
+_lock = threading.Lock()
+_current = None
+
+
+def _stale(current, version):
+    return current is None or current[0] != version or time.monotonic() - current[1] > settings.COUPON_BOOK_TTL
+
+
+def get_coupon_book():
+    """This process's coupon book, rebuilt first if the coupon version has moved or the book is too old."""
+    global _current
+    version = get_version(COUPONS)
+    current = _current
+    if _stale(current, version):
+        with _lock:
+            current = _current
+            if _stale(current, version):
+                current = _current = (version, time.monotonic(), CouponBook.build())
+    return current[2]
+
+
+def find_coupon(code, now=None):
+    return get_coupon_book().find(code, now) if code else None
+
+
+def shipping_for(payment_method):
+    return settings.COD_SHIPPING_CHARGE if payment_method == 'cod' else ZERO
+
+
+class Quote(namedtuple('Quote', ['subtotal', 'discount', 'shipping', 'total', 'coupon'])):
+    @property
+    def amount_in_paise(self):
+        return int(self.total * 100)
+
+    def order_fields(self):
+        """The amounts to save on the Order placed for this quote."""
+        return {
+            'subtotal': self.subtotal,
+            'discount_amount': self.discount,
+            'shipping_charge': self.shipping,
+            'paid_amount': self.total,
+            'coupon': self.coupon.code if self.coupon else None,
+        }
+
+
+def quote(items, coupon_code=None, payment_method='razorpay'):
+    """
+    Price cart `items` (with select_related('product', 'combo_deal')) paid
+    by `payment_method`, applying `coupon_code` if it names a usable coupon.
+    """
+    subtotal = sum((item.line_total() for item in items), ZERO)
+    coupon = find_coupon(coupon_code)
+    discount = ZERO
+    if coupon:
+        discount = min(subtotal * coupon.percentage / 100, subtotal).quantize(CENT, ROUND_HALF_UP)
+    shipping = shipping_for(payment_method)
+    return Quote(subtotal, discount, shipping, subtotal - discount + shipping, coupon)
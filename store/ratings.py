@@ -0,0 +1,128 @@
+# store/ratings.py
+from collections import defaultdict, namedtuple
+
+from django.db import transaction
+from django.db.models import Count, F, FloatField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, NullIf
+
+from .models import Product, Review, RATING_STARS
+
+COUNTER_FIELDS = ['rating_count', 'rating_sum'] + [f'rating_{star}' for star in RATING_STARS]
+
+ReviewStats = namedtuple('ReviewStats', ['total', 'average', 'distribution'])
+
+
+def _stats(total, rating_sum, distribution):
+    return ReviewStats(total, rating_sum / total if total else 0, distribution)
+
+
+def combine_review_stats(stats):
+    """Merge several ReviewStats (e.g. the products of a combo) into one."""
+    total = 0
+    rating_sum = 0
+    distribution = dict.fromkeys(RATING_STARS, 0)
+    for item in stats:
+        total += item.total
+        rating_sum += item.average * item.total
+        for star, count in item.distribution.items():
+            distribution[star] += count
+    return _stats(total, rating_sum, distribution)
+
+
+def product_review_stats(products, moderated=True):
+    """
+    Map product id -> ReviewStats for the given products.
+
+    With moderation on only approved reviews are visible, which is exactly
+    what the Product counters hold, so no query is needed. Otherwise every
+    review is visible and one grouped query covers all products at once.
+    """
+    products = list(products)
+    if moderated:
+        return {
+            p.pk: _stats(p.rating_count, p.rating_sum, p.rating_distribution)
+            for p in products
+        }
+
+    totals = {p.pk: [0, 0, dict.fromkeys(RATING_STARS, 0)] for p in products}
+    grouped = (
+        Review.objects.filter(product__in=list(totals))
+        .order_by()
+        .values_list('product_id', 'rating')
+        .annotate(n=Count('id'))
+    )
+    for product_id, rating, n in grouped:
+        row = totals[product_id]
+        row[0] += n
+        row[1] += rating * n
+        if rating in RATING_STARS:
+            row[2][rating] += n
+    return {pk: _stats(*row) for pk, row in totals.items()}
+
+
+def review_stats(products, moderated=True):
+    """Total, average and 1-5 distribution across one or more products."""
+    if isinstance(products, Product):
+        products = [products]
+    return combine_review_stats(product_review_stats(products, moderated).values())
+
+
+def latest_review_id(moderated=True, **lookups):
+    """
+    Subquery for the id of the newest visible review matching `lookups`,
+    which are usually relative to an OuterRef('pk').
+    """
+    reviews = Review.objects.filter(**lookups)
+    if moderated:
+        reviews = reviews.filter(is_approved=True)
+    return Subquery(reviews.order_by('-created_at', '-pk').values('pk')[:1])
+
+
+def with_combo_review_stats(combos, moderated=True):
+    """
+    Annotate a ComboDeal queryset with review_count, avg_rating and
+    latest_review_id across the reviews of each combo's products.
+
+    Everything is aggregated by the database. Moderated totals are summed
+    from the Product counters. Otherwise the reviews themselves are counted.
+    """
+    if moderated:
+        count, rating_sum = Sum('products__rating_count'), Sum('products__rating_sum')
+    else:
+        count, rating_sum = Count('products__reviews'), Sum('products__reviews__rating')
+    return combos.annotate(
+        review_count=Coalesce(count, 0),
+        avg_rating=Coalesce(rating_sum * 1.0 / NullIf(count, 0), Value(0.0), output_field=FloatField()),
+        latest_review_id=latest_review_id(moderated, product__combo_deals=OuterRef('pk')),
+    )
+
+
+def rebuild_rating_counters(batch_size=500):
+    """
+    Recompute every Product's rating counters from the approved reviews.
+    One grouped query over reviews, then a batched bulk_update of products.
+    Returns the number of products written.
+    """
+    grouped = (
+        Review.objects.filter(is_approved=True)
+        .order_by()
+        .values_list('product_id', 'rating')
+        .annotate(n=Count('id'))
+    )
+    counters = defaultdict(lambda: dict.fromkeys(COUNTER_FIELDS, 0))
+    for product_id, rating, n in grouped:
+        row = counters[product_id]
+        row['rating_count'] += n
+        row['rating_sum'] += rating * n
+        if rating in RATING_STARS:
+            row[f'rating_{rating}'] += n
+
+    products = list(Product.objects.only('pk', *COUNTER_FIELDS))
+    empty = dict.fromkeys(COUNTER_FIELDS, 0)
+    for product in products:
+        for field, value in counters.get(product.pk, empty).items():
+            setattr(product, field, value)
+
+    with transaction.atomic():
+        Product.objects.bulk_update(products, COUNTER_FIELDS, batch_size=batch_size)
+    return len(products)
@@ -0,0 +1,182 @@
+# store/recommend.py
+"""
+"Frequently bought together" recommendations.
+
+Every order is a basket of products, and a combo line counts as each
+product in the combo. CoPurchase stores the upper triangle of the sparse
+product-by-product co-purchase matrix. Each cell is the number of orders
+that held both products. The diagonal is the number of orders that held
+each one.
+
+Training is incremental. It reads only the orders past the high-water
+mark where the last run stopped. It counts their pairs with SciPy and
+adds them in. It then rewrites the top-k neighbours of every product
+whose scores moved into ProductRecommendation. Serving a strip is one
+indexed query on that table; no order history is read.
+
+A score is the cosine similarity of the two products' order sets,
+orders(a, b) / sqrt(orders(a) * orders(b)). It is damped by
+orders(a, b) / (orders(a, b) + RECOMMEND_SHRINKAGE), so that a single
+order shared by two rarely bought products does not come first.
+
+Counts only go up. An order cancelled after it was trained on still
+counts until `manage.py train_recommendations --full` starts over.
+"""
+from collections import defaultdict
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from scipy import sparse
+
+from .models import ComboDeal, CoPurchase, Order, OrderItem, Product, ProductRecommendation, TrainingState
+
+DEFAULTS = {
+    'RECOMMEND_TOP_K': 8,
+    'RECOMMEND_SHRINKAGE': 2,
+}
+
+STATE_NAME = 'co_purchase'
+WRITE_BATCH = 1000
+
+
+def _setting(name):
+    return getattr(settings, name, DEFAULTS[name])
+
+
+def read_baskets(after, upto, batch_size=5000):
+    """
+    The distinct (order id, product id) pairs of orders in (after, upto],
+    combos expanded, as two arrays. Cancelled and failed orders are left out.
+    """
+    combos = defaultdict(list)
+    for combo_id, product_id in ComboDeal.products.through.objects.values_list('combodeal_id', 'product_id'):
+        combos[combo_id].append(product_id)
+    pairs = set()
+    for start in range(after, upto, batch_size):
+        lines = (
+            OrderItem.objects
+            .filter(order_id__gt=start, order_id__lte=min(start + batch_size, upto))
+            .exclude(order__status='cancelled')
+            .exclude(order__payment_status='failed')
+            .values_list('order_id', 'product_id', 'combo_deal_id')
+        )
+        for order_id, product_id, combo_id in lines:
+            if product_id is not None:
+                pairs.add((order_id, product_id))
+            for member_id in combos.get(combo_id, ()):
+                pairs.add((order_id, member_id))
+    if not pairs:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    orders, products = np.array(sorted(pairs), dtype=np.int64).T
+    return orders, products
+
+
+def co_purchases(orders, products, size):
+    """Upper-triangular co-purchase counts (size x size) for baskets given as (order, product) pairs."""
+    _, rows = np.unique(orders, return_inverse=True)
+    baskets = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.int64), (rows, products)), shape=(rows.max() + 1, size),
+    )
+    return sparse.triu(baskets.T @ baskets).tocsr()
+
+
+def load_counts(size):
+    cells = np.array(CoPurchase.objects.values_list('product_id', 'other_id', 'orders'), dtype=np.int64)
+    cells = cells.reshape(-1, 3)
+    return sparse.csr_matrix((cells[:, 2], (cells[:, 0], cells[:, 1])), shape=(size, size))
+
+
+def scores(counts, shrinkage):
+    """(product, other, score) arrays for every co-purchased pair, both ways round."""
+    counts = counts.tocoo()
+    bought = counts.diagonal().astype(np.float64)
+    off = counts.row != counts.col
+    a, b = counts.row[off], counts.col[off]
+    together = counts.data[off].astype(np.float64)
+    score = together / np.sqrt(bought[a] * bought[b]) * together / (together + shrinkage)
+    return np.concatenate([a, b]), np.concatenate([b, a]), np.concatenate([score, score])
+
+
+def top_k(products, others, score, k):
+    """The k best (product, other, score, rank) of each product, ties going to the lower id."""
+    order = np.lexsort((others, -score, products))
+    products, others, score = products[order], others[order], score[order]
+    rank = np.arange(len(products)) - np.searchsorted(products, products)
+    keep = rank < k
+    return products[keep], others[keep], score[keep], rank[keep]
+
+
+def _save_counts(counts, changed):
+    cells = changed.tocoo()
+    totals = np.asarray(counts[cells.row, cells.col]).ravel()
+    CoPurchase.objects.bulk_create(
+        [
+            CoPurchase(product_id=int(a), other_id=int(b), orders=int(n))
+            for a, b, n in zip(cells.row, cells.col, totals)
+        ],
+        batch_size=WRITE_BATCH,
+        update_conflicts=True,
+        unique_fields=['product', 'other'],
+        update_fields=['orders'],
+    )
+
+
+def _save_recommendations(affected, products, others, score, rank):
+    affected = affected.tolist()
+    for start in range(0, len(affected), WRITE_BATCH):
+        ProductRecommendation.objects.filter(product_id__in=affected[start:start + WRITE_BATCH]).delete()
+    ProductRecommendation.objects.bulk_create(
+        [
+            ProductRecommendation(product_id=int(p), recommended_id=int(o), score=float(s), rank=int(r))
+            for p, o, s, r in zip(products, others, score, rank)
+        ],
+        batch_size=WRITE_BATCH,
+    )
+
+
+def train(full=False, batch_size=5000):
+    """
+    Take in the orders placed since the last run (every order with `full`)
+    and refresh the neighbours of the products they affect.
+    Returns (orders read, products refreshed).
+    """
+    with transaction.atomic():
+        state, _ = TrainingState.objects.select_for_update().get_or_create(name=STATE_NAME)
+        if full:
+            CoPurchase.objects.all().delete()
+            ProductRecommendation.objects.all().delete()
+            state.high_water_mark = 0
+        upto = Order.objects.aggregate(last=Max('id'))['last'] or 0
+        orders, products = read_baskets(state.high_water_mark, upto, batch_size)
+        refreshed = 0
+        if len(orders):
+            size = max(Product.objects.aggregate(last=Max('id'))['last'] or 0, int(products.max())) + 1
+            changed = co_purchases(orders, products, size)
+            counts = load_counts(size) + changed
+            _save_counts(counts, changed)
+
+            # A product's scores move when its own counts do or when those of a product it was bought with do
+            touched = np.unique(products)
+            a, b, score = scores(counts, _setting('RECOMMEND_SHRINKAGE'))
+            affected = np.union1d(touched, a[np.isin(b, touched)])
+            mine = np.isin(a, affected)
+            _save_recommendations(affected, *top_k(a[mine], b[mine], score[mine], _setting('RECOMMEND_TOP_K')))
+            refreshed = len(affected)
+        state.high_water_mark = max(state.high_water_mark, upto)
+        state.trained_at = timezone.now()
+        state.save()
+    return len(np.unique(orders)), refreshed
+
+
+def frequently_bought_with(product, limit=None):
+    """Products most often bought with `product`, best first, from the precomputed table."""
+    limit = limit or _setting('RECOMMEND_TOP_K')
+    return (
+        Product.objects
+        .filter(recommended_in__product=product, is_available=True)
+        .only('id', 'name', 'slug', 'image', 'price', 'sale_price')
+        .order_by('recommended_in__rank')[:limit]
+    )
@@ -0,0 +1,249 @@
+# store/search.py
+"""
+Product search index.
+
+Each product is indexed as three weighted columns:
+- name
+- keywords: category name, concern label and ideal_for
+- body: description and what_makes_it_potent
+
+SQLite uses an FTS5 table and Postgres a tsvector table with a GIN index.
+Both tables are created by migration 0031. Other databases fall back to
+the old icontains scan. Queries match every term as a prefix. If that
+finds nothing, each term is widened with close spellings from the index
+vocabulary, which gives typo tolerance.
+"""
+import difflib
+import re
+
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Category, Product
+
+SEARCH_RESULT_LIMIT = 200
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return [token.lower() for token in TOKEN_RE.findall(text or '')]
+
+
+def product_document(product):
+    """(name, keywords, body) text for one product."""
+    keywords = ' '.join([product.category.name, product.get_concern_display(), product.ideal_for])
+    body = ' '.join([product.description, product.what_makes_it_potent])
+    return product.name, keywords, body
+
+
+def close_spellings(token, vocabulary, limit=3):
+    return difflib.get_close_matches(token, vocabulary, n=limit, cutoff=0.75)
+
+
+class SearchBackend:
+    """ORM fallback for databases without a native full-text index."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def index(self, products, replace=True):
+        pass
+
+    def unindex(self, product_ids):
+        pass
+
+    def clear(self):
+        pass
+
+    def search(self, query, limit=SEARCH_RESULT_LIMIT):
+        # The same fields as product_document(); concern is stored as a key, so its label is matched here
+        condition = Q()
+        for token in tokenize(query):
+            concerns = [key for key, label in Product.CONCERN_CHOICES if token in label.lower()]
+            condition &= (
+                Q(name__icontains=token) |
+                Q(description__icontains=token) |
+                Q(what_makes_it_potent__icontains=token) |
+                Q(ideal_for__icontains=token) |
+                Q(category__name__icontains=token) |
+                Q(concern__in=concerns)
+            )
+        return list(Product.objects.filter(condition).order_by('name').values_list('pk', flat=True)[:limit])
+
+
+class SQLiteSearchBackend(SearchBackend):
+    table = 'store_product_fts'
+    vocab_table = 'store_product_fts_vocab'
+    # bm25 column weights for name, keywords, body
+    weights = (10.0, 4.0, 1.0)
+
+    def index(self, products, replace=True):
+        rows = [(p.pk, *product_document(p)) for p in products]
+        if not rows:
+            return
+        with self.connection.cursor() as cursor:
+            if replace:
+                self._delete(cursor, [row[0] for row in rows])
+            cursor.executemany(
+                f'INSERT INTO {self.table} (rowid, name, keywords, body) VALUES (%s, %s, %s, %s)', rows
+            )
+
+    def unindex(self, product_ids):
+        with self.connection.cursor() as cursor:
+            self._delete(cursor, product_ids)
+
+    def clear(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table}')
+
+    def _delete(self, cursor, product_ids):
+        cursor.executemany(f'DELETE FROM {self.table} WHERE rowid = %s', [(pk,) for pk in product_ids])
+
+    def vocabulary(self, token):
+        # fts5vocab serves term range scans from the index itself
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT term FROM {self.vocab_table} WHERE term >= %s AND term < %s',
+                [token[0], chr(ord(token[0]) + 1)],
+            )
+            return [term for (term,) in cursor.fetchall() if abs(len(term) - len(token)) <= 2]
+
+    def _match(self, match, limit):
+        weights = ', '.join(str(w) for w in self.weights)
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s '
+                f'ORDER BY bm25({self.table}, {weights}) LIMIT %s',
+                [match, limit],
+            )
+            return [pk for (pk,) in cursor.fetchall()]
+
+    def search(self, query, limit=SEARCH_RESULT_LIMIT):
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        ids = self._match(' AND '.join(f'"{t}"*' for t in tokens), limit)
+        if ids:
+            return ids
+        groups = []
+        for token in tokens:
+            alternatives = [f'"{t}"*' for t in [token, *close_spellings(token, self.vocabulary(token))]]
+            groups.append('(' + ' OR '.join(alternatives) + ')')
+        return self._match(' AND '.join(groups), limit)
+
+
+class PostgresSearchBackend(SearchBackend):
+    table = 'store_product_search'
+    config = 'english'
+    vocabulary_ttl = 3600
+
+    def index(self, products, replace=True):
+        rows = [(p.pk, *product_document(p)) for p in products]
+        if not rows:
+            return
+        with self.connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {self.table} (product_id, document) VALUES (%s, "
+                f"setweight(to_tsvector('{self.config}', %s), 'A') || "
+                f"setweight(to_tsvector('{self.config}', %s), 'B') || "
+                f"setweight(to_tsvector('{self.config}', %s), 'C')) "
+                f"ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document",
+                rows,
+            )
+
+    def unindex(self, product_ids):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table} WHERE product_id = ANY(%s)', [list(product_ids)])
+
+    def clear(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'TRUNCATE {self.table}')
+
+    def vocabulary(self, token):
+        # ts_stat scans the whole index, so the lexeme list is cached for a while
+        words = cache.get('store:search:vocabulary')
+        if words is None:
+            with self.connection.cursor() as cursor:
+                cursor.execute(f"SELECT word FROM ts_stat('SELECT document FROM {self.table}')")
+                words = [word for (word,) in cursor.fetchall()]
+            cache.set('store:search:vocabulary', words, self.vocabulary_ttl)
+        return [w for w in words if w[:1] == token[0] and abs(len(w) - len(token)) <= 2]
+
+    def _match(self, tsquery, limit):
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT product_id FROM {self.table}, to_tsquery('{self.config}', %s) query "
+                f"WHERE document @@ query ORDER BY ts_rank(document, query) DESC LIMIT %s",
+                [tsquery, limit],
+            )
+            return [pk for (pk,) in cursor.fetchall()]
+
+    def search(self, query, limit=SEARCH_RESULT_LIMIT):
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        ids = self._match(' & '.join(f'{t}:*' for t in tokens), limit)
+        if ids:
+            return ids
+        groups = []
+        for token in tokens:
+            alternatives = [f'{t}:*' for t in [token, *close_spellings(token, self.vocabulary(token))]]
+            groups.append('(' + ' | '.join(alternatives) + ')')
+        return self._match(' & '.join(groups), limit)
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+def get_search_backend():
+    return BACKENDS.get(connection.vendor, SearchBackend)(connection)
+
+
+def search_product_ids(query, limit=SEARCH_RESULT_LIMIT):
+    """Ids of the products matching `query`, best match first."""
+    return get_search_backend().search(query, limit)
+
+
+def index_products(products):
+    get_search_backend().index(products)
+
+
+def rebuild_search_index(batch_size=1000):
+    """Re-index every product from scratch. Returns the number indexed."""
+    backend = get_search_backend()
+    products = Product.objects.select_related('category').order_by('pk')
+    total = 0
+    last_pk = 0
+    with transaction.atomic():
+        backend.clear()
+        while True:
+            batch = list(products.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                return total
+            backend.index(batch, replace=False)
+            total += len(batch)
+            last_pk = batch[-1].pk
+
+
+#Incremental updates: re-index a product whenever it (or its category) changes
+@receiver(post_save, sender=Product)
+def index_saved_product(sender, instance, raw=False, **kwargs):
+    if not raw:
+        index_products([instance])
+
+
+@receiver(post_delete, sender=Product)
+def unindex_deleted_product(sender, instance, **kwargs):
+    get_search_backend().unindex([instance.pk])
+
+
+@receiver(post_save, sender=Category)
+def reindex_category_products(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        index_products(instance.products.select_related('category'))
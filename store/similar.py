@@ -0,0 +1,279 @@
+# store/similar.py
+"""
+"You may also like": products whose text reads alike, so even a product
+nobody has ordered yet has neighbours.
+
+Each product is a hashed TF-IDF vector over its name, description,
+what_makes_it_potent, how_to_use, ideal_for and consumer_studies, plus a
+token for its category and one for its concern. Fields are weighted, term
+frequencies are damped with 1 + log(tf), and every vector is L2
+normalized. Words are hashed into a fixed number of columns, so the
+matrix keeps its shape as products are added. Neighbours are the
+highest cosine scores, which for unit vectors is a row of the matrix
+product X @ X.T.
+
+Each process holds one index, like the facet and suggest indexes, built
+and refreshed on a background thread; until the first build is done
+product pages show no strip. Scoring every product against every other
+is quadratic, so neighbour lists are computed when a product is first
+asked for. Products asked for together are computed as one matrix
+product.
+
+When the catalog version moves the index refreshes rather than rebuilds.
+It re-reads only the products whose updated_at moved and drops the ones
+that are gone. One matrix product then scores those rows against the
+whole catalog. That gives their new neighbour lists, and the same scores
+are merged into every list already computed. Lists that held a changed
+product are recomputed when next asked for. IDF weights are fixed when
+the index is built, and once more than REBUILD_FRACTION of the catalog
+has changed the index is built afresh.
+
+Text changed with queryset.update() does not move updated_at, so it is
+not seen until the next full build.
+"""
+import math
+import zlib
+from collections import Counter
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+from scipy import sparse
+
+from .models import Product
+from .search import tokenize
+from .versions import CATALOG, VersionedIndex
+
+DEFAULTS = {
+    'SIMILAR_PRODUCTS_K': 12,
+}
+
+COLUMNS = 1 << 18
+# Rows scored per matrix product when many lists are computed at once
+CHUNK = 256
+REBUILD_FRACTION = 0.2
+# updated_at is read back this far to cover clock skew between app servers
+SKEW = timedelta(seconds=5)
+
+FIELDS = ['id', 'name', 'description', 'what_makes_it_potent', 'how_to_use', 'ideal_for',
+          'consumer_studies', 'category_id', 'concern']
+FIELD_WEIGHTS = {
+    'name': 3, 'ideal_for': 2, 'description': 1, 'what_makes_it_potent': 1, 'how_to_use': 1, 'consumer_studies': 1,
+}
+TAG_WEIGHT = 2
+# What the product strip template shows
+STRIP_FIELDS = ['id', 'name', 'slug', 'image', 'price', 'sale_price']
+STOP_WORDS = frozenset(
+    'a an and are as at be by for from in is it its of on or so that the this to with you your'.split()
+)
+
+_columns = {}
+
+
+def _setting(name):
+    return getattr(settings, name, DEFAULTS[name])
+
+
+def column(term):
+    """A term's hashed column, stable across processes."""
+    value = _columns.get(term)
+    if value is None:
+        value = _columns[term] = zlib.crc32(term.encode()) & (COLUMNS - 1)
+    return value
+
+
+def product_terms(row):
+    """Weighted term counts for one product (a dict of FIELDS)."""
+    counts = Counter()
+    for field, weight in FIELD_WEIGHTS.items():
+        for token in tokenize(row[field]):
+            if len(token) > 1 and token not in STOP_WORDS:
+                counts[token] += weight
+    counts[f"category:{row['category_id']}"] += TAG_WEIGHT
+    if row['concern']:
+        counts[f"concern:{row['concern']}"] += TAG_WEIGHT
+    return counts
+
+
+def term_frequencies(rows):
+    """Damped, hashed term frequencies of `rows` as a sparse matrix, one row each."""
+    indptr, indices, data = [0], [], []
+    for row in rows:
+        hashed = Counter()
+        for term, count in product_terms(row).items():
+            hashed[column(term)] += count
+        indices.extend(hashed.keys())
+        data.extend(1 + math.log(count) for count in hashed.values())
+        indptr.append(len(indices))
+    return sparse.csr_matrix(
+        (np.array(data, dtype=np.float32), np.array(indices, dtype=np.int64), np.array(indptr, dtype=np.int64)),
+        shape=(len(rows), COLUMNS),
+    )
+
+
+def normalize_rows(matrix):
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return (sparse.diags((1 / norms).astype(np.float32)) @ matrix).tocsr()
+
+
+class SimilarityIndex:
+    def __init__(self, ids, vectors, idf, synced_at, k):
+        """
+        `ids` are product ids by row of `vectors`, the normalized TF-IDF
+        matrix; a removed product keeps its row, zeroed, and an id of -1.
+        """
+        self.ids = ids
+        self.vectors = vectors
+        self.transposed = vectors.T.tocsr()
+        self.idf = idf
+        self.synced_at = synced_at
+        self.k = k
+        self.rows = {pk: row for row, pk in enumerate(ids.tolist()) if pk >= 0}
+        size = len(ids)
+        self.neighbours = np.full((size, k), -1, dtype=np.int64)
+        self.scores = np.zeros((size, k), dtype=np.float32)
+        self.ready = np.zeros(size, dtype=bool)
+
+    @classmethod
+    def build(cls, k=None):
+        synced_at = timezone.now()
+        rows = list(Product.objects.order_by('id').values(*FIELDS))
+        frequencies = term_frequencies(rows)
+        documents = np.bincount(frequencies.indices, minlength=COLUMNS)
+        idf = (np.log((1 + len(rows)) / (1 + documents)) + 1).astype(np.float32)
+        ids = np.array([row['id'] for row in rows], dtype=np.int64)
+        return cls(ids, cls._weigh(frequencies, idf), idf, synced_at, k or _setting('SIMILAR_PRODUCTS_K'))
+
+    @staticmethod
+    def _weigh(frequencies, idf):
+        weighted = frequencies.copy()
+        weighted.data *= idf[weighted.indices]
+        return normalize_rows(weighted)
+
+    def _score(self, rows):
+        """Every product's score against each of `rows`, self excluded: a dense len(rows) x size array."""
+        scores = (self.vectors[rows] @ self.transposed).toarray()
+        scores[np.arange(len(rows)), rows] = 0
+        return scores
+
+    def _best(self, scores, ids=None):
+        """The top k (rows, scores) of each row of `scores`; `ids` are the row numbers of its columns."""
+        k = min(self.k, scores.shape[1])
+        if k == 0:
+            return np.empty((len(scores), 0), dtype=np.int64), np.empty((len(scores), 0), dtype=np.float32)
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        best = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-best, axis=1, kind='stable')
+        top = np.take_along_axis(top, order, axis=1)
+        best = np.take_along_axis(best, order, axis=1)
+        rows = top if ids is None else np.take_along_axis(ids, top, axis=1)
+        rows[best <= 0] = -1
+        return rows, best
+
+    def _store(self, rows, neighbours, scores):
+        width = neighbours.shape[1]
+        self.neighbours[rows] = -1
+        self.scores[rows] = 0
+        self.neighbours[rows, :width] = neighbours
+        self.scores[rows, :width] = scores
+        self.ready[rows] = True
+
+    def compute(self, rows):
+        """Compute the neighbour lists of `rows` in batches of CHUNK."""
+        rows = np.asarray(rows, dtype=np.int64)
+        for start in range(0, len(rows), CHUNK):
+            chunk = rows[start:start + CHUNK]
+            self._store(chunk, *self._best(self._score(chunk)))
+
+    def similar(self, pk, limit=None):
+        """Ids of the products most like product `pk`, best first."""
+        row = self.rows.get(pk)
+        if row is None:
+            return []
+        if not self.ready[row]:
+            # Another thread may be doing the same; both write the same values
+            self.compute([row])
+        neighbours = self.neighbours[row][:limit]
+        return self.ids[neighbours[neighbours >= 0]].tolist()
+
+    def refresh(self):
+        """
+        A copy brought up to date with products changed since this index was
+        synced, or a new build if too much has changed.
+        """
+        synced_at = timezone.now()
+        changed = list(Product.objects.filter(updated_at__gte=self.synced_at - SKEW).order_by('id').values(*FIELDS))
+        current = set(Product.objects.values_list('id', flat=True))
+        removed = [pk for pk in self.rows if pk not in current]
+        if not changed and not removed:
+            # Only reviews or stock moved the version
+            self.synced_at = synced_at
+            return self
+        if len(changed) + len(removed) > REBUILD_FRACTION * max(len(self.rows), 1):
+            return type(self).build(self.k)
+
+        # New products get rows at the end; removed ones keep theirs, zeroed
+        added = [row['id'] for row in changed if row['id'] not in self.rows]
+        ids = np.concatenate([self.ids, np.array(added, dtype=np.int64)])
+        rows = {**self.rows, **{pk: len(self.ids) + i for i, pk in enumerate(added)}}
+        ids[[rows[pk] for pk in removed]] = -1
+        positions = np.array([rows[row['id']] for row in changed] + [rows[pk] for pk in removed], dtype=np.int64)
+
+        vectors = sparse.vstack([self.vectors, sparse.csr_matrix((len(added), COLUMNS), dtype=np.float32)]).tocsr()
+        keep = np.ones(len(ids), dtype=np.float32)
+        keep[positions] = 0
+        updated = self._weigh(term_frequencies(changed), self.idf) if changed else None
+        vectors = sparse.diags(keep) @ vectors
+        if updated is not None:
+            place = sparse.csr_matrix(
+                (np.ones(len(changed), dtype=np.float32), (positions[:len(changed)], np.arange(len(changed)))),
+                shape=(len(ids), len(changed)),
+            )
+            vectors = vectors + place @ updated
+        vectors = vectors.tocsr()
+        vectors.eliminate_zeros()
+
+        index = type(self)(ids, vectors, self.idf, synced_at, self.k)
+        size = len(self.ids)
+        index.neighbours[:size] = self.neighbours
+        index.scores[:size] = self.scores
+        index.ready[:size] = self.ready
+
+        # Lists that held a changed product are recomputed when next asked for
+        index.ready[np.isin(index.neighbours, positions).any(axis=1)] = False
+        index.ready[positions] = False
+        unchanged = np.ones(len(ids), dtype=bool)
+        unchanged[positions] = False
+        merge = np.flatnonzero(index.ready & unchanged)
+        for start in range(0, len(positions), CHUNK):
+            chunk = positions[start:start + CHUNK]
+            scores = index._score(chunk)
+            # The changed rows' own lists come from the same product
+            index._store(chunk, *index._best(scores))
+            # and the changed rows are candidates for every list already computed
+            if len(merge):
+                candidates = np.hstack([index.scores[merge], scores[:, merge].T])
+                names = np.hstack([index.neighbours[merge], np.broadcast_to(chunk, (len(merge), len(chunk)))])
+                index._store(merge, *index._best(candidates, names))
+        return index
+
+
+# Building takes seconds on a large catalog, so the first one is never waited for
+_index = VersionedIndex(CATALOG, SimilarityIndex.build, refresh=SimilarityIndex.refresh, wait_for_first=False)
+
+
+def get_similarity_index():
+    """This process's index, or None until it is first built; refreshed in the background when the catalog moves."""
+    return _index.get()
+
+
+def similar_products(product, limit=6):
+    """Available products most like `product`, best first, in one query."""
+    index = get_similarity_index()
+    ids = index.similar(product.pk) if index else []
+    if not ids:
+        return []
+    found = Product.objects.filter(pk__in=ids, is_available=True).only(*STRIP_FIELDS).in_bulk()
+    return [found[pk] for pk in ids if pk in found][:limit]
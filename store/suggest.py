@@ -0,0 +1,123 @@
+# store/suggest.py
+"""
+Search-as-you-type suggestions served from memory.
+
+Every product and category name is normalized and indexed once per word
+start ("aloe vera gel", "vera gel", "gel"), so typing any word of a name
+finds it. The keys live in one sorted array, and a prefix lookup is a
+bisect plus a short scan. Prefixes of one or two characters match too many
+keys to scan, so their top results are precomputed at build time.
+
+Each process holds one index and rebuilds it in the background when the
+catalog version moves (store/versions.py VersionedIndex), serving the old
+one meanwhile, so keystrokes never reach the database or wait on a build.
+"""
+import heapq
+from bisect import bisect_left
+
+from django.urls import reverse
+
+from .models import Category, Product
+from .search import tokenize
+from .versions import CATALOG, VersionedIndex
+
+MAX_SUGGESTIONS = 20
+SCAN_LIMIT = 400
+SHORT_PREFIX = 2
+
+
+def normalize(text):
+    return ' '.join(tokenize(text))
+
+
+class SuggestIndex:
+    def __init__(self, items):
+        """
+        `items` are (kind, name, slug, popularity) tuples. Entries rank whole-name
+        matches before word matches, then by popularity, then by name.
+        """
+        self.items = items
+        pairs = []
+        for position, (kind, name, slug, popularity) in enumerate(items):
+            key = normalize(name)
+            start = 0
+            while True:
+                pairs.append((key[start:], start > 0, position))
+                start = key.find(' ', start) + 1
+                if not start:
+                    break
+        pairs.sort()
+        self.keys = [key for key, _, _ in pairs]
+        self.entries = [(word_match, position) for _, word_match, position in pairs]
+        self.short = self._precompute_short_prefixes()
+
+    @classmethod
+    def build(cls):
+        products = Product.objects.filter(is_available=True).values_list('name', 'slug', 'rating_count')
+        categories = Category.objects.values_list('name', 'slug')
+        items = [('category', name, slug, 0) for name, slug in categories]
+        items += [('product', name, slug, popularity) for name, slug, popularity in products]
+        return cls(items)
+
+    def _score(self, entry):
+        word_match, position = entry
+        kind, name, slug, popularity = self.items[position]
+        return (word_match, -popularity, name.lower())
+
+    def _rank(self, entries, kind, limit):
+        best = {}
+        for entry in entries:
+            position = entry[1]
+            if self.items[position][0] != kind:
+                continue
+            score = self._score(entry)
+            if position not in best or score < best[position]:
+                best[position] = score
+        return [p for p, _ in heapq.nsmallest(limit, best.items(), key=lambda pair: pair[1])]
+
+    def _precompute_short_prefixes(self):
+        buckets = {}
+        for key, entry in zip(self.keys, self.entries):
+            for length in range(1, min(SHORT_PREFIX, len(key)) + 1):
+                buckets.setdefault(key[:length], []).append(entry)
+        return {
+            prefix: {kind: self._rank(entries, kind, MAX_SUGGESTIONS) for kind in ('product', 'category')}
+            for prefix, entries in buckets.items()
+        }
+
+    def lookup(self, prefix, limit=8):
+        """{'product': [item positions], 'category': [...]} for a typed prefix."""
+        prefix = normalize(prefix)
+        limit = min(limit, MAX_SUGGESTIONS)
+        if not prefix:
+            return {'product': [], 'category': []}
+        if len(prefix) <= SHORT_PREFIX:
+            ranked = self.short.get(prefix, {})
+            return {kind: ranked.get(kind, [])[:limit] for kind in ('product', 'category')}
+        lo = bisect_left(self.keys, prefix)
+        hi = min(bisect_left(self.keys, prefix + '\uffff', lo), lo + SCAN_LIMIT)
+        entries = self.entries[lo:hi]
+        return {kind: self._rank(entries, kind, limit) for kind in ('product', 'category')}
+
+    def suggest(self, prefix, limit=8):
+        """JSON-ready product and category suggestions for a typed prefix."""
+        found = self.lookup(prefix, limit)
+        products_url = reverse('store:products')
+        return {
+            'products': [
+                {'name': self.items[p][1], 'url': reverse('store:product_detail', args=[self.items[p][2]])}
+                for p in found['product']
+            ],
+            'categories': [
+                {'name': self.items[p][1], 'url': f'{products_url}?category={self.items[p][2]}'}
+                for p in found['category']
+            ],
+        }
+
+
+_index = VersionedIndex(CATALOG, SuggestIndex.build)
+
+
+def get_suggest_index():
+    """This process's index; while the catalog version has moved, the previous one as it is rebuilt."""
+    return _index.get()
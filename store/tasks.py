@@ -0,0 +1,224 @@
+# store/tasks.py
+"""
+A small database-backed task queue for side effects that should not hold
+up a request: email, cache warmups, image uploads (store/uploads.py).
+
+Functions decorated with @task are registered by name. Calling
+`func.delay(**kwargs)` inserts a Task row, inside the caller's transaction
+if there is one, so a task is only queued when whatever it describes was
+committed. `manage.py run_tasks` claims due tasks and runs them on a
+thread pool. Several workers, in one or many processes, can run at once;
+claiming marks rows as running in one UPDATE, so a task is taken by a
+single worker.
+
+A failed task is retried after an exponential, jittered delay
+(TASK_RETRY_BASE seconds, doubled each attempt). Once it has failed
+max_attempts times it is marked dead, which leaves it in the table for
+admin to inspect and requeue. A task left running by a worker that died
+is claimed again after TASK_LOCK_TIMEOUT seconds, so tasks should be safe
+to run twice.
+
+Arguments must be JSON-serialisable; pass ids, not model instances.
+"""
+import logging
+import random
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import send_mail
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import CustomUser, Order, Task
+from .navigation import BUILDERS, get_navigation_part
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'TASK_MAX_ATTEMPTS': 5,
+    'TASK_RETRY_BASE': 30,
+    'TASK_LOCK_TIMEOUT': 600,
+}
+
+REGISTRY = {}
+
+
+def _setting(name):
+    return getattr(settings, name, DEFAULTS[name])
+
+
+def task(func=None, *, max_attempts=None):
+    """Register `func` as a task and give it a .delay(**kwargs) that queues it."""
+    def register(func):
+        name = f'{func.__module__}.{func.__qualname__}'
+        REGISTRY[name] = func
+
+        def delay(run_at=None, **kwargs):
+            return enqueue(name, run_at=run_at, max_attempts=max_attempts, **kwargs)
+
+        def delay_once(**kwargs):
+            """delay(), unless the same call is already queued and not yet started."""
+            if Task.objects.filter(name=name, kwargs=kwargs, status=Task.QUEUED).exists():
+                return None
+            return delay(**kwargs)
+
+        func.task_name = name
+        func.delay = delay
+        func.delay_once = delay_once
+        return func
+
+    return register(func) if func is not None else register
+
+
+def enqueue(name, run_at=None, max_attempts=None, **kwargs):
+    if name not in REGISTRY:
+        raise KeyError(f'Unknown task {name}')
+    return Task.objects.create(
+        name=name,
+        kwargs=kwargs,
+        run_at=run_at or timezone.now(),
+        max_attempts=max_attempts or _setting('TASK_MAX_ATTEMPTS'),
+    )
+
+
+def worker_id():
+    return f'{socket.gethostname()}:{threading.get_native_id()}'
+
+
+def claim(limit, worker=None):
+    """Mark up to `limit` due tasks as running for `worker` and return them."""
+    worker = worker or worker_id()
+    now = timezone.now()
+    stale = now - timedelta(seconds=_setting('TASK_LOCK_TIMEOUT'))
+    due = (
+        Q(status=Task.QUEUED, run_at__lte=now)
+        | Q(status=Task.RUNNING, locked_at__lt=stale)
+    )
+    with transaction.atomic():
+        candidates = Task.objects.filter(due).order_by('run_at', 'id')
+        if connection.features.has_select_for_update_skip_locked:
+            candidates = candidates.select_for_update(skip_locked=True)
+        ids = list(candidates.values_list('id', flat=True)[:limit])
+        if not ids:
+            return []
+        # Re-checking `due` makes the claim safe without row locks too
+        Task.objects.filter(due, id__in=ids).update(status=Task.RUNNING, locked_by=worker, locked_at=now)
+        return list(Task.objects.filter(id__in=ids, status=Task.RUNNING, locked_by=worker, locked_at=now))
+
+
+def retry_delay(attempts):
+    """Seconds to wait after the `attempts`th failure."""
+    base = _setting('TASK_RETRY_BASE') * 2 ** (attempts - 1)
+    return random.uniform(base / 2, base)
+
+
+def run_task(task):
+    """Run one claimed task and record the outcome. Returns its final status."""
+    task.attempts += 1
+    try:
+        func = REGISTRY[task.name]
+        func(**task.kwargs)
+    except Exception as e:
+        logger.exception('Task %s (%s) failed', task.pk, task.name)
+        task.last_error = f'{type(e).__name__}: {e}'
+        if task.attempts >= task.max_attempts:
+            task.status = Task.DEAD
+        else:
+            task.status = Task.QUEUED
+            task.run_at = timezone.now() + timedelta(seconds=retry_delay(task.attempts))
+    else:
+        task.status = Task.DONE
+        task.last_error = ''
+    task.finished_at = timezone.now() if task.status in (Task.DONE, Task.DEAD) else None
+    task.locked_by = ''
+    task.locked_at = None
+    task.save(update_fields=['status', 'attempts', 'run_at', 'last_error', 'finished_at', 'locked_by', 'locked_at'])
+    return task.status
+
+
+def _run_in_thread(task):
+    try:
+        return run_task(task)
+    finally:
+        close_old_connections()
+
+
+def run_pending(limit=50, threads=1):
+    """Claim up to `limit` due tasks and run them on `threads` threads. Returns their statuses."""
+    tasks = claim(limit)
+    if threads <= 1 or len(tasks) <= 1:
+        return [run_task(task) for task in tasks]
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return list(pool.map(_run_in_thread, tasks))
+
+
+@task
+def send_email(subject, message, recipient_list, from_email=None):
+    send_mail(subject=subject, message=message, from_email=from_email,
+              recipient_list=recipient_list, fail_silently=False)
+
+
+@task
+def send_order_confirmation(order_id):
+    order = Order.objects.select_related('user').prefetch_related('items__product', 'items__combo_deal').get(pk=order_id)
+    lines = '\n'.join(f'{item.quantity} × {item.get_name()} — ₹{item.line_total()}' for item in order.items.all())
+    send_mail(
+        subject=f'Order #{order.pk} confirmed',
+        message=f'Hi {order.first_name},\n\nThanks for your order.\n\n{lines}\n\nTotal: ₹{order.paid_amount}',
+        from_email=None,
+        recipient_list=[order.email or order.user.email],
+        fail_silently=False,
+    )
+
+
+@task
+def send_backorder_alert(order_id, shortage):
+    """Email staff about a paid order that was placed without the stock for it."""
+    recipients = list(
+        CustomUser.objects.filter(is_staff=True, is_active=True).exclude(email='').values_list('email', flat=True)
+    )
+    if recipients:
+        send_mail(
+            subject=f'Order #{order_id} is paid but backordered',
+            message=f'Order #{order_id} was paid for after stock ran out. Restock or refund it.\n\n{shortage}',
+            from_email=None,
+            recipient_list=recipients,
+            fail_silently=False,
+        )
+
+
+@task
+def warm_navigation_cache():
+    """
+    Build every header/footer part into the shared cache (settings.CACHES)
+    ahead of the next page view. Queued when the navigation version moves.
+    """
+    for key in BUILDERS:
+        get_navigation_part(key)
+
+
+@task
+def attach_upload(upload_id):
+    from .uploads import attach
+
+    attach(upload_id)
+
+
+@task
+def process_payment_events():
+    from .webhooks import process_pending
+
+    process_pending()
+
+
+@task
+def score_reviews():
+    """Score every review not yet scored with the active review classifier."""
+    from .moderation import BATCH_SIZE, score_pending
+
+    while score_pending(BATCH_SIZE) == BATCH_SIZE:
+        pass
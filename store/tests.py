@@ -1,3 +1,1698 @@
-from django.test import TestCase
+from datetime import timedelta
+from decimal import Decimal
+import hashlib
+import hmac
+import json
+import threading
+import time
+from importlib import import_module
+from io import StringIO
+from tempfile import TemporaryDirectory
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+import razorpay
+
+from django.apps import apps as django_apps
+from django.contrib.sessions.models import Session
+from django.core import mail
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, close_old_connections, connection, reset_queries, transaction
+from django.db.models import OuterRef
+from django.db.models.functions import Lower
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .carts import active_cart, add_line, changing
+from .context_processors import site_settings
+from .fake_gateway import FakeRazorpayServer
+from .forecast import build_forecasts, send_stockout_alerts, smooth
+from .inventory import OutOfStock, reserve_stock, stock_requirements
+from .moderation import ReviewClassifier, features, save_classifier
+from .models import (
+    Cart, CartItem, Category, ComboDeal, Coupon, CoPurchase, CustomUser, ModerationModel, Offer, Order, OrderItem,
+    PaymentEvent, Product, ProductRecommendation, Review, SiteSettings, StagedUpload, StockForecast, Task,
+    UserRecommendation,
+)
+from .navigation import BUILDERS, get_navigation_part
+from .orders import place_order
+from .pagination import encode_cursor
+from .payments import CircuitBreaker, GatewayUnavailable, PaymentGateway, reset_gateway
+from .personalize import build_user_recommendations, recommended_for
+from .pricing import find_coupon, quote
+from .ratings import latest_review_id, review_stats
+from .recommend import frequently_bought_with, train
+from .search import SearchBackend, get_search_backend, search_product_ids
+from . import similar
+from .similar import SimilarityIndex, get_similarity_index, similar_products
+from .tasks import claim, run_pending, score_reviews, send_backorder_alert, send_email, task, warm_navigation_cache
+from .versions import CATALOG, COUPONS, VersionedIndex, bump_version, get_version
+from .webhooks import process_pending
+
+# Pinned query budgets for warm detail pages, context processors included.
+PRODUCT_DETAIL_QUERIES = 8
+COMBO_DETAIL_QUERIES = 4
+# A warm listing page: the products (latest review id included) and their reviews
+PRODUCT_LIST_QUERIES = 2
+# The order changelist, whatever the number of orders and items per page
+ORDER_CHANGELIST_QUERIES = 8
+
+
+# Query budgets count database work, so tests keep the cache in memory and
+# read versions from it every time; SharedCacheTests covers the configured
+# backend with the versions held in process. Indexes rebuild inline so a
+# change is visible to the next assertion; BackgroundRebuildTests covers the
+# thread.
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    VERSION_CHECK_INTERVAL=0,
+    INDEX_REBUILD_IN_BACKGROUND=False,
+)
+class StoreTestCase(TestCase):
+    """Small fixtures shared by the store test cases."""
+
+    def setUp(self):
+        cache.clear()
+
+    def make_category(self, name='Skin Care'):
+        return Category.objects.create(name=name)
+
+    def make_product(self, name='Aloe Gel', category=None, **extra):
+        category = category or Category.objects.first() or self.make_category()
+        extra.setdefault('price', '100.00')
+        extra.setdefault('stock', 10)
+        extra.setdefault('description', f'{name} description')
+        return Product.objects.create(name=name, category=category, **extra)
+
+    def make_user(self, username='buyer'):
+        return CustomUser.objects.create_user(username=username, email=f'{username}@example.com', password='pass12345')
+
+
+class RatingCounterTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = self.make_product()
+        self.user = self.make_user()
+
+    def review(self, rating, **extra):
+        return Review.objects.create(product=self.product, user=self.user, rating=rating, comment='ok', **extra)
+
+    def assertCounters(self, count, total, dist):
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.rating_count, count)
+        self.assertEqual(self.product.rating_sum, total)
+        self.assertEqual(self.product.rating_distribution, dict(zip(range(1, 6), dist)))
+
+    def test_create_and_delete_approved_reviews(self):
+        five = self.review(5)
+        self.review(3)
+        self.assertCounters(2, 8, [0, 0, 1, 0, 1])
+        five.delete()
+        self.assertCounters(1, 3, [0, 0, 1, 0, 0])
+
+    def test_unapproved_reviews_are_not_counted_until_approved(self):
+        pending = self.review(4, is_approved=False)
+        self.assertCounters(0, 0, [0, 0, 0, 0, 0])
+        pending.is_approved = True
+        pending.save()
+        self.assertCounters(1, 4, [0, 0, 0, 1, 0])
+        pending.rating = 2
+        pending.save()
+        self.assertCounters(1, 2, [0, 1, 0, 0, 0])
+        pending.is_approved = False
+        pending.save()
+        self.assertCounters(0, 0, [0, 0, 0, 0, 0])
+
+    def test_admin_list_editable_toggle_updates_counters(self):
+        review = self.review(5)
+        admin = CustomUser.objects.create_superuser('admin', 'admin@example.com', 'pass12345')
+        self.client.force_login(admin)
+        response = self.client.post(reverse('admin:store_review_changelist'), {
+            'form-TOTAL_FORMS': '1',
+            'form-INITIAL_FORMS': '1',
+            'form-0-id': str(review.pk),
+            '_save': 'Save',
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(Review.objects.get(pk=review.pk).is_approved)
+        self.assertCounters(0, 0, [0, 0, 0, 0, 0])
+
+    def test_only_rating_changes_move_the_catalog_version(self):
+        review = self.review(4, is_approved=False)
+        version = get_version(CATALOG)
+        review.comment = 'edited'
+        review.save()
+        review.delete()
+        self.assertEqual(get_version(CATALOG), version)
+        self.review(4)
+        self.assertNotEqual(get_version(CATALOG), version)
+
+    def test_rebuild_command_recomputes_from_scratch(self):
+        self.review(5)
+        self.review(1)
+        self.review(2, is_approved=False)
+        Product.objects.update(rating_count=99, rating_sum=0, rating_3=7)
+        call_command('rebuild_rating_counters', stdout=StringIO())
+        self.assertCounters(2, 6, [1, 0, 0, 0, 1])
+
+    def test_home_page_reads_counters_without_review_aggregates(self):
+        for i in range(4):
+            self.make_product(name=f'Featured {i}')
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('store:home'))
+        self.assertEqual(response.status_code, 200)
+        aggregates = [q['sql'] for q in ctx.captured_queries if 'store_review' in q['sql'] and 'COUNT' in q['sql']]
+        self.assertEqual(aggregates, [])
+
+
+class ReviewStatsTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_user()
+        self.first = self.make_product(name='Aloe Gel')
+        self.second = self.make_product(name='Neem Wash')
+        self.combo = ComboDeal.objects.create(
+            name='Glow Kit', description='Kit', original_price='250.00', discounted_price='199.00'
+        )
+        self.combo.products.set([self.first, self.second])
+        for product, rating, approved in [
+            (self.first, 5, True), (self.first, 4, True), (self.second, 2, True), (self.second, 1, False),
+        ]:
+            Review.objects.create(product=product, user=self.user, rating=rating, comment='ok', is_approved=approved)
+        self.settings_obj = SiteSettings.objects.first() or SiteSettings.objects.create()
+        Cart.objects.create(user=self.user)
+        self.client.force_login(self.user)
+
+    def test_moderated_stats_come_from_counters(self):
+        self.first.refresh_from_db()
+        self.second.refresh_from_db()
+        with self.assertNumQueries(0):
+            stats = review_stats([self.first, self.second], moderated=True)
+        self.assertEqual(stats.total, 3)
+        self.assertAlmostEqual(stats.average, 11 / 3)
+        self.assertEqual(stats.distribution, {1: 0, 2: 1, 3: 0, 4: 1, 5: 1})
+
+    def test_unmoderated_stats_use_one_grouped_query(self):
+        with self.assertNumQueries(1):
+            stats = review_stats([self.first, self.second], moderated=False)
+        self.assertEqual(stats.total, 4)
+        self.assertEqual(stats.distribution, {1: 1, 2: 1, 3: 0, 4: 1, 5: 1})
+
+    def test_product_detail_query_count(self):
+        url = reverse('store:product_detail', args=[self.first.slug])
+        self.client.get(url)
+        with self.assertNumQueries(PRODUCT_DETAIL_QUERIES):
+            response = self.client.get(url)
+        self.assertEqual(response.context['total_reviews'], 2)
+        self.assertEqual(response.context['rating_dist'][5], 1)
+
+    def test_combo_detail_query_count(self):
+        self.settings_obj.require_review_moderation = True
+        self.settings_obj.save()
+        url = reverse('store:combo_detail', args=[self.combo.slug])
+        self.client.get(url)
+        with self.assertNumQueries(COMBO_DETAIL_QUERIES):
+            response = self.client.get(url)
+        self.assertEqual(response.context['total_reviews'], 3)
+        self.assertAlmostEqual(response.context['avg_rating'], 11 / 3)
+
+    def test_combo_listing_stats_per_combo(self):
+        other = ComboDeal.objects.create(
+            name='Hair Kit', description='Kit', original_price='150.00', discounted_price='120.00'
+        )
+        other.products.set([self.second])
+        response = self.client.get(reverse('store:combos'))
+        combos = {c.slug: c for c in response.context['combos']}
+        self.assertEqual(combos['glow-kit'].review_count, 4)
+        self.assertEqual(combos['hair-kit'].review_count, 2)
+        self.assertEqual(combos['hair-kit'].latest_review.rating, 1)
+
+    def test_moderated_combo_listing_costs_the_same_for_any_number_of_combos(self):
+        self.settings_obj.require_review_moderation = True
+        self.settings_obj.save()
+        url = reverse('store:combos')
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        queries = len(ctx)
+        combo = response.context['combos'][0]
+        self.assertEqual(combo.review_count, 3)
+        self.assertAlmostEqual(combo.avg_rating, 11 / 3)
+        self.assertEqual(combo.latest_review.rating, 2)
+        for i in range(5):
+            product = self.make_product(name=f'Extra {i}')
+            Review.objects.create(product=product, user=self.user, rating=3, comment='ok')
+            ComboDeal.objects.create(
+                name=f'Extra Kit {i}', description='Kit', original_price='100.00', discounted_price='90.00'
+            ).products.set([product, self.first])
+        self.client.get(url)
+        with self.assertNumQueries(queries):
+            response = self.client.get(url)
+        self.assertEqual([c.review_count for c in response.context['combos']], [3] + [3] * 5)
+
+
+class NavigationCacheTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.request = RequestFactory().get('/')
+
+    def test_context_values_are_lazy(self):
+        with self.assertNumQueries(0):
+            context = site_settings(self.request)
+        with self.assertNumQueries(1):
+            self.assertEqual(list(context['header_offers']), [])
+            self.assertEqual(len(context['header_offers']), 0)
+
+    def test_parts_are_served_from_cache_until_a_save(self):
+        offer = Offer.objects.create(title='Free shipping')
+        self.assertEqual(get_navigation_part('header_offers'), [offer])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_navigation_part('header_offers'), [offer])
+        offer.title = 'Flat 10% off'
+        offer.save()
+        self.assertEqual(get_navigation_part('header_offers')[0].title, 'Flat 10% off')
+
+    def test_product_save_refreshes_menu(self):
+        category = self.make_category(name='Hair Care')
+        self.assertEqual(get_navigation_part('nav_hair_products'), [])
+        product = self.make_product(name='Bhringraj Oil', category=category)
+        self.assertEqual(get_navigation_part('nav_hair_products'), [product])
+
+
+class SharedCacheTests(TestCase):
+    """The cache and version interval as configured, not StoreTestCase's."""
+
+    def setUp(self):
+        self.assertNotIn('locmem', settings.CACHES['default']['BACKEND'])
+        self.enterContext(mock.patch.dict('store.versions._versions', clear=True))
+
+    def test_versions_bumped_in_one_process_are_seen_in_another(self):
+        # Two handles on the configured backend, as two worker processes would have
+        web, worker = caches.create_connection('default'), caches.create_connection('default')
+        with mock.patch('store.versions.cache', web):
+            before = get_version(COUPONS)
+        with mock.patch('store.versions.cache', worker):
+            bump_version(COUPONS)
+        with mock.patch('store.versions.time.monotonic', return_value=time.monotonic() + settings.VERSION_CHECK_INTERVAL):
+            with mock.patch('store.versions.cache', web):
+                self.assertNotEqual(get_version(COUPONS), before)
+
+    def test_warm_suggestions_and_navigation_stay_off_the_database(self):
+        Product.objects.create(name='Aloe Gel', category=Category.objects.create(name='Skin Care'), price='100.00')
+        url = reverse('store:product_suggest')
+        self.client.get(url, {'q': 'alo'})
+        for key in BUILDERS:
+            get_navigation_part(key)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url, {'q': 'alo'}).json()['products'][0]['name'], 'Aloe Gel')
+            for key in BUILDERS:
+                get_navigation_part(key)
+
+
+class BackgroundRebuildTests(StoreTestCase):
+    @override_settings(INDEX_REBUILD_IN_BACKGROUND=True)
+    def test_requests_get_the_previous_index_while_it_is_rebuilt(self):
+        release = threading.Event()
+        builds = []
+
+        def build():
+            if builds:
+                release.wait(5)
+            builds.append(len(builds) + 1)
+            return builds[-1]
+
+        index = VersionedIndex(CATALOG, build)
+        self.assertEqual(index.get(), 1)
+        bump_version(CATALOG)
+        self.assertEqual([index.get(), index.get()], [1, 1])
+        rebuilding = index._rebuilding
+        release.set()
+        rebuilding.join()
+        self.assertEqual(index.get(), 2)
+        self.assertEqual(builds, [1, 2])
+
+
+class CartSummaryTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = self.make_product(sale_price='80.00')
+        self.user = self.make_user()
+
+    def cart_queries(self, ctx):
+        return [q['sql'] for q in ctx.captured_queries if 'store_cart' in q['sql']]
+
+    def test_anonymous_visitors_create_no_rows(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('store:home'))
+        self.assertEqual(response.context['cart_count'], 0)
+        self.assertEqual(self.cart_queries(ctx), [])
+        self.assertFalse(Cart.objects.exists())
+        self.assertFalse(Session.objects.exists())
+
+    def test_cart_mutations_keep_the_badge_current(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('store:add_to_cart', args=[self.product.slug]), {'quantity': 3})
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('store:home'))
+        self.assertEqual(response.context['cart_count'], 3)
+        self.assertEqual(response.context['cart_subtotal'], Decimal('240.00'))
+        self.assertEqual(self.cart_queries(ctx), [])
+
+        item = CartItem.objects.get()
+        self.client.post(reverse('store:update_cart', args=[item.pk]), {'action': 'decrease'})
+        self.assertEqual(self.client.session['cart_summary']['count'], 2)
+        self.client.post(reverse('store:remove_from_cart', args=[item.pk]))
+        self.assertEqual(self.client.session['cart_summary'], {'count': 0, 'subtotal': '0.00', 'version': 3})
+
+    def test_summary_is_computed_once_for_existing_sessions(self):
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.product, quantity=2)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse('store:home')).context['cart_count'], 2)
+        self.assertEqual(self.client.session['cart_summary'], {'count': 2, 'subtotal': '160.00', 'version': 0})
+
+    def test_signing_in_replaces_a_visitor_badge_whose_cart_is_gone(self):
+        self.client.post(reverse('store:add_to_cart', args=[self.product.slug]), {'quantity': 2})
+        Cart.objects.filter(user__isnull=True).delete()
+        self.client.login(username='buyer', password='pass12345')
+        self.assertEqual(self.client.session['cart_summary'], {'count': 0, 'subtotal': '0.00'})
+
+    def test_checkout_resyncs_a_badge_from_an_older_cart_version(self):
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.product, quantity=2)
+        self.client.force_login(self.user)
+        self.client.get(reverse('store:home'))
+        # Another device adds a line
+        with changing(cart):
+            add_line(cart, product=self.product)
+        self.assertEqual(self.client.session['cart_summary']['count'], 2)
+        self.client.get(reverse('store:checkout'))
+        self.assertEqual(self.client.session['cart_summary'], {'count': 3, 'subtotal': '240.00', 'version': 1})
+
+
+class ProductSearchTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.category = self.make_category(name='Hair Care')
+        self.shampoo = self.make_product(name='Neem Shampoo', category=self.category, concern='hair_fall')
+        self.oil = self.make_product(
+            name='Bhringraj Oil', category=self.category, description='Cold pressed oil with neem and amla.'
+        )
+        self.gel = self.make_product(
+            name='Aloe Gel', category=self.make_category(), description='Soothing gel.', ideal_for='Sensitive skin', concern='hydration'
+        )
+
+    def test_name_matches_rank_above_description_matches(self):
+        self.assertEqual(search_product_ids('neem'), [self.shampoo.pk, self.oil.pk])
+
+    def test_prefix_and_concern_label_matches(self):
+        self.assertEqual(search_product_ids('sham'), [self.shampoo.pk])
+        self.assertEqual(search_product_ids('hydration sensitive'), [self.gel.pk])
+
+    def test_orm_fallback_matches_the_indexed_fields(self):
+        self.oil.what_makes_it_potent = 'Slow cooked with curry leaves.'
+        self.oil.save()
+        backend = SearchBackend(connection)
+        self.assertEqual(backend.search('hydration sensitive'), [self.gel.pk])
+        self.assertEqual(backend.search('hair fall'), [self.shampoo.pk])
+        self.assertEqual(backend.search('curry'), [self.oil.pk])
+
+    def test_typos_fall_back_to_close_spellings(self):
+        self.assertEqual(search_product_ids('shampooo'), [self.shampoo.pk])
+        self.assertEqual(search_product_ids('bringraj'), [self.oil.pk])
+
+    def test_index_follows_product_and_category_changes(self):
+        self.gel.name = 'Kumkumadi Serum'
+        self.gel.save()
+        self.assertEqual(search_product_ids('kumkumadi'), [self.gel.pk])
+        self.assertEqual(search_product_ids('aloe'), [])
+        self.category.name = 'Scalp Rituals'
+        self.category.save()
+        self.assertCountEqual(search_product_ids('scalp'), [self.shampoo.pk, self.oil.pk])
+        self.oil.delete()
+        self.assertEqual(search_product_ids('bhringraj'), [])
+
+    def test_rebuild_command(self):
+        get_search_backend().clear()
+        self.assertEqual(search_product_ids('neem'), [])
+        call_command('rebuild_search_index', stdout=StringIO())
+        self.assertEqual(search_product_ids('neem'), [self.shampoo.pk, self.oil.pk])
+
+    def test_listing_redirects_on_a_single_match(self):
+        response = self.client.get(reverse('store:products'), {'q': 'aloe'})
+        self.assertRedirects(response, reverse('store:product_detail', args=[self.gel.slug]))
+        response = self.client.get(reverse('store:products'), {'q': 'neem'})
+        self.assertEqual([p.pk for p in response.context['products']], [self.shampoo.pk, self.oil.pk])
+
+
+class ProductListingTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_user()
+        self.products = [
+            self.make_product(name='Neem Soap', price='80.00'),
+            self.make_product(name='Aloe Gel', price='150.00', sale_price='90.00'),
+            self.make_product(name='Rose Toner', price='120.00'),
+            self.make_product(name='Amla Oil', price='120.00'),
+            self.make_product(name='Ubtan Pack', price='200.00'),
+        ]
+        for product, ratings in zip(self.products, [[5], [3, 4], [], [5, 5], [1]]):
+            for rating in ratings:
+                Review.objects.create(product=product, user=self.user, rating=rating, comment=f'{rating} stars')
+
+    def walk(self, **params):
+        """Every product name, following next_cursor through two-product pages."""
+        names, url, params = [], reverse('store:products'), {'format': 'json', **params}
+        with mock.patch('store.views.PRODUCTS_PER_PAGE', 2):
+            while True:
+                page = self.client.get(url, params).json()
+                names += [p['name'] for p in page['products']]
+                if not page['next_cursor']:
+                    return names
+                params['cursor'] = page['next_cursor']
+
+    def test_every_sort_walks_the_catalog_once_in_order(self):
+        self.assertEqual(self.walk(), ['Ubtan Pack', 'Amla Oil', 'Rose Toner', 'Aloe Gel', 'Neem Soap'])
+        self.assertEqual(self.walk(sort='price'), ['Neem Soap', 'Aloe Gel', 'Rose Toner', 'Amla Oil', 'Ubtan Pack'])
+        self.assertEqual(self.walk(sort='price_desc'), ['Ubtan Pack', 'Amla Oil', 'Rose Toner', 'Aloe Gel', 'Neem Soap'])
+        self.assertEqual(self.walk(sort='rating'), ['Amla Oil', 'Neem Soap', 'Aloe Gel', 'Ubtan Pack', 'Rose Toner'])
+
+    def test_bad_cursor_starts_from_the_first_page(self):
+        response = self.client.get(reverse('store:products'), {'format': 'json', 'cursor': 'not-a-cursor'})
+        self.assertEqual(len(response.json()['products']), 5)
+
+    def test_tampered_cursor_starts_from_the_first_page(self):
+        for sort, values in [('newest', ['x']), ('price', ['abc', '1']), ('price', ['NaN', '1']), ('newest', ['9' * 30])]:
+            response = self.client.get(reverse('store:products'), {'format': 'json', 'sort': sort, 'cursor': encode_cursor(values)})
+            self.assertEqual(response.status_code, 200, values)
+            self.assertEqual(len(response.json()['products']), 5, values)
+
+    def test_only_the_latest_review_per_product_is_loaded(self):
+        self.client.get(reverse('store:products'), {'format': 'json'})
+        with self.assertNumQueries(PRODUCT_LIST_QUERIES):
+            page = self.client.get(reverse('store:products'), {'format': 'json'}).json()
+        reviews = {p['name']: p['latest_review'] for p in page['products']}
+        self.assertEqual(reviews['Aloe Gel'], {'rating': 4, 'comment': '4 stars'})
+        self.assertIsNone(reviews['Rose Toner'])
+
+    def test_htmx_requests_get_bare_cards_with_a_scroll_trigger(self):
+        with mock.patch('store.views.PRODUCTS_PER_PAGE', 2):
+            response = self.client.get(reverse('store:products'), {'sort': 'price'}, HTTP_HX_REQUEST='true')
+        self.assertTemplateUsed(response, 'store/partials/product_cards.html')
+        self.assertTemplateNotUsed(response, 'store/base.html')
+        self.assertContains(response, 'hx-trigger="revealed"')
+        self.assertContains(response, 'sort=price&amp;cursor=')
+
+
+class FacetTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        skin, hair = self.make_category(), self.make_category(name='Hair Care')
+        self.make_product(name='Neem Soap', category=skin, concern='acne', price='80.00')
+        self.make_product(name='Aloe Gel', category=skin, concern='hydration', price='600.00', sale_price='450.00')
+        self.make_product(name='Amla Oil', category=hair, concern='hair_fall', price='300.00', stock=0)
+        self.make_product(name='Hidden Mask', category=hair, is_available=False)
+
+    def browse(self, **params):
+        page = self.client.get(reverse('store:products'), {'format': 'json', **params}).json()
+        counts = {(f['name'], v['key']): v['count'] for f in page['facets']['facets'] for v in f['values']}
+        return sorted(p['name'] for p in page['products']), page['facets']['total'], counts
+
+    def test_values_or_within_a_facet_and_and_across_facets(self):
+        names, total, _ = self.browse(category=['skin-care', 'hair-care'])
+        self.assertEqual(names, ['Aloe Gel', 'Amla Oil', 'Neem Soap'])
+        names, total, _ = self.browse(category=['skin-care', 'hair-care'], price=['under-250', '250-500'])
+        self.assertEqual(names, ['Aloe Gel', 'Amla Oil', 'Neem Soap'])
+        names, total, _ = self.browse(category='skin-care', stock='in-stock', sale='on-sale')
+        self.assertEqual((names, total), (['Aloe Gel'], 1))
+        names, total, _ = self.browse(category='no-such-category')
+        self.assertEqual(total, 3)
+
+    def test_each_facet_is_counted_against_the_others(self):
+        _, total, counts = self.browse(category='skin-care')
+        self.assertEqual(total, 2)
+        # Ticking Hair Care as well would add the oil
+        self.assertEqual(counts['category', 'hair-care'], 1)
+        self.assertEqual(counts['concern', 'acne'], 1)
+        self.assertEqual(counts['concern', 'hair_fall'], 0)
+        self.assertEqual(counts['price', '250-500'], 1)
+        self.assertEqual(counts['rating', 'unrated'], 2)
+
+    def test_counts_follow_search_results(self):
+        _, total, counts = self.browse(q='oil soap')
+        self.assertEqual(total, 0)
+        _, total, counts = self.browse(q='skin')
+        self.assertEqual((total, counts['category', 'skin-care'], counts['category', 'hair-care']), (2, 2, 0))
+
+    def test_sidebar_is_free_when_warm_and_follows_reviews(self):
+        self.assertEqual(self.browse()[2]['rating', 'unrated'], 3)
+        Review.objects.create(product=Product.objects.get(name='Neem Soap'), user=self.make_user(), rating=5, comment='Clear skin')
+        _, _, counts = self.browse()
+        self.assertEqual((counts['rating', '4-up'], counts['rating', 'unrated']), (1, 2))
+        params = {'format': 'json', 'category': 'skin-care', 'concern': ['acne', 'hydration'], 'price': 'under-250'}
+        with self.assertNumQueries(PRODUCT_LIST_QUERIES):
+            self.client.get(reverse('store:products'), params)
+
+
+class InventoryTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_user()
+        self.gel = self.make_product(name='Aloe Gel', stock=5)
+        self.soap = self.make_product(name='Neem Soap', stock=3)
+        self.combo = ComboDeal.objects.create(
+            name='Glow Kit', description='Kit', original_price='250.00', discounted_price='199.00'
+        )
+        self.combo.products.set([self.gel, self.soap])
+        self.cart = Cart.objects.create(user=self.user)
+        self.client.force_login(self.user)
+
+    def stock(self):
+        return dict(Product.objects.values_list('name', 'stock'))
+
+    def place_cod_order(self):
+        return self.client.post(reverse('store:place_cod_order'), {
+            'first_name': 'Asha', 'last_name': 'Rao', 'email': 'asha@example.com',
+            'address': '1 MG Road', 'zipcode': '560001', 'city': 'Bengaluru',
+        })
+
+    def test_combo_lines_expand_into_their_products(self):
+        CartItem.objects.create(cart=self.cart, product=self.gel, quantity=2)
+        CartItem.objects.create(cart=self.cart, combo_deal=self.combo, quantity=1)
+        self.assertEqual(stock_requirements(self.cart.items.all()), {self.gel.pk: 3, self.soap.pk: 1})
+
+    def test_reservation_is_all_or_nothing(self):
+        # Savepoint, one UPDATE for every line, the sold-out check, release
+        with self.assertNumQueries(4):
+            reserve_stock({self.gel.pk: 2, self.soap.pk: 3})
+        self.assertEqual(self.stock(), {'Aloe Gel': 3, 'Neem Soap': 0})
+        with self.assertRaisesMessage(OutOfStock, 'Neem Soap (0 left)'):
+            reserve_stock({self.gel.pk: 1, self.soap.pk: 1})
+        self.assertEqual(self.stock(), {'Aloe Gel': 3, 'Neem Soap': 0})
+
+    def test_cod_orders_take_stock_for_products_and_combos(self):
+        CartItem.objects.create(cart=self.cart, product=self.soap, quantity=1)
+        CartItem.objects.create(cart=self.cart, combo_deal=self.combo, quantity=2)
+        self.assertEqual(self.place_cod_order().json()['status'], 'success')
+        self.assertEqual(self.stock(), {'Aloe Gel': 3, 'Neem Soap': 0})
+
+    def test_cod_orders_fail_cleanly_when_stock_runs_out(self):
+        CartItem.objects.create(cart=self.cart, product=self.gel, quantity=1)
+        CartItem.objects.create(cart=self.cart, combo_deal=self.combo, quantity=4)
+        response = self.place_cod_order()
+        self.assertEqual(response.status_code, 409)
+        self.assertIn('Neem Soap (3 left)', response.json()['message'])
+        self.assertEqual(self.stock(), {'Aloe Gel': 5, 'Neem Soap': 3})
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(self.cart.items.count(), 2)
+
+
+class OrderPlacementTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_user()
+        self.cart = Cart.objects.create(user=self.user)
+        self.combo = ComboDeal.objects.create(
+            name='Glow Kit', description='Kit', original_price='250.00', discounted_price='199.00'
+        )
+        self.combo.products.set([self.make_product(name='Kit Gel', stock=100), self.make_product(name='Kit Soap', stock=100)])
+
+    def fill_cart(self, lines):
+        for i in range(lines - 1):
+            product = self.make_product(name=f'Product {lines}.{i}', stock=5)
+            CartItem.objects.create(cart=self.cart, product=product, quantity=2, unit_price='10.00' if i % 2 else None)
+        CartItem.objects.create(cart=self.cart, combo_deal=self.combo, quantity=3)
+        return self.cart.items.select_related('product', 'combo_deal')
+
+    def test_query_count_does_not_grow_with_the_cart(self):
+        items = list(self.fill_cart(3))
+        with CaptureQueriesContext(connection) as small:
+            place_order(self.user, items, first_name='Asha', paid_amount='1.00')
+        items = list(self.fill_cart(30))
+        with self.assertNumQueries(len(small)):
+            order = place_order(self.user, items, first_name='Asha', paid_amount='1.00')
+        self.assertEqual(order.items.count(), 30)
+        self.assertFalse(self.cart.items.exists())
+
+    def test_lines_are_priced_like_the_cart(self):
+        items = list(self.fill_cart(3))
+        order = place_order(self.user, items, first_name='Asha', paid_amount='1.00')
+        prices = {(i.product.name if i.product else i.combo_deal.name): i.price for i in order.items.select_related('product', 'combo_deal')}
+        self.assertEqual(prices, {'Product 3.0': Decimal('100.00'), 'Product 3.1': Decimal('10.00'), 'Glow Kit': Decimal('199.00')})
+        self.assertEqual(Product.objects.get(name='Kit Gel').stock, 97)
+
+
+class InventoryConcurrencyTests(TransactionTestCase):
+    def test_concurrent_checkouts_never_oversell(self):
+        category = Category.objects.create(name='Skin Care')
+        gel = Product.objects.create(name='Aloe Gel', category=category, description='Gel', price='100.00', stock=10)
+        soap = Product.objects.create(name='Neem Soap', category=category, description='Soap', price='80.00', stock=40)
+        outcomes = []
+        start = threading.Barrier(30)
+
+        def checkout(needed):
+            start.wait()
+            try:
+                reserve_stock(needed)
+                outcomes.append(('reserved', needed))
+            except OutOfStock:
+                outcomes.append(('out of stock', needed))
+            finally:
+                close_old_connections()
+                connection.close()
+
+        # Every thread wants one gel, half of them bundled with a soap as a combo would
+        threads = [
+            threading.Thread(target=checkout, args=({gel.pk: 1, soap.pk: 1} if i % 2 else {gel.pk: 1},))
+            for i in range(30)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        gel.refresh_from_db()
+        soap.refresh_from_db()
+        reserved = [needed for outcome, needed in outcomes if outcome == 'reserved']
+        self.assertEqual((len(reserved), len(outcomes)), (10, 30))
+        self.assertEqual(gel.stock, 0)
+        self.assertEqual(soap.stock, 40 - sum(1 for needed in reserved if soap.pk in needed))
+
+
+class SuggestTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.category = self.make_category(name='Hair Care')
+        self.oil = self.make_product(name='Bhringraj Hair Oil', category=self.category)
+        self.mask = self.make_product(name='Hibiscus Hair Mask', category=self.category)
+        self.gel = self.make_product(name='Aloe Gel')
+
+    def suggest(self, q, **params):
+        return self.client.get(reverse('store:product_suggest'), {'q': q, **params}).json()
+
+    def test_whole_name_and_word_prefixes(self):
+        result = self.suggest('ha')
+        self.assertEqual([c['name'] for c in result['categories']], ['Hair Care'])
+        self.assertEqual(result['categories'][0]['url'], '/products/?category=hair-care')
+        self.assertEqual([p['name'] for p in result['products']], ['Bhringraj Hair Oil', 'Hibiscus Hair Mask'])
+        result = self.suggest('hair m')
+        self.assertEqual(result['products'], [{'name': 'Hibiscus Hair Mask', 'url': '/products/hibiscus-hair-mask/'}])
+        self.assertEqual(self.suggest('gel', limit=1)['products'][0]['name'], 'Aloe Gel')
+
+    def test_warm_keystrokes_never_query(self):
+        self.suggest('al')
+        with self.assertNumQueries(0):
+            self.assertEqual(len(self.suggest('alo')['products']), 1)
+
+    def test_catalog_changes_rebuild_the_index(self):
+        self.assertEqual(self.suggest('kumk')['products'], [])
+        self.make_product(name='Kumkumadi Tailam')
+        self.assertEqual(self.suggest('kumk')['products'][0]['name'], 'Kumkumadi Tailam')
+        self.gel.is_available = False
+        self.gel.save()
+        self.assertEqual(self.suggest('aloe')['products'], [])
+
+
+class PaymentGatewayTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = FakeRazorpayServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.server.requests.clear()
+        self.server.fail_next = 0
+        self.server.delay = 0
+        self.now = 0
+        self.sleeps = []
+        self.gateway = PaymentGateway(
+            'rzp_test', 'secret', base_url=self.server.base_url, connect_timeout=1, read_timeout=0.2,
+            max_retries=2, breaker=CircuitBreaker(threshold=3, reset_after=30, clock=lambda: self.now),
+            sleep=self.sleeps.append,
+        )
+
+    def test_calls_share_one_keep_alive_connection(self):
+        order = self.gateway.create_order(19900)
+        self.assertEqual(self.gateway.fetch_order(order['id'])['amount'], 19900)
+        self.assertEqual(len({port for _, _, port in self.server.requests}), 1)
+
+    def test_fetches_retry_with_jittered_backoff(self):
+        order = self.gateway.create_order(19900)
+        self.server.fail_next = 2
+        self.assertEqual(self.gateway.fetch_order(order['id'])['id'], order['id'])
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertEqual(len(self.sleeps), 2)
+        self.assertTrue(0 <= self.sleeps[0] <= 0.2 and 0 <= self.sleeps[1] <= 0.4)
+
+    def test_order_creation_is_not_retried_after_reaching_the_gateway(self):
+        self.server.fail_next = 1
+        with self.assertRaises(GatewayUnavailable):
+            self.gateway.create_order(19900)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_slow_gateway_times_out(self):
+        self.server.delay = 0.5
+        with self.assertRaises(GatewayUnavailable):
+            self.gateway.create_order(19900)
+
+    def test_breaker_fails_fast_then_lets_a_trial_through(self):
+        self.server.fail_next = 100
+        for _ in range(3):
+            with self.assertRaises(GatewayUnavailable):
+                self.gateway.create_order(19900)
+        with self.assertRaises(GatewayUnavailable):
+            self.gateway.create_order(19900)
+        self.assertEqual(len(self.server.requests), 3)
+        self.now = 31
+        self.server.fail_next = 0
+        self.assertEqual(self.gateway.create_order(19900)['status'], 'created')
+        self.assertEqual(self.gateway.breaker.state, 'closed')
+
+    def test_rejected_requests_do_not_trip_the_breaker(self):
+        for _ in range(5):
+            with self.assertRaises(razorpay.errors.BadRequestError):
+                self.gateway.fetch_order('order_missing')
+        self.assertEqual(self.gateway.breaker.state, 'closed')
+
+
+class CheckoutGatewayTests(StoreTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = FakeRazorpayServer().start()
+        cls.enterClassContext(override_settings(RAZORPAY_BASE_URL=cls.server.base_url, RAZORPAY_BREAKER_THRESHOLD=1))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        reset_gateway()
+        self.addCleanup(reset_gateway)
+        self.server.requests.clear()
+        self.server.fail_next = 0
+        self.user = self.make_user()
+        self.cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=self.cart, product=self.make_product(), quantity=2)
+        self.client.force_login(self.user)
+
+    def test_checkout_creates_the_gateway_order_through_the_adapter(self):
+        response = self.client.get(reverse('store:checkout'))
+        self.assertEqual(response.status_code, 200)
+        self.cart.refresh_from_db()
+        self.assertEqual(self.server.orders[self.cart.razorpay_order_id]['amount'], 20000)
+
+    def test_reloading_checkout_reuses_the_gateway_order(self):
+        self.client.get(reverse('store:checkout'))
+        self.client.get(reverse('store:checkout'))
+        self.assertEqual(len(self.server.requests), 1)
+        first = Cart.objects.get(pk=self.cart.pk).razorpay_order_id
+        self.assertContains(self.client.get(reverse('store:checkout')), first)
+
+    def test_changing_the_cart_creates_a_new_gateway_order(self):
+        self.client.get(reverse('store:checkout'))
+        first = Cart.objects.get(pk=self.cart.pk).razorpay_order_id
+        CartItem.objects.filter(cart=self.cart).update(quantity=3)
+        self.client.get(reverse('store:checkout'))
+        cart = Cart.objects.get(pk=self.cart.pk)
+        self.assertNotEqual(cart.razorpay_order_id, first)
+        self.assertEqual(self.server.orders[cart.razorpay_order_id]['amount'], 30000)
+
+    def test_gateway_order_is_for_the_discounted_total(self):
+        Coupon.objects.create(code='SAVE10', discount_percentage=10)
+        self.client.get(reverse('store:checkout'), {'coupon': ' save10 '})
+        response = self.client.get(reverse('store:checkout'))
+        self.assertEqual(response.context['final_amount'], Decimal('180.00'))
+        cart = Cart.objects.get(pk=self.cart.pk)
+        self.assertEqual(self.server.orders[cart.razorpay_order_id]['amount'], 18000)
+
+    def pay(self, order_id='order_1', payment_id='pay_1'):
+        signature = hmac.new(settings.RP_KEY_SECRET.encode(), f'{order_id}|{payment_id}'.encode(), hashlib.sha256).hexdigest()
+        return self.client.post(reverse('store:checkout'), {
+            'first_name': 'Asha', 'last_name': 'Rao', 'email': 'a@example.com',
+            'address': '1 MG Road', 'zipcode': '411001', 'city': 'Pune',
+            'razorpay_order_id': order_id, 'razorpay_payment_id': payment_id, 'razorpay_signature': signature,
+        })
+
+    def test_a_forged_payment_is_refused(self):
+        with mock.patch('store.views.get_gateway') as gateway:
+            gateway().verify_payment_signature.side_effect = razorpay.errors.SignatureVerificationError('mismatch')
+            response = self.pay()
+        self.assertEqual(response.json(), {'status': 'failure', 'message': 'Invalid signature'})
+        self.assertFalse(Order.objects.exists())
+
+    def test_paid_checkout_is_backordered_when_stock_ran_out(self):
+        Product.objects.update(stock=1)
+        staff = self.make_user('boss')
+        CustomUser.objects.filter(pk=staff.pk).update(is_staff=True)
+        self.assertEqual(self.pay().json(), {'status': 'success'})
+        order = Order.objects.get()
+        self.assertEqual((order.status, order.razorpay_payment_id), ('backordered', 'pay_1'))
+        self.assertEqual(order.items.get().quantity, 2)
+        self.assertEqual(Product.objects.get().stock, 1)
+        self.assertTrue(Task.objects.filter(name=send_backorder_alert.task_name).exists())
+        run_pending()
+        alert = mail.outbox[-1]
+        self.assertEqual((alert.subject, alert.to), (f'Order #{order.pk} is paid but backordered', ['boss@example.com']))
+
+    def test_razorpay_orders_are_placed_once(self):
+        Order.objects.create(user=self.user, razorpay_order_id='order_1')
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Order.objects.create(user=self.user, razorpay_order_id='order_1')
+        Order.objects.create(user=self.user)
+        Order.objects.create(user=self.user)
+        # The webhook placed it after this callback looked
+        with mock.patch('django.db.models.QuerySet.exists', return_value=False):
+            self.assertEqual(self.pay().json(), {'status': 'success'})
+        self.assertEqual(Order.objects.filter(razorpay_order_id='order_1').count(), 1)
+        self.assertEqual(Product.objects.get().stock, 10)
+
+    def test_checkout_fails_fast_while_the_gateway_is_down(self):
+        self.server.fail_next = 1
+        self.assertRedirects(self.client.get(reverse('store:checkout')), reverse('store:cart'))
+        requests_made = len(self.server.requests)
+        self.assertRedirects(self.client.get(reverse('store:checkout')), reverse('store:cart'))
+        self.assertEqual(len(self.server.requests), requests_made)
+
+
+@override_settings(RAZORPAY_WEBHOOK_SECRET='whsec_test')
+class PaymentWebhookTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_user()
+        self.product = self.make_product(stock=5)
+        self.cart = Cart.objects.create(user=self.user, razorpay_order_id='order_1', razorpay_order_key='k')
+        CartItem.objects.create(cart=self.cart, product=self.product, quantity=2)
+
+    def deliver(self, event, event_id='evt_1', secret='whsec_test', order_id='order_1', notes=None):
+        body = json.dumps({
+            'event': event,
+            'payload': {'payment': {'entity': {
+                'id': 'pay_1', 'order_id': order_id, 'amount': 20000, 'status': event.split('.')[1],
+                'notes': {
+                    'first_name': 'Asha', 'last_name': 'Rao', 'address': '1 MG Road', 'city': 'Pune', 'zipcode': '411001',
+                    **(notes or {}),
+                },
+            }}},
+        }).encode()
+        signature = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+        return self.client.post(
+            reverse('store:razorpay_webhook'), body, content_type='application/json',
+            headers={'X-Razorpay-Signature': signature, 'X-Razorpay-Event-Id': event_id},
+        )
+
+    def test_unsigned_delivery_is_rejected(self):
+        self.assertEqual(self.deliver('payment.captured', secret='wrong').status_code, 400)
+        self.assertFalse(PaymentEvent.objects.exists())
+
+    def test_redelivered_event_is_stored_once(self):
+        for _ in range(2):
+            self.assertEqual(self.deliver('payment.captured').status_code, 200)
+        self.assertEqual(PaymentEvent.objects.count(), 1)
+        self.assertFalse(Order.objects.exists())
+
+    def test_capture_places_the_order_when_the_browser_never_reported_back(self):
+        self.deliver('payment.captured')
+        self.deliver('payment.captured', event_id='evt_2')
+        self.assertEqual(process_pending(), (2, 0))
+        order = Order.objects.get()
+        self.assertEqual((order.payment_status, order.razorpay_payment_status), ('paid', 'captured'))
+        self.assertEqual((order.first_name, order.city, order.paid_amount), ('Asha', 'Pune', Decimal('200')))
+        self.assertEqual(order.items.get().quantity, 2)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 3)
+        self.assertFalse(self.cart.items.exists())
+
+    def test_capture_prices_the_order_with_the_coupon_from_the_notes(self):
+        Coupon.objects.create(code='SAVE10', discount_percentage=10)
+        self.deliver('payment.captured', notes={'coupon': 'save10'})
+        process_pending()
+        order = Order.objects.get()
+        self.assertEqual(
+            (order.subtotal, order.discount_amount, order.shipping_charge, order.paid_amount, order.coupon),
+            (Decimal('200.00'), Decimal('20.00'), Decimal('0.00'), Decimal('200'), 'SAVE10'),
+        )
+
+    def test_capture_after_stock_ran_out_backorders_the_order(self):
+        Product.objects.filter(pk=self.product.pk).update(stock=1)
+        self.deliver('payment.captured')
+        self.assertEqual(process_pending(), (1, 0))
+        self.assertEqual(Order.objects.get().status, 'backordered')
+        self.assertEqual(Product.objects.get(pk=self.product.pk).stock, 1)
+        self.assertTrue(PaymentEvent.objects.get().processed_at)
+
+    def test_capture_marks_an_existing_order_paid(self):
+        Order.objects.create(user=self.user, razorpay_order_id='order_1')
+        self.deliver('payment.captured')
+        process_pending()
+        self.assertEqual(Order.objects.get().payment_status, 'paid')
+        self.assertTrue(self.cart.items.exists())
+
+    def test_capture_losing_the_race_to_the_browser_marks_its_order_paid(self):
+        self.deliver('payment.captured')
+        Order.objects.create(user=self.user, razorpay_order_id='order_1')
+        # As if the browser's insert landed after the webhook looked for it
+        with mock.patch('django.db.models.QuerySet.exists', return_value=False):
+            self.assertEqual(process_pending(), (1, 0))
+        self.assertEqual(Order.objects.get().payment_status, 'paid')
+        self.assertEqual(Product.objects.get(pk=self.product.pk).stock, 5)
+
+    @override_settings(PAYMENT_EVENT_MAX_ATTEMPTS=2)
+    def test_an_event_that_keeps_failing_is_marked_failed(self):
+        self.deliver('payment.captured', order_id='order_missing')
+        self.assertEqual(process_pending(), (0, 1))
+        self.assertIsNone(PaymentEvent.objects.get().failed_at)
+        self.assertEqual(process_pending(), (0, 1))
+        self.assertEqual(process_pending(), (0, 0))
+        event = PaymentEvent.objects.get()
+        self.assertEqual(event.attempts, 2)
+        self.assertIsNotNone(event.failed_at)
+
+    def test_failed_payment_is_recorded_and_unknown_orders_are_kept_for_retry(self):
+        Order.objects.create(user=self.user, razorpay_order_id='order_1')
+        self.deliver('payment.failed')
+        self.deliver('payment.captured', event_id='evt_2', order_id='order_missing')
+        self.assertEqual(process_pending(), (1, 1))
+        self.assertEqual(Order.objects.get().payment_status, 'failed')
+        pending = PaymentEvent.objects.get(processed_at__isnull=True)
+        self.assertEqual((pending.attempts, pending.last_error), (1, 'No cart or order for order_missing'))
+
+
+flaky_calls = []
+
+
+@task(max_attempts=2)
+def flaky(fail=True):
+    flaky_calls.append(fail)
+    if fail:
+        raise ConnectionError('SMTP down')
+
+
+@override_settings(TASK_RETRY_BASE=30)
+class TaskQueueTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        flaky_calls.clear()
+
+    def test_placing_an_order_queues_its_confirmation(self):
+        user = self.make_user()
+        cart = Cart.objects.create(user=user)
+        CartItem.objects.create(cart=cart, product=self.make_product(), quantity=2)
+        # Creating the product queued a navigation warmup
+        self.assertEqual(run_pending(), ['done'])
+        order = place_order(user, cart.items.select_related('product', 'combo_deal'), email='buyer@example.com')
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(run_pending(), ['done'])
+        self.assertEqual(mail.outbox[0].subject, f'Order #{order.pk} confirmed')
+        self.assertIn('2 × Aloe Gel', mail.outbox[0].body)
+
+    def test_cancellation_email_is_sent_by_the_worker(self):
+        user = self.make_user()
+        order = Order.objects.create(user=user, status='processing')
+        self.client.force_login(user)
+        response = self.client.post(reverse('store:cancel_order_request', args=[order.pk]), {'reason': 'Ordered twice'})
+        self.assertRedirects(response, f'/cancel-order/{order.pk}/confirmed/', fetch_redirect_response=False)
+        self.assertEqual(len(mail.outbox), 0)
+        run_pending()
+        self.assertEqual(mail.outbox[0].to, ['buyer@example.com'])
+
+    def test_photos_are_uploaded_by_the_worker(self):
+        user = self.make_user()
+        product = self.make_product()
+        self.client.force_login(user)
+        photo = SimpleUploadedFile('glow.gif', b'GIF89a\x01\x00\x01\x00\x00\x00\x00;', content_type='image/gif')
+        self.client.post(reverse('store:product_detail', args=[product.slug]), {
+            'action': 'add_review', 'rating': '5', 'comment': 'Lovely', 'photo': photo,
+        })
+        review = Review.objects.get()
+        self.assertFalse(review.photo)
+        with TemporaryDirectory() as media, self.settings(MEDIA_ROOT=media):
+            run_pending()
+            review.refresh_from_db()
+            self.assertTrue(review.photo.name.startswith('reviews/glow'))
+            self.assertEqual(review.photo.read(), b'GIF89a\x01\x00\x01\x00\x00\x00\x00;')
+            review.photo.close()
+        self.assertFalse(StagedUpload.objects.exists())
+
+    def test_navigation_changes_queue_one_cache_warmup(self):
+        Task.objects.all().delete()
+        Offer.objects.create(title='Free shipping')
+        Offer.objects.create(title='Flat 10% off')
+        self.assertEqual(Task.objects.filter(name=warm_navigation_cache.task_name).count(), 1)
+
+    def test_failures_back_off_then_go_dead(self):
+        queued = flaky.delay()
+        with self.assertLogs('store.tasks', 'ERROR'):
+            self.assertEqual(run_pending(), ['queued'])
+        queued.refresh_from_db()
+        self.assertEqual(queued.attempts, 1)
+        self.assertIn('SMTP down', queued.last_error)
+        self.assertTrue(timezone.now() + timedelta(seconds=14) < queued.run_at <= timezone.now() + timedelta(seconds=30))
+        self.assertEqual(run_pending(), [])
+        Task.objects.filter(pk=queued.pk).update(run_at=timezone.now())
+        with self.assertLogs('store.tasks', 'ERROR'):
+            self.assertEqual(run_pending(), ['dead'])
+        self.assertEqual(len(flaky_calls), 2)
+
+    def test_a_claimed_task_is_not_handed_out_again_until_its_lock_expires(self):
+        queued = flaky.delay(fail=False)
+        self.assertEqual(len(claim(10, worker='a')), 1)
+        self.assertEqual(claim(10, worker='b'), [])
+        Task.objects.filter(pk=queued.pk).update(locked_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual([t.locked_by for t in claim(10, worker='b')], ['b'])
+
+
+class TaskWorkerThreadTests(TransactionTestCase):
+    def test_thread_pool_runs_every_task_once(self):
+        for i in range(12):
+            send_email.delay(subject=f'Note {i}', message='hi', recipient_list=['a@example.com'])
+        statuses = run_pending(limit=50, threads=4)
+        self.assertEqual(statuses, ['done'] * 12)
+        self.assertEqual(sorted(m.subject for m in mail.outbox), sorted(f'Note {i}' for i in range(12)))
+        self.assertEqual(Task.objects.filter(status=Task.DONE).count(), 12)
+
+
+class PricingTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_user()
+        self.cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=self.cart, product=self.make_product(price='199.99'), quantity=3)
+        self.items = self.cart.items.select_related('product', 'combo_deal')
+
+    def test_coupons_match_normalized_codes_from_memory(self):
+        Coupon.objects.create(code='Monsoon15', discount_percentage=15)
+        find_coupon('warm-up')
+        with self.assertNumQueries(0):
+            self.assertEqual(find_coupon('  MONSOON15 ').code, 'Monsoon15')
+
+    def test_coupon_validity_window_and_deactivation(self):
+        now = timezone.now()
+        Coupon.objects.create(code='OLD', discount_percentage=10, valid_to=now - timedelta(days=1))
+        Coupon.objects.create(code='SOON', discount_percentage=10, valid_from=now + timedelta(days=1))
+        live = Coupon.objects.create(code='LIVE', discount_percentage=10, valid_to=now + timedelta(days=1))
+        self.assertEqual([find_coupon(code) for code in ('OLD', 'SOON')], [None, None])
+        self.assertIsNotNone(find_coupon('live'))
+        live.active = False
+        live.save()
+        self.assertIsNone(find_coupon('live'))
+
+    def test_coupon_book_is_reloaded_once_it_is_too_old(self):
+        find_coupon('warm-up')
+        # Created without the signal, as if the version bump was lost with the cache
+        Coupon.objects.bulk_create([Coupon(code='FLASH', discount_percentage=20)])
+        self.assertIsNone(find_coupon('flash'))
+        with mock.patch('store.pricing.time.monotonic', return_value=time.monotonic() + settings.COUPON_BOOK_TTL + 1):
+            self.assertEqual(find_coupon('flash').code, 'FLASH')
+
+    def test_quote_breakdown(self):
+        Coupon.objects.create(code='SAVE10', discount_percentage=10)
+        online = quote(self.items, 'save10')
+        self.assertEqual(online[:4], (Decimal('599.97'), Decimal('60.00'), Decimal('0.00'), Decimal('539.97')))
+        self.assertEqual(online.amount_in_paise, 53997)
+        self.assertEqual(quote(self.items, 'save10', 'cod').total, Decimal('589.97'))
+        self.assertEqual(quote(self.items, 'nope').total, Decimal('599.97'))
+
+    def test_cash_on_delivery_charges_the_same_quote_and_stores_it(self):
+        Coupon.objects.create(code='SAVE10', discount_percentage=10)
+        self.client.force_login(self.user)
+        session = self.client.session
+        session['coupon_code'] = 'SAVE10'
+        session.save()
+        response = self.client.post(reverse('store:place_cod_order'), {
+            'first_name': 'Asha', 'last_name': 'Rao', 'email': 'a@example.com',
+            'address': '1 MG Road', 'zipcode': '411001', 'city': 'Pune',
+        })
+        self.assertEqual(response.json()['status'], 'success')
+        order = Order.objects.get()
+        self.assertEqual(
+            (order.subtotal, order.discount_amount, order.shipping_charge, order.paid_amount, order.coupon),
+            (Decimal('599.97'), Decimal('60.00'), Decimal('50.00'), Decimal('589.97'), 'SAVE10'),
+        )
+
+
+class OrderAdminTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.admin = CustomUser.objects.create_superuser('admin', 'admin@example.com', 'pass12345')
+        self.client.force_login(self.admin)
+        self.product = self.make_product()
+        self.combo = ComboDeal.objects.create(
+            name='Glow Kit', description='Kit', original_price='250.00', discounted_price='199.00'
+        )
+
+    def add_orders(self, count):
+        customers = CustomUser.objects.bulk_create([
+            CustomUser(username=f'customer{Order.objects.count() + i}') for i in range(count)
+        ])
+        orders = Order.objects.bulk_create([Order(user=user, first_name=user.username) for user in customers])
+        OrderItem.objects.bulk_create([
+            item
+            for order in orders
+            for item in (
+                OrderItem(order=order, product=self.product, price='100.00', quantity=2),
+                OrderItem(order=order, combo_deal=self.combo, price='199.00', quantity=1),
+            )
+        ])
+
+    def changelist_queries(self):
+        # Warm up first, so the session has settled
+        self.assertContains(self.client.get(reverse('admin:store_order_changelist')), 'Aloe Gel (x2), Glow Kit (x1)')
+        reset_queries()
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse('admin:store_order_changelist'))
+            return len(ctx)
+
+    def test_changelist_query_count_does_not_grow_with_orders(self):
+        self.add_orders(100)
+        self.assertEqual(self.changelist_queries(), ORDER_CHANGELIST_QUERIES)
+        self.add_orders(900)
+        self.assertEqual(self.changelist_queries(), ORDER_CHANGELIST_QUERIES)
+
+    def test_change_page_loads_items_in_one_query(self):
+        self.add_orders(1)
+        order = Order.objects.get()
+        response = self.client.get(reverse('admin:store_order_change', args=[order.pk]))
+        self.assertContains(response, 'Glow Kit')
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse('admin:store_order_change', args=[order.pk]))
+            queries = len(ctx)
+        self.add_orders(1)
+        OrderItem.objects.bulk_create([OrderItem(order=order, product=self.product, price='1.00') for _ in range(20)])
+        with self.assertNumQueries(queries):
+            self.client.get(reverse('admin:store_order_change', args=[order.pk]))
+
+
+@skipUnless(connection.vendor == 'sqlite', 'Reads SQLite query plans')
+class HotQueryIndexTests(StoreTestCase):
+    """Each hot lookup in the views should be answered from an index, not a table scan."""
+
+    def assertUsesIndex(self, queryset, index):
+        plan = queryset.explain()
+        # A SCAN of a partial index only visits the rows it covers, in index order
+        self.assertRegex(plan, rf'(SEARCH|SCAN) \S+ USING (COVERING )?INDEX {index}\b', plan)
+        self.assertNotIn('USE TEMP B-TREE', plan)
+
+    def test_hot_queries_use_their_indexes(self):
+        cases = [
+            (Product.objects.filter(is_available=True).order_by('-id')[:24], 'product_available_idx'),
+            (Product.objects.filter(is_available=True, concern__in=['acne', 'dry_skin']), 'product_concern_idx'),
+            (Review.objects.filter(product_id=1, is_approved=True).order_by('-created_at', '-pk')[:6],
+             'review_product_visible_idx'),
+            (Product.objects.filter(is_available=True).annotate(
+                latest_review_id=latest_review_id(product=OuterRef('pk'))).order_by('-id')[:24],
+             'review_product_visible_idx'),
+            (Order.objects.filter(razorpay_order_id='order_1'), 'order_razorpay_order_unique'),
+            (Order.objects.filter(status='processing').order_by('-created_at')[:100], 'order_status_created_idx'),
+            (CartItem.objects.filter(cart_id=1, product_id=2), 'cartitem_unique_product'),
+            (CartItem.objects.filter(cart_id=1, combo_deal_id=2), 'cartitem_unique_combo'),
+            (Coupon.objects.alias(normalized=Lower('code')).filter(normalized='save10'), 'coupon_code_ci_unique'),
+        ]
+        for queryset, index in cases:
+            with self.subTest(index=index):
+                self.assertUsesIndex(queryset, index)
+
+    def test_cart_lines_and_coupon_codes_are_unique(self):
+        cart = Cart.objects.create(user=self.make_user())
+        product = self.make_product()
+        CartItem.objects.create(cart=cart, product=product)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            CartItem.objects.create(cart=cart, product=product)
+        Coupon.objects.create(code='SAVE10', discount_percentage=10)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Coupon.objects.create(code='save10', discount_percentage=20)
+
+    def test_adding_a_product_again_raises_its_quantity(self):
+        user = self.make_user()
+        product = self.make_product()
+        self.client.force_login(user)
+        for quantity in (1, 2):
+            self.client.post(reverse('store:add_to_cart', args=[product.slug]), {'quantity': quantity})
+        self.assertEqual(list(CartItem.objects.values_list('quantity', flat=True)), [3])
+
+
+class CartServiceTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_user()
+        self.product = self.make_product()
+        self.combo = ComboDeal.objects.create(
+            name='Glow Kit', description='Kit', original_price='250.00', discounted_price='199.00'
+        )
+
+    def lines(self, cart):
+        return set(cart.items.values_list('product_id', 'combo_deal_id', 'quantity'))
+
+    def test_adding_is_one_statement_and_never_duplicates_a_line(self):
+        cart = active_cart(self.user)
+        for quantity in (1, 2):
+            with self.assertNumQueries(1):
+                add_line(cart, product=self.product, quantity=quantity)
+        add_line(cart, combo_deal=self.combo)
+        add_line(cart, combo_deal=self.combo)
+        self.assertEqual(self.lines(cart), {(None, self.combo.pk, 2), (self.product.pk, None, 3)})
+
+    def test_each_user_has_one_active_cart(self):
+        paid = Cart.objects.create(user=self.user, is_paid=True)
+        cart = active_cart(self.user)
+        self.assertNotEqual(cart, paid)
+        self.assertEqual(active_cart(self.user), cart)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Cart.objects.create(user=self.user)
+
+    def test_guest_cart_is_merged_on_login(self):
+        add_line(active_cart(self.user), product=self.product)
+        self.client.post(reverse('store:add_to_cart', args=[self.product.slug]), {'quantity': 2})
+        guest = Cart.objects.get(user__isnull=True)
+        add_line(guest, combo_deal=self.combo)
+        self.assertEqual(self.client.get(reverse('store:cart')).context['items'].count(), 2)
+
+        self.client.login(username='buyer', password='pass12345')
+        cart = active_cart(self.user)
+        self.assertEqual(self.lines(cart), {(None, self.combo.pk, 1), (self.product.pk, None, 3)})
+        self.assertFalse(Cart.objects.filter(pk=guest.pk).exists())
+        self.assertEqual(self.client.session['cart_summary']['count'], 4)
+
+    def test_visitors_only_change_their_own_lines(self):
+        add_line(active_cart(self.user), product=self.product)
+        line = CartItem.objects.get()
+        response = self.client.post(reverse('store:remove_from_cart', args=[line.pk]))
+        self.assertEqual(response.status_code, 404)
+        self.client.post(reverse('store:add_to_cart', args=[self.product.slug]))
+        own = CartItem.objects.get(cart__user__isnull=True)
+        self.client.post(reverse('store:update_cart', args=[own.pk]), {'action': 'increase'})
+        own.refresh_from_db()
+        self.assertEqual(own.quantity, 2)
+        self.client.post(reverse('store:remove_from_cart', args=[own.pk]))
+        self.assertEqual(CartItem.objects.count(), 1)
+
+    def test_cart_buttons_change_the_stored_quantity(self):
+        self.client.post(reverse('store:add_to_cart', args=[self.product.slug]))
+        line = CartItem.objects.get()
+
+        def other_tab_adds_two(cart, version=None):
+            # Lands after the view has loaded the line at quantity 1
+            CartItem.objects.filter(pk=line.pk).update(quantity=3)
+            return changing(cart, version)
+
+        with mock.patch('store.views.changing', side_effect=other_tab_adds_two):
+            self.client.post(reverse('store:update_cart', args=[line.pk]), {'action': 'decrease'})
+        line.refresh_from_db()
+        self.assertEqual(line.quantity, 2)
+        self.client.post(reverse('store:update_cart', args=[line.pk]), {'action': 'increase'})
+        line.refresh_from_db()
+        self.assertEqual(line.quantity, 3)
+        for _ in range(3):
+            self.client.post(reverse('store:update_cart', args=[line.pk]), {'action': 'decrease'})
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_reorder_adds_the_order_lines_to_the_cart(self):
+        order = Order.objects.create(user=self.user)
+        OrderItem.objects.create(order=order, product=self.product, price='100.00', quantity=2)
+        OrderItem.objects.create(order=order, combo_deal=self.combo, price='199.00', quantity=1)
+        self.client.force_login(self.user)
+        self.client.post(reverse('store:reorder', args=[order.pk]))
+        self.assertEqual(self.lines(active_cart(self.user)), {(None, self.combo.pk, 1), (self.product.pk, None, 2)})
+
+
+class CartApiTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = self.make_product(price='120.00')
+        self.other = self.make_product(name='Neem Soap', price='40.00')
+
+    def add(self, product, **data):
+        return self.client.post(reverse('store:cart_api_add'), {'product': product.slug, **data})
+
+    def test_add_returns_the_line_subtotal_and_badge_count(self):
+        self.add(self.other)
+        data = self.add(self.product, quantity=2).json()
+        self.assertEqual(data['status'], 'success')
+        self.assertEqual(data['line']['quantity'], 2)
+        self.assertEqual(data['line']['line_total'], '240.00')
+        self.assertEqual((data['count'], data['subtotal'], data['version']), (3, '280.00', 2))
+        self.assertEqual(self.client.session['cart_summary'], {'count': 3, 'subtotal': '280.00', 'version': 2})
+
+        summary = self.client.get(reverse('store:cart_api')).json()
+        self.assertEqual([line['quantity'] for line in summary['lines']], [1, 2])
+        self.assertEqual(summary['version'], 2)
+
+    def test_set_quantity_and_remove(self):
+        line_id = self.add(self.product).json()['line']['id']
+        url = reverse('store:cart_api_set_quantity', args=[line_id])
+        data = self.client.post(url, {'quantity': 5, 'version': 1}).json()
+        self.assertEqual((data['line']['quantity'], data['subtotal'], data['version']), (5, '600.00', 2))
+        data = self.client.post(reverse('store:cart_api_remove', args=[line_id]), {'version': 2}).json()
+        self.assertEqual((data['line'], data['count'], data['subtotal']), (None, 0, '0.00'))
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_a_stale_version_is_refused_with_the_current_cart(self):
+        line_id = self.add(self.product).json()['line']['id']
+        self.add(self.other)
+        response = self.client.post(reverse('store:cart_api_set_quantity', args=[line_id]), {'quantity': 3, 'version': 1})
+        self.assertEqual(response.status_code, 409)
+        data = response.json()
+        self.assertEqual((data['status'], data['version'], data['count']), ('conflict', 2, 2))
+        self.assertEqual(CartItem.objects.get(pk=line_id).quantity, 1)
+
+    def test_form_posts_move_the_version_too(self):
+        line_id = self.add(self.product).json()['line']['id']
+        self.client.post(reverse('store:update_cart', args=[line_id]), {'action': 'increase'})
+        self.assertEqual(Cart.objects.get().version, 2)
+
+    def test_bad_requests(self):
+        self.assertEqual(self.add(self.product, quantity='x').status_code, 400)
+        self.assertEqual(self.client.post(reverse('store:cart_api_add'), {'product': 'nope'}).status_code, 404)
+        line_id = self.add(self.product).json()['line']['id']
+        self.assertEqual(self.client.get(reverse('store:cart_api_remove', args=[line_id])).status_code, 405)
+        missing = self.client.post(reverse('store:cart_api_remove', args=[line_id + 1]))
+        self.assertEqual(missing.status_code, 404)
+        self.assertEqual(Cart.objects.get().version, 1)
+
+
+class RecommenderTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_user()
+        self.a, self.b, self.c, self.d = (self.make_product(name=name) for name in 'ABCD')
+        self.combo = ComboDeal.objects.create(
+            name='Glow Kit', description='Kit', original_price='250.00', discounted_price='199.00'
+        )
+        self.combo.products.set([self.a, self.c])
+        self.order(self.a, self.b)
+        self.order(self.a, self.b, self.c)
+        self.order(self.combo, self.d)
+        self.order(self.a, self.d, status='cancelled')
+
+    def order(self, *lines, **fields):
+        order = Order.objects.create(user=self.user, **fields)
+        for line in lines:
+            kind = 'combo_deal' if isinstance(line, ComboDeal) else 'product'
+            OrderItem.objects.create(order=order, price='100.00', **{kind: line})
+        return order
+
+    def neighbours(self, product):
+        return list(frequently_bought_with(product))
+
+    def test_top_k_from_co_purchases(self):
+        self.assertEqual(train(), (3, 4))
+        self.assertEqual(self.neighbours(self.a), [self.b, self.c, self.d])
+        self.assertEqual(self.neighbours(self.d), [self.c, self.a])
+        self.assertEqual(CoPurchase.objects.get(product=self.a, other=self.a).orders, 3)
+        with self.assertNumQueries(1):
+            self.neighbours(self.b)
+
+    def test_incremental_training_matches_a_full_run(self):
+        train()
+        self.order(self.a, self.d)
+        self.order(self.a, self.d)
+        self.assertEqual(train()[0], 2)
+        self.assertEqual(self.neighbours(self.a), [self.d, self.b, self.c])
+        self.assertEqual(train(), (0, 0))
+
+        def table():
+            return sorted(ProductRecommendation.objects.values_list('product', 'rank', 'recommended', 'score'))
+
+        incremental = table()
+        train(full=True)
+        self.assertEqual(table(), incremental)
+
+    def test_unavailable_products_are_not_shown(self):
+        train()
+        Product.objects.filter(pk=self.b.pk).update(is_available=False)
+        self.assertEqual(self.neighbours(self.a), [self.c, self.d])
+        response = self.client.get(reverse('store:product_detail', args=[self.a.slug]))
+        self.assertContains(response, 'Frequently Bought Together')
+
+
+class SimilarProductsTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.enterContext(mock.patch('store.similar._index._current', None))
+        skin = self.make_category('Skin Care')
+        hair = self.make_category('Hair Care')
+        self.wash = self.make_product(name='Neem Face Wash', category=skin, concern='acne',
+                                      description='Neem and tea tree wash for oily, acne prone skin')
+        self.gel = self.make_product(name='Neem Spot Gel', category=skin, concern='acne',
+                                     description='Neem gel that calms acne and oily skin')
+        self.oil = self.make_product(name='Coconut Hair Oil', category=hair, concern='hair_fall',
+                                     description='Cold pressed coconut oil against hair fall')
+        self.amla = self.make_product(name='Amla Hair Oil', category=hair, concern='hair_fall',
+                                      description='Amla oil that strengthens roots and slows hair fall')
+        # Out of reach of the clock-skew window, so only later saves count as changes
+        Product.objects.update(updated_at=timezone.now() - timedelta(minutes=1))
+
+    def test_products_without_orders_have_neighbours(self):
+        self.assertEqual(similar_products(self.wash)[0], self.gel)
+        self.assertEqual(similar_products(self.oil)[0], self.amla)
+        Product.objects.filter(pk=self.gel.pk).update(is_available=False)
+        self.assertNotIn(self.gel, similar_products(self.wash))
+
+    @mock.patch('store.similar.REBUILD_FRACTION', 1)
+    def test_refresh_rescores_changed_rows_into_computed_lists(self):
+        index = get_similarity_index()
+        for product in (self.wash, self.gel, self.oil, self.amla):
+            index.similar(product.pk)
+        self.amla.description = 'Neem and tea tree oil for oily, acne prone skin'
+        self.amla.concern = 'acne'
+        self.amla.save()
+        self.oil.delete()
+
+        refreshed = get_similarity_index()
+        self.assertIsNot(refreshed, index)
+        self.assertTrue(refreshed.ready[refreshed.rows[self.wash.pk]])
+        merged = refreshed.similar(self.wash.pk)
+        self.assertIn(self.amla.pk, merged)
+        self.assertNotIn(self.oil.pk, refreshed.similar(self.amla.pk))
+
+        # Merging gives the lists a recompute from the refreshed vectors would
+        refreshed.compute(list(refreshed.rows.values()))
+        self.assertEqual(refreshed.similar(self.wash.pk), merged)
+
+    @override_settings(INDEX_REBUILD_IN_BACKGROUND=True)
+    def test_pages_show_no_strip_until_the_first_build_is_done(self):
+        built = SimilarityIndex.build()
+        release = threading.Event()
+
+        def build():
+            release.wait(5)
+            return built
+
+        with mock.patch('store.similar._index.build', build):
+            self.assertEqual(similar_products(self.wash), [])
+            self.assertContains(self.client.get(reverse('store:product_detail', args=[self.wash.slug])), self.wash.name)
+            rebuilding = similar._index._rebuilding
+            release.set()
+            rebuilding.join()
+        self.assertEqual(similar_products(self.wash)[0], self.gel)
+
+    def test_unchanged_text_keeps_the_index(self):
+        index = get_similarity_index()
+        Review.objects.create(product=self.wash, user=self.make_user(), rating=5, comment='ok')
+        self.assertIs(get_similarity_index(), index)
+        self.assertIsInstance(index, SimilarityIndex)
+
+
+class PersonalFeedTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        skin = self.make_category('Skin Care')
+        hair = self.make_category('Hair Care')
+        self.alice = self.make_user('alice')
+        self.bob = self.make_user('bob')
+        self.gel = self.make_product(name='Neem Gel', category=skin, concern='acne')
+        self.wash = self.make_product(name='Neem Wash', category=skin, concern='acne')
+        self.cream = self.make_product(name='Rose Cream', category=skin, concern='dry_skin')
+        self.oil = self.make_product(name='Amla Oil', category=hair, concern='hair_fall')
+        self.sold_out = self.make_product(name='Tea Tree Toner', category=skin, concern='acne', stock=0)
+        self.order(self.alice, self.gel)
+        for _ in range(3):
+            self.order(self.bob, self.gel, self.cream)
+        self.order(self.bob, self.oil)
+        Review.objects.create(product=self.wash, user=self.alice, rating=5, comment='ok')
+        Review.objects.create(product=self.oil, user=self.alice, rating=1, comment='no')
+        train()
+
+    def order(self, user, *products):
+        order = Order.objects.create(user=user)
+        for product in products:
+            OrderItem.objects.create(order=order, product=product, price='100.00')
+
+    def test_batch_ranks_blended_signals_and_skips_sold_out(self):
+        self.assertEqual(build_user_recommendations(chunk_size=1), 2)
+        ranked = list(UserRecommendation.objects.filter(user=self.alice).order_by('rank').values_list('product', flat=True))
+        # Bought with her gel first; the concern she rated badly outweighs the oil's popularity
+        self.assertEqual(ranked[:2], [self.cream.pk, self.gel.pk])
+        self.assertIn(self.wash.pk, ranked)
+        self.assertNotIn(self.oil.pk, ranked)
+        self.assertNotIn(self.sold_out.pk, ranked)
+
+        Product.objects.filter(pk=self.cream.pk).update(stock=0)
+        with self.assertNumQueries(1):
+            products = recommended_for(self.alice)
+        self.assertEqual(products[0], self.gel)
+
+    def test_users_without_a_list_get_cached_bestsellers(self):
+        carol = self.make_user('carol')
+        self.assertEqual(recommended_for(carol)[:2], [self.gel, self.cream])
+        with self.assertNumQueries(2):
+            recommended_for(carol)
+        self.client.force_login(carol)
+        self.assertContains(self.client.get(reverse('store:profile')), 'Recommended For You')
+
+
+class ReviewModerationTests(StoreTestCase):
+    PRAISE = ['love this gel', 'skin feels soft and fresh', 'great for my skin', 'works well, will buy again']
+    COMPLAINTS = ['gave me a rash', 'sticky and smells bad', 'waste of money', 'broke me out, disappointed']
+    SPAM = ['FREE CASH click www.win-big.com', 'call 98765 43210 for offer', 'earn money from home click here']
+
+    def setUp(self):
+        super().setUp()
+        self.product = self.make_product(name='Neem Gel', category=self.make_category('Skin Care'))
+        self.user = self.make_user('alice')
+        texts = (self.PRAISE + self.COMPLAINTS + self.SPAM) * 5
+        sentiment = ([1] * 4 + [0] * 4 + [None] * 3) * 5
+        spam = ([0] * 8 + [1] * 3) * 5
+        self.classifier = ReviewClassifier.train(texts, sentiment, spam)
+        save_classifier(self.classifier, len(texts))
+
+    def post_review(self, rating, comment):
+        self.client.force_login(self.user)
+        self.client.post(reverse('store:product_detail', args=[self.product.slug]), {
+            'action': 'add_review', 'rating': str(rating), 'comment': comment,
+        })
+        return Review.objects.latest('id')
+
+    def test_new_reviews_are_queued_and_scored_in_the_background(self):
+        # The fixtures' navigation warmup
+        run_pending()
+        good = self.post_review(5, 'love this gel, skin feels soft')
+        junk = self.post_review(5, 'FREE CASH click www.win-big.com')
+        self.assertIsNone(good.scored_at)
+        self.assertEqual(Task.objects.filter(name=score_reviews.task_name).count(), 1)
+
+        self.assertEqual(run_pending(), ['done'])
+        good.refresh_from_db()
+        junk.refresh_from_db()
+        self.assertEqual(good.model_version, self.classifier.version)
+        self.assertTrue(good.is_approved)
+        self.assertFalse(good.flagged)
+        self.assertGreater(junk.spam_score, 0.5)
+        self.assertFalse(junk.is_approved)
+        self.assertTrue(junk.flagged)
+        # Holding the spam back took its stars off the product
+        self.assertEqual(Product.objects.get(pk=self.product.pk).rating_count, 1)
+
+    def test_moderated_review_that_reads_safe_is_approved(self):
+        SiteSettings.objects.create(require_review_moderation=True)
+        review = self.post_review(1, 'gave me a rash, waste of money')
+        self.assertFalse(review.is_approved)
+        score_reviews()
+        review.refresh_from_db()
+        self.assertTrue(review.is_approved)
+        self.assertEqual(Product.objects.get(pk=self.product.pk).rating_count, 1)
+
+    def test_nothing_is_scored_without_a_trained_model(self):
+        ModerationModel.objects.all().delete()
+        review = self.post_review(5, 'love this gel')
+        score_reviews()
+        review.refresh_from_db()
+        self.assertIsNone(review.scored_at)
+        self.assertTrue(review.is_approved)
+
+    def test_reviews_from_before_the_classifier_are_left_alone(self):
+        backfill = import_module('store.migrations.0050_backfill_review_scores').mark_existing_reviews_scored
+        old = Review.objects.create(product=self.product, user=self.user, rating=5, comment='FREE CASH click www.win-big.com')
+        backfill(django_apps, None)
+        score_reviews()
+        old.refresh_from_db()
+        self.assertEqual((old.model_version, old.is_approved, old.flagged), ('legacy', True, False))
+
+    def test_batch_features_match_one_review_at_a_time(self):
+        texts = ['love this gel', '', None, 'CALL 98765-43210 NOW!!!!', 'so   good\nreally', 'Visit WWW.SHOP.IN', 'ok ' * 200]
+        batch = features(texts).toarray()
+        for row, text in zip(batch, texts):
+            self.assertTrue((row == features([text]).toarray()[0]).all(), text)
+        self.assertEqual(features([]).shape, (0, batch.shape[1]))
+
+    def test_saved_classifier_scores_the_same(self):
+        texts = ['love this gel', 'click here for free cash']
+        loaded = ReviewClassifier.loads(ModerationModel.objects.get(is_active=True).weights)
+        self.assertEqual(loaded.version, self.classifier.version)
+        for before, after in zip(self.classifier.score(texts), loaded.score(texts)):
+            self.assertTrue((before == after).all())
+
+
+class DemandForecastTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        skin = self.make_category('Skin Care')
+        self.gel = self.make_product(name='Neem Gel', category=skin, stock=10)
+        self.wash = self.make_product(name='Neem Wash', category=skin, stock=500)
+        self.idle = self.make_product(name='Rose Cream', category=skin, stock=3)
+        self.kit = ComboDeal.objects.create(name='Neem Kit', description='Kit', original_price='500', discounted_price='399')
+        self.kit.products.set([self.gel, self.wash])
+        self.user = self.make_user('alice')
+        self.staff = self.make_user('boss')
+        CustomUser.objects.filter(pk=self.staff.pk).update(is_staff=True, email='boss@example.com')
+        self.today = timezone.localdate()
+        # Every day for four weeks: a gel and a kit, so two gels and one wash a day
+        for days_ago in range(1, 29):
+            self.order(days_ago, product=self.gel)
+            self.order(days_ago, combo_deal=self.kit)
+        self.order(3, product=self.idle, status='cancelled')
+
+    def order(self, days_ago, status='processing', **line):
+        order = Order.objects.create(user=self.user, status=status)
+        Order.objects.filter(pk=order.pk).update(created_at=timezone.now() - timedelta(days=days_ago))
+        OrderItem.objects.create(order=order, price='100.00', **line)
+
+    def test_smoothing_follows_a_level_shift(self):
+        sales = np.array([[1.0] * 20 + [5.0] * 20, [0.0] * 40])
+        demand = smooth(sales)
+        self.assertAlmostEqual(demand[0], 5, delta=0.1)
+        self.assertEqual(demand[1], 0)
+
+    def test_forecasts_days_until_stockout_and_alerts_staff_once(self):
+        self.assertEqual(build_forecasts(), 3)
+        gel = StockForecast.objects.get(product=self.gel)
+        self.assertAlmostEqual(gel.daily_demand, 2, delta=0.05)
+        self.assertAlmostEqual(gel.days_until_stockout, 5, delta=0.2)
+        self.assertEqual(gel.stockout_on, self.today + timedelta(days=int(gel.days_until_stockout)))
+        self.assertAlmostEqual(StockForecast.objects.get(product=self.wash).days_until_stockout, 500, delta=10)
+        self.assertIsNone(StockForecast.objects.get(product=self.idle).days_until_stockout)
+
+        self.assertEqual(send_stockout_alerts(), 1)
+        email = Task.objects.get(name=send_email.task_name)
+        self.assertEqual(email.kwargs['recipient_list'], ['boss@example.com'])
+        self.assertIn('Neem Gel', email.kwargs['message'])
+        build_forecasts()
+        self.assertEqual(send_stockout_alerts(), 0)
+
+        # Restocked, it is out of danger and can be alerted again later
+        Product.objects.filter(pk=self.gel.pk).update(stock=1000)
+        build_forecasts()
+        send_stockout_alerts()
+        self.assertIsNone(StockForecast.objects.get(product=self.gel).alerted_at)
+
+    def test_admin_changelist_shows_forecasts_from_the_table(self):
+        build_forecasts()
+        CustomUser.objects.filter(pk=self.staff.pk).update(is_superuser=True)
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse('admin:store_product_changelist'))
+        self.assertContains(response, '5 days (2.0/day)')
+        self.assertContains(response, '1 products will run out within 14 days')
+        response = self.client.get(reverse('admin:store_product_changelist'), {'runs_out': 'soon'})
+        self.assertEqual([p.pk for p in response.context['cl'].result_list], [self.gel.pk])
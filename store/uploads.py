@@ -0,0 +1,51 @@
+# store/uploads.py
+"""
+Image uploads off the request path.
+
+Review and cancellation photos are saved to the default file storage,
+Cloudinary when it is configured, which is an HTTP upload. Doing it while
+the customer waits ties up the request for as long as the upload takes.
+
+stage_upload() instead keeps the uploaded bytes in a StagedUpload row and
+queues the attach_upload task (store/tasks.py). The row lives in the
+database, so the worker does not need to share a disk with the web
+process. The worker saves the file into the model's field and deletes
+the row. Until then the review or request simply has no photo.
+"""
+from django.apps import apps
+from django.core.files.base import ContentFile
+
+from .models import StagedUpload
+from .tasks import attach_upload
+
+# The fields an upload may be attached to
+ATTACHABLE = {
+    'store.review': 'photo',
+    'store.cancellationrequest': 'photo',
+}
+
+
+def stage_upload(instance, field, file):
+    """Queue `file` to be saved into `instance`'s `field` by the task worker."""
+    label = instance._meta.label_lower
+    if ATTACHABLE.get(label) != field:
+        raise ValueError(f'Uploads cannot be attached to {label}.{field}')
+    upload = StagedUpload.objects.create(
+        model=label, object_id=instance.pk, field=field, name=file.name, data=file.read(),
+    )
+    attach_upload.delay(upload_id=upload.pk)
+    return upload
+
+
+def attach(upload_id):
+    """Save a staged upload into its field. A no-op if it was already attached."""
+    upload = StagedUpload.objects.filter(pk=upload_id).first()
+    if upload is None:
+        return
+    model = apps.get_model(upload.model)
+    instance = model._default_manager.filter(pk=upload.object_id).first()
+    # Gone if the row was deleted while the upload waited
+    if instance is not None:
+        getattr(instance, upload.field).save(upload.name, ContentFile(bytes(upload.data)), save=False)
+        instance.save(update_fields=[upload.field])
+    upload.delete()
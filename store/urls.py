@@ -18,6 +18,7 @@ urlpatterns = [
     path('faq/', views.faq_view, name='faq'),
     path('contact/', views.contact_view, name='contact'),
     path('products/', views.product_list_view, name='products'),
+    path('products/suggest/', views.product_suggest_view, name='product_suggest'),
     path('products/<slug:product_slug>/', views.product_detail_view, name='product_detail'),
     path('combos/', views.combo_deals_view, name='combos'),
     path('combos/<slug:combo_slug>/', views.combo_detail_view, name='combo_detail'),
@@ -27,12 +28,17 @@ urlpatterns = [
     path('payment/', views.payment_view, name='payment'),
     path('payment/', views.payment_view, name='payment'),
     path('verify-payment/', views.verify_payment, name='verify_payment'),
+    path('webhooks/razorpay/', views.razorpay_webhook, name='razorpay_webhook'),
     path('login/', views.login_view, name='login'),
     path('logout/', views.logout_view, name='logout'),
     path('signup/', views.signup_view, name='signup'),
     path('profile/', views.profile, name='profile'),
     path('cart/update/<int:item_id>/', views.update_cart, name='update_cart'),
     path('cart/remove/<int:item_id>/', views.remove_from_cart, name='remove_from_cart'),
+    path('api/cart/', views.cart_api, name='cart_api'),
+    path('api/cart/add/', views.cart_api_add, name='cart_api_add'),
+    path('api/cart/lines/<int:item_id>/', views.cart_api_set_quantity, name='cart_api_set_quantity'),
+    path('api/cart/lines/<int:item_id>/remove/', views.cart_api_remove, name='cart_api_remove'),
     path('login/', auth_views.LoginView.as_view(template_name='login.html'), name='login'),
     path('logout/', auth_views.LogoutView.as_view(next_page='/'), name='logout'),
     path('order-success/', TemplateView.as_view(template_name='store/order_success.html'), name='order_success'),
@@ -1,28 +1,72 @@
 # store/utils.py
+from decimal import Decimal
+
 from django.conf import settings
+from django.db.models import DecimalField, F, Sum
+from django.db.models.functions import Coalesce
 from .models import Cart
 
-def get_or_create_cart(request):
+CART_SUMMARY_KEY = 'cart_summary'
+CENTS = Decimal('0.01')
+EMPTY_CART_SUMMARY = {'count': 0, 'subtotal': '0.00'}
+
+# Mirrors CartItem.line_total(): combo price, else the stored unit price,
+# else the product's sale price, else its list price.
+LINE_PRICE = Coalesce(
+    'combo_deal__discounted_price', 'unit_price', 'product__sale_price', 'product__price',
+    output_field=DecimalField(max_digits=10, decimal_places=2),
+)
+
+
+def store_cart_summary(request, cart=None):
+    """
+    Recompute the badge count and subtotal for `cart` (one aggregate query)
+    and keep them in the session, with the cart version they were computed
+    at. Call after every cart mutation; pass no cart once it has been emptied.
+    """
+    summary = dict(EMPTY_CART_SUMMARY)
+    if cart is not None:
+        totals = cart.items.aggregate(
+            count=Sum('quantity'),
+            subtotal=Sum(F('quantity') * LINE_PRICE),
+        )
+        summary = {
+            'count': totals['count'] or 0,
+            'subtotal': str(Decimal(totals['subtotal'] or 0).quantize(CENTS)),
+            'version': cart.version,
+        }
+    request.session[CART_SUMMARY_KEY] = summary
+    return summary
+
+
+def remember_cart_summary(request, cart, items):
+    """Store the summary for `cart` from its items when they are already loaded, without a query."""
+    summary = {
+        'count': sum(item.quantity for item in items),
+        'subtotal': str(Decimal(sum(item.line_total() for item in items)).quantize(CENTS)),
+        'version': cart.version,
+    }
+    request.session[CART_SUMMARY_KEY] = summary
+    return summary
+
+
+def cart_summary_is_current(request, cart):
+    """Whether the stored summary was computed at `cart`'s version; no query, for carts already loaded."""
+    summary = request.session.get(CART_SUMMARY_KEY)
+    return summary is not None and summary.get('version') == (cart.version if cart is not None else None)
+
+
+def get_cart_summary(request):
     """
-    DB-backed cart:
-    - If user is authenticated, prefer user-linked cart (one active cart per user).
-    - Otherwise, store cart_id in session.
+    The badge count and subtotal, from the session when it has them.
+    A visitor's summary is stored whenever their cart changes, so one
+    without it has no cart and gets the empty summary without touching the
+    database or creating a session.
     """
-    # Try user cart first
-    if request.user.is_authenticated:
-        cart, _ = Cart.objects.get_or_create(user=request.user, defaults={})
-        request.session['cart_id'] = cart.id
-        return cart
-
-    # For anonymous users, use session-stored cart id
-    cart_id = request.session.get('cart_id')
-    if cart_id:
-        try:
-            cart = Cart.objects.get(id=cart_id)
-            return cart
-        except Cart.DoesNotExist:
-            pass
-
-    cart = Cart.objects.create()
-    request.session['cart_id'] = cart.id
-    return cart
+    summary = request.session.get(CART_SUMMARY_KEY)
+    if summary is not None:
+        return summary
+    if not request.user.is_authenticated:
+        return EMPTY_CART_SUMMARY
+    cart = Cart.objects.filter(user=request.user, is_paid=False).first()
+    return store_cart_summary(request, cart)
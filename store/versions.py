@@ -0,0 +1,154 @@
+# store/versions.py
+"""
+Named version counters kept in the cache. Data derived from the database is
+cached under a key that includes its version, so bumping the version is all
+it takes to invalidate every copy. Indexes held in process memory (suggest,
+facets, similar products, the coupon book) compare the version on use and
+rebuild when it has moved.
+
+That only reaches other processes because settings.CACHES is shared by all
+of them: Redis, or the database cache table. With a per-process cache such
+as LocMemCache a change made in one worker would never reach the others.
+
+Reading the shared cache on every use would put a cache round trip, and
+with the database cache a query, on every request. So each process keeps
+the numbers it read and goes back to the shared cache at most every
+VERSION_CHECK_INTERVAL seconds. A bump made in this process is seen here
+at once; one made elsewhere within that interval.
+
+VersionedIndex holds one such in-process index. Its first build happens
+on first use, or for indexes too slow for that, in the background with
+None served meanwhile. After that a moved version starts a rebuild on a
+background thread and requests go on being served the previous index until
+the new one is ready, so no page view waits for a rebuild.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Category, Coupon, Product, Review
+
+DEFAULTS = {
+    'VERSION_CHECK_INTERVAL': 5,
+    'INDEX_REBUILD_IN_BACKGROUND': True,
+}
+
+CATALOG = 'catalog'
+COUPONS = 'coupons'
+
+# name -> (version, time.monotonic() when it was read from the shared cache)
+_versions = {}
+
+
+def _setting(name):
+    return getattr(settings, name, DEFAULTS[name])
+
+
+def _key(name):
+    return f'store:version:{name}'
+
+
+def _read_version(name):
+    version = cache.get(_key(name))
+    if version is None:
+        # Seeded from the clock so a version lost to eviction never reuses an old key
+        cache.add(_key(name), time.time_ns(), None)
+        version = cache.get(_key(name))
+    return version
+
+
+def get_version(name):
+    """The version of `name`, as this process last read it from the shared cache."""
+    now = time.monotonic()
+    known = _versions.get(name)
+    if known is not None and now - known[1] < _setting('VERSION_CHECK_INTERVAL'):
+        return known[0]
+    version = _read_version(name)
+    _versions[name] = (version, now)
+    return version
+
+
+def bump_version(name):
+    try:
+        cache.incr(_key(name))
+    except ValueError:
+        _read_version(name)
+    _versions.pop(name, None)
+
+
+class VersionedIndex:
+    """This process's copy of `build()`, kept in step with the version `name`."""
+
+    def __init__(self, name, build, refresh=None, wait_for_first=True):
+        """
+        `refresh(old)`, if given, brings the previous index up to date instead
+        of building afresh. Without `wait_for_first`, get() returns None until
+        the first index is ready, and that build happens in the background too.
+        """
+        self.name = name
+        self.build = build
+        self.refresh = refresh
+        self.wait_for_first = wait_for_first
+        self._lock = threading.Lock()
+        self._current = None
+        self._rebuilding = None
+
+    def get(self):
+        version = get_version(self.name)
+        current = self._current
+        if current is None and self.wait_for_first or not _setting('INDEX_REBUILD_IN_BACKGROUND'):
+            if current is None or current[0] != version:
+                with self._lock:
+                    if self._current is None or self._current[0] != version:
+                        self._current = (version, self._make(self._current))
+        elif current is None or current[0] != version:
+            with self._lock:
+                if self._rebuilding is None:
+                    self._rebuilding = threading.Thread(target=self._rebuild, args=[version], daemon=True)
+                    self._rebuilding.start()
+        current = self._current
+        return current[1] if current else None
+
+    def _make(self, current):
+        if current is None or self.refresh is None:
+            return self.build()
+        return self.refresh(current[1])
+
+    def _rebuild(self, version):
+        try:
+            # The version read before building, so a change made meanwhile starts another rebuild
+            self._current = (version, self._make(self._current))
+        finally:
+            self._rebuilding = None
+            connections.close_all()
+
+
+#Anything derived from the product catalog is keyed on the catalog version
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=Category)
+def catalog_changed(sender, **kwargs):
+    bump_version(CATALOG)
+
+
+#Reviews count only when they move a product's rating counters, which they
+#do through queryset updates that send no Product signals. Edits, photos and
+#spam scores leave the catalog alone.
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def ratings_changed(sender, instance, **kwargs):
+    if getattr(instance, '_moved_rating_counters', False):
+        bump_version(CATALOG)
+
+
+#The coupon book in store/pricing.py is keyed on the coupon version
+@receiver(post_save, sender=Coupon)
+@receiver(post_delete, sender=Coupon)
+def coupons_changed(sender, **kwargs):
+    bump_version(COUPONS)
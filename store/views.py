@@ -5,13 +5,12 @@ from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse
-from django.db import models
-from django.db.models import Q
+from django.db import IntegrityError, models, transaction
+from django.db.models import F, OuterRef, Q
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 import json
 from django.utils import timezone
-from django.core.mail import send_mail
 from django.contrib.admin.views.decorators import staff_member_required
 
 
@@ -26,101 +25,33 @@ from .models import (
     OrderItem,
     ContactMessage,
     CustomUser,
-    Coupon,
     CancellationRequest,
     ShippingAddress
 )
+from .carts import StaleCart, active_cart, add_line, changing, current_cart
+from .facets import get_facet_index
+from .inventory import OutOfStock
+from .navigation import get_site_settings
+from .orders import place_order
+from .pagination import keyset_page
+from .personalize import recommended_for
+from .payments import GatewayUnavailable, forget_gateway_order, gateway_order_for, get_gateway
+from .pricing import find_coupon, quote, shipping_for
+from .search import search_product_ids
+from .tasks import process_payment_events, send_email
+from .uploads import stage_upload
+from .suggest import get_suggest_index
+from .ratings import latest_review_id, review_stats, with_combo_review_stats
+from .recommend import frequently_bought_with
+from .similar import similar_products
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse
 from django.views.decorators.http import require_POST
 from .models import Product, ComboDeal, CartItem, Cart
-from .utils import get_or_create_cart
+from .utils import EMPTY_CART_SUMMARY, cart_summary_is_current, remember_cart_summary, store_cart_summary
+from .webhooks import HANDLED_EVENTS, record_event, valid_signature
 from django.contrib import messages 
 
-@require_POST
-def add_to_cart(request, product_slug):
-    """
-    POST endpoint matching path('cart/add/<slug:product_slug>/', ...)
-    - If product exists, add/increment CartItem for that product.
-    - If product_slug corresponds to a product. (If you want combos via slug, adapt accordingly.)
-    """
-    cart = get_or_create_cart(request)
-
-    # try product first
-    product = get_object_or_404(Product, slug=product_slug, is_available=True)
-
-    # Check if CartItem for this product already exists in the cart
-    item, created = CartItem.objects.get_or_create(
-        cart=cart,
-        product=product,
-        defaults={'quantity': 1, 'unit_price': product.get_display_price()}
-    )
-
-    if not created:
-        item.quantity += 1
-        # update unit_price if needed (keep previous if set)
-        if item.unit_price is None:
-            item.unit_price = product.get_display_price()
-        item.save()
-
-    messages.success(request, f"Added {product.name} to cart.")
-    return redirect(request.META.get('HTTP_REFERER', reverse('cart')))
-
-@require_POST
-def update_cart(request, item_id):
-    """
-    path('cart/update/<int:item_id>/', name='update_cart')
-    Expects POST with 'quantity' value (int).
-    If quantity <= 0, item removed.
-    """
-    cart = get_or_create_cart(request)
-    item = get_object_or_404(CartItem, id=item_id, cart=cart)
-
-    try:
-        qty = int(request.POST.get('quantity', item.quantity))
-    except (ValueError, TypeError):
-        qty = item.quantity
-
-    if qty <= 0:
-        item.delete()
-        messages.info(request, f"Removed {item.get_name()} from cart.")
-    else:
-        item.quantity = qty
-        item.save()
-        messages.success(request, f"Updated quantity for {item.get_name()}.")
-
-    return redirect(request.META.get('HTTP_REFERER', reverse('cart')))
-
-
-@require_POST
-def remove_from_cart(request, item_id):
-    """
-    path('cart/remove/<int:item_id>/', name='remove_from_cart')
-    """
-    cart = get_or_create_cart(request)
-    item = get_object_or_404(CartItem, id=item_id, cart=cart)
-    item.delete()
-    messages.info(request, f"Removed {item.get_name()} from cart.")
-    return redirect(request.META.get('HTTP_REFERER', reverse('cart')))
-
-def cart_view(request):
-    """
-    path('cart/', name='cart')
-    Show cart items and total.
-    """
-    cart = get_or_create_cart(request)
-    items = cart.items.select_related('product', 'combo_deal').all()
-
-    total = sum(item.line_total() for item in items)
-    item_count = sum(item.quantity for item in items)
-
-    context = {
-        'cart': cart,
-        'cart_items': items,
-        'cart_total': total,
-        'cart_item_count': item_count,
-    }
-    return render(request, 'store/cart.html', context)
 
 
 
@@ -167,6 +98,7 @@ def home_view(request):
         'categories': categories,
         'steps': [1, 2, 3, 4],
         'recent_reviews': recent_reviews,
+        'recommended': recommended_for(request.user),
     })
 
 def logout_view(request):
@@ -220,60 +152,132 @@ def contact_view(request):
     return render(request, 'store/contact.html')
 
 
+PRODUCTS_PER_PAGE = 24
+# Keyset orderings for the listing: (field, descending) pairs, each ending in
+# the primary key so every row has a distinct position.
+PRODUCT_SORTS = {
+    'newest': [('id', True)],
+    'price': [('listing_price', False), ('id', False)],
+    'price_desc': [('listing_price', True), ('id', True)],
+    'rating': [('listing_rating', True), ('rating_count', True), ('id', True)],
+}
+
+
+def attach_latest_reviews(objects):
+    """
+    Set `latest_review` on each product (or combo) from its
+    `latest_review_id` annotation, loading just those reviews in one query.
+    """
+    ids = [o.latest_review_id for o in objects if o.latest_review_id]
+    reviews = Review.objects.in_bulk(ids) if ids else {}
+    for o in objects:
+        o.latest_review = reviews.get(o.latest_review_id)
+
+
+def product_card_json(product):
+    return {
+        'id': product.pk,
+        'name': product.name,
+        'url': reverse('store:product_detail', args=[product.slug]),
+        'image': product.image.url if product.image else None,
+        'price': str(product.price),
+        'sale_price': str(product.sale_price) if product.sale_price is not None else None,
+        'rating': round(product.rating_mean, 1),
+        'rating_count': product.rating_count,
+        'latest_review': {
+            'rating': product.latest_review.rating,
+            'comment': product.latest_review.comment,
+        } if product.latest_review else None,
+    }
+
+
 def product_list_view(request):
     # Prepare reviews visibility per moderation setting
-    site_cfg = None
-    try:
-        from .models import SiteSettings
-        site_cfg = SiteSettings.objects.first()
-    except Exception:
-        site_cfg = None
-
-    from django.db.models import Prefetch
-    reviews_qs = Review.objects.select_related('user')
-    if site_cfg and site_cfg.require_review_moderation:
-        reviews_qs = reviews_qs.filter(is_approved=True)
+    site_cfg = get_site_settings(request)
+    moderated = bool(site_cfg and site_cfg.require_review_moderation)
 
-    products = Product.objects.filter(is_available=True).prefetch_related(
-        Prefetch('reviews', queryset=reviews_qs.order_by('-created_at'), to_attr='visible_reviews')
+    products = Product.objects.filter(is_available=True).annotate(
+        latest_review_id=latest_review_id(moderated, product=OuterRef('pk')),
     )
-    category_slug = request.GET.get('category')
-    concern = request.GET.get('concern')
+    facet_index = get_facet_index()
+    selection = facet_index.clean(request.GET)
     query = request.GET.get('q', '').strip()
-    if category_slug:
-        products = products.filter(category__slug=category_slug)
-    if concern:
-        products = products.filter(concern=concern)
+    sort = request.GET.get('sort')
+    sorted_explicitly = sort in PRODUCT_SORTS
+    if not sorted_explicitly:
+        sort = 'newest'
+    products = products.filter(facet_index.filter(selection))
+    next_cursor = None
+    within = None
     if query:
-        products = products.filter(
-            Q(name__icontains=query) |
-            Q(description__icontains=query) |
-            Q(category__name__icontains=query)
-        )
+        # Ranked ids from the full-text index, then the page's own filters.
+        # Search results are capped, so they come back as a single page.
+        ranked = search_product_ids(query)
+        within = facet_index.subset(ranked)
+        rank = {pk: position for position, pk in enumerate(ranked)}
+        products = sorted(products.filter(pk__in=ranked), key=lambda p: rank[p.pk])
+        if sorted_explicitly:
+            products.sort(key=lambda p: [
+                -getattr(p, field) if descending else getattr(p, field)
+                for field, descending in PRODUCT_SORTS[sort]
+            ])
         # If exactly one result, redirect to product detail
-        prod_count = products.count()
-        if prod_count == 1:
-            only = products.first()
-            return redirect('store:product_detail', product_slug=only.slug)
-    categories = Category.objects.all()
-    return render(request, 'store/products.html', {
+        if len(products) == 1:
+            return redirect('store:product_detail', product_slug=products[0].slug)
+    else:
+        products, next_cursor = keyset_page(
+            products, PRODUCT_SORTS[sort], request.GET.get('cursor'), PRODUCTS_PER_PAGE
+        )
+    attach_latest_reviews(products)
+
+    next_url = None
+    if next_cursor:
+        params = request.GET.copy()
+        params['cursor'] = next_cursor
+        params.pop('format', None)
+        next_url = f"{request.path}?{params.urlencode()}"
+
+    # Infinite scroll: JSON for scripts, bare cards for HTMX
+    if request.GET.get('format') == 'json':
+        return JsonResponse({
+            'products': [product_card_json(p) for p in products],
+            'facets': facet_index.counts(selection, within),
+            'next_cursor': next_cursor,
+            'next_url': next_url,
+        })
+    context = {
         'products': products,
-        'categories': categories,
-        'active_category': category_slug or '',
-        'active_concern': concern or '',
+        'next_url': next_url,
+    }
+    if request.headers.get('HX-Request'):
+        return render(request, 'store/partials/product_cards.html', context)
+
+    return render(request, 'store/products.html', {
+        **context,
+        'facets': facet_index.counts(selection, within),
+        'active_sort': sort,
         'query': query,
     })
 
 
+def product_suggest_view(request):
+    """
+    path('products/suggest/', name='product_suggest')
+    Autocomplete JSON for ?q=<prefix>[&limit=k], served from the in-process index.
+    """
+    query = request.GET.get('q', '')
+    try:
+        limit = max(int(request.GET.get('limit', 8)), 1)
+    except (TypeError, ValueError):
+        limit = 8
+    suggestions = get_suggest_index().suggest(query, limit)
+    return JsonResponse({'query': query, **suggestions})
+
+
 def product_detail_view(request, product_slug):
     product = get_object_or_404(Product, slug=product_slug, is_available=True)
     # Only show approved reviews if moderation is enabled
-    site_cfg = None
-    try:
-        from .models import SiteSettings
-        site_cfg = SiteSettings.objects.first()
-    except Exception:
-        site_cfg = None
+    site_cfg = get_site_settings(request)
     reviews_qs = product.reviews.select_related('user')
     if site_cfg and site_cfg.require_review_moderation:
         reviews_qs = reviews_qs.filter(is_approved=True)
@@ -291,14 +295,15 @@ def product_detail_view(request, product_slug):
                 is_approved = True
                 if site_cfg and site_cfg.require_review_moderation:
                     is_approved = False
-                Review.objects.create(
+                review = Review.objects.create(
                     product=product,
                     user=request.user,
                     rating=rating,
                     comment=comment,
                     is_approved=is_approved,
-                    photo=photo,
                 )
+                if photo:
+                    stage_upload(review, 'photo', photo)
                 if is_approved:
                     messages.success(request, 'Review submitted!')
                 else:
@@ -306,77 +311,34 @@ def product_detail_view(request, product_slug):
                 return redirect('store:product_detail', product_slug=product.slug)
             messages.error(request, 'Please provide a rating (1-5) and a comment.')
 
-    # Calculate review statistics
-    total_reviews = reviews.count()
-    avg_rating = reviews.aggregate(avg=models.Avg('rating'))['avg'] or 0
-    
-    # Rating distribution
-    rating_dist = {}
-    for i in range(1, 6):
-        rating_dist[i] = reviews.filter(rating=i).count()
-    
+    stats = review_stats(product, moderated=bool(site_cfg and site_cfg.require_review_moderation))
+
     return render(request, 'store/product_detail.html', {
         'product': product,
         'reviews': reviews[:6],  # Show only first 6 reviews
-        'total_reviews': total_reviews,
-        'avg_rating': avg_rating,
-        'rating_dist': rating_dist,
+        'total_reviews': stats.total,
+        'avg_rating': stats.average,
+        'rating_dist': stats.distribution,
+        'recommendations': frequently_bought_with(product),
+        'similar_products': similar_products(product),
     })
 
 
 def combo_deals_view(request):
-    # Fetch combos with included products and recent reviews aggregated from products
-    from django.db.models import Prefetch, Avg, Count
-    site_cfg = None
-    try:
-        from .models import SiteSettings
-        site_cfg = SiteSettings.objects.first()
-    except Exception:
-        site_cfg = None
-
-    reviews_qs = Review.objects.select_related('user').order_by('-created_at')
-    if site_cfg and site_cfg.require_review_moderation:
-        reviews_qs = reviews_qs.filter(is_approved=True)
-
-    combos = ComboDeal.objects.prefetch_related(
-        Prefetch('products__reviews', queryset=reviews_qs, to_attr='combo_visible_reviews')
-    ).all()
-
-    # Build lightweight aggregates for template consumption
-    combo_meta = {}
-    for combo in combos:
-        all_reviews = []
-    for p in combo.products.all():
-        if hasattr(p, 'combo_visible_reviews'):
-            all_reviews.extend(p.combo_visible_reviews)
-
-    count_reviews = len(all_reviews)
-    if count_reviews:
-        avg_rating = sum([r.rating for r in all_reviews]) / count_reviews
-        latest = all_reviews[0]
-    else:
-        avg_rating = 0
-        latest = None
-
-    # ✅ Attach data directly to the combo object
-    combo.avg_rating = avg_rating
-    combo.review_count = count_reviews
-    combo.latest_review = latest
-
-    return render(request, 'store/combos.html', {'combos': combos, 'combo_meta': combo_meta})
+    # Rating stats and the latest review for each combo, aggregated across its products
+    site_cfg = get_site_settings(request)
+    combos = list(with_combo_review_stats(
+        ComboDeal.objects.all(), moderated=bool(site_cfg and site_cfg.require_review_moderation)
+    ))
+    attach_latest_reviews(combos)
+    return render(request, 'store/combos.html', {'combos': combos})
 
 def combo_detail_view(request, combo_slug):
     combo = get_object_or_404(ComboDeal, slug=combo_slug)
     included_products = combo.products.filter(is_available=True)
     
     # Collect reviews from included products for display
-    site_cfg = None
-    try:
-        from .models import SiteSettings
-        site_cfg = SiteSettings.objects.first()
-    except Exception:
-        site_cfg = None
-        site_cfg = None
+    site_cfg = get_site_settings(request)
     reviews_qs = Review.objects.select_related('user').filter(product__in=included_products).order_by('-created_at')
     if site_cfg and site_cfg.require_review_moderation:
         reviews_qs = reviews_qs.filter(is_approved=True)
@@ -398,9 +360,10 @@ def combo_detail_view(request, combo_slug):
                             user=request.user,
                             rating=int(rating),
                             comment=comment,
-                            photo=photo,
                             is_approved=not (site_cfg and site_cfg.require_review_moderation)
                         )
+                        if photo:
+                            stage_upload(review, 'photo', photo)
                         if site_cfg and site_cfg.require_review_moderation:
                             messages.success(request, 'Review submitted and will be published after moderation.')
                         else:
@@ -412,52 +375,38 @@ def combo_detail_view(request, combo_slug):
                 return redirect('store:combo_detail', combo_slug=combo.slug)
             else:
                 # Handle add to cart
-                cart, _ = Cart.objects.get_or_create(user=request.user)
-                item, created = CartItem.objects.get_or_create(
-                    cart=cart, 
-                    combo_deal=combo,
-                    defaults={'quantity': 1}
-                )
-                if not created:
-                    item.quantity += 1
-                    item.save()
+                cart = active_cart(request.user)
+                with changing(cart):
+                    add_line(cart, combo_deal=combo)
+                    store_cart_summary(request, cart)
                 messages.success(request, 'Combo added to cart.')
                 return redirect('store:cart')
         else:
             messages.error(request, 'Please login to perform this action.')
             return redirect('store:combo_detail', combo_slug=combo.slug)
     
-    # Calculate review statistics
-    all_reviews = Review.objects.filter(product__in=included_products)
-    if site_cfg and site_cfg.require_review_moderation:
-        all_reviews = all_reviews.filter(is_approved=True)
-    
-    total_reviews = all_reviews.count()
-    avg_rating = all_reviews.aggregate(avg=models.Avg('rating'))['avg'] or 0
-    
-    # Rating distribution
-    rating_dist = {}
-    for i in range(1, 6):
-        rating_dist[i] = all_reviews.filter(rating=i).count()
-    
+    stats = review_stats(included_products, moderated=bool(site_cfg and site_cfg.require_review_moderation))
+
     return render(request, 'store/combo_detail.html', {
         'combo': combo,
         'included_products': included_products,
         'combo_reviews': reviews_qs[:6],
-        'total_reviews': total_reviews,
-        'avg_rating': avg_rating,
-        'rating_dist': rating_dist,
+        'total_reviews': stats.total,
+        'avg_rating': stats.average,
+        'rating_dist': stats.distribution,
     })
 
 def view_cart(request):
-    if request.user.is_authenticated:
-        cart, _ = Cart.objects.get_or_create(user=request.user)
+    cart = current_cart(request)
+    if cart is not None:
         items = cart.items.select_related('product', 'combo_deal').all()
         subtotal = sum([item.line_total() for item in items])
     else:
-        cart = None
         items = []
         subtotal = 0
+    if cart is not None:
+        # The items are loaded anyway, so resync the badge summary for free
+        remember_cart_summary(request, cart, items)
     return render(request, 'store/cart.html', {
         'cart': cart,
         'items': items,
@@ -465,20 +414,19 @@ def view_cart(request):
     })
 
 
-@login_required
 def add_to_cart(request, product_slug):
     product = get_object_or_404(Product, slug=product_slug, is_available=True)
-    quantity = int(request.POST.get('quantity', '1')) if request.method == 'POST' else 1
+    try:
+        quantity = int(request.POST.get('quantity', '1')) if request.method == 'POST' else 1
+    except ValueError:
+        quantity = 1
     if quantity < 1:
         quantity = 1
-    cart, _ = Cart.objects.get_or_create(user=request.user)
-
-    CartItem.objects.create(
-        cart=cart,
-        product=product,
-        quantity=quantity,
-        unit_price=None  # Individual products use their own price
-    )
+    # Visitors get a session cart, folded into their own when they sign in
+    cart = current_cart(request, create=True)
+    with changing(cart):
+        add_line(cart, product=product, quantity=quantity)
+        store_cart_summary(request, cart)
     messages.success(request, f"Added {product.name} to cart.")
     return redirect('store:cart')
 
@@ -496,6 +444,7 @@ def profile(request):
         "user": user,
         "orders": orders,
         "combos": combos,
+        "recommended": recommended_for(user),
     }
     return render(request, "store/profile.html", context)
 
@@ -634,184 +583,130 @@ from decimal import Decimal
 
 @login_required
 def checkout_view(request):
-    COD_SHIPPING_CHARGE = Decimal("99.00")
-    cart, _ = Cart.objects.get_or_create(user=request.user)
+    cart = active_cart(request.user)
     items = cart.items.select_related('product', 'combo_deal').all()
 
     if not items:
         messages.error(request, 'Your cart is empty.')
         return redirect('store:products')
-
-    subtotal = sum(item.line_total() for item in items)
-
-    # -------------------------------
-    # COUPON LOGIC
-    # -------------------------------
-    applied_coupon = None
-    discount_amount = Decimal('0')
-    final_amount = subtotal
-
-    coupon_code = request.session.get('coupon_code')
-    if coupon_code:
-        try:
-            applied_coupon = Coupon.objects.get(
-                code__iexact=coupon_code,
-                active=True,
-                valid_from__lte=timezone.now()
-            )
-            discount_amount = subtotal * (applied_coupon.discount_percentage / Decimal('100'))
-            final_amount = max(subtotal - discount_amount, Decimal('0.00'))
-            # Add shipping ONLY for COD
-            payment_method = request.POST.get("payment_method") or request.GET.get("payment_method")
-
-            shipping_charge = Decimal("0.00")
-            if payment_method == "cod":
-                shipping_charge = COD_SHIPPING_CHARGE
-
-            final_amount += shipping_charge
-        except Coupon.DoesNotExist:
-            request.session.pop('coupon_code', None)
+    if not cart_summary_is_current(request, cart):
+        # Another session changed the cart; the loaded items resync the badge
+        remember_cart_summary(request, cart, items)
 
     # -------------------------------
     # APPLY COUPON (GET)
     # -------------------------------
     if request.method == "GET" and request.GET.get("coupon"):
         code = request.GET.get("coupon").strip()
-        try:
-            Coupon.objects.get(
-                code__iexact=code,
-                active=True,
-                valid_from__lte=timezone.now()
-            )
+        if find_coupon(code):
             request.session['coupon_code'] = code
-            return redirect('store:checkout')
-        except Coupon.DoesNotExist:
+        else:
             messages.error(request, "Invalid or expired coupon code.")
-            return redirect('store:checkout')
+        return redirect('store:checkout')
+
+    # -------------------------------
+    # PRICING (online payment; COD goes through place_cod_order)
+    # -------------------------------
+    coupon_code = request.session.get('coupon_code')
+    pricing = quote(items, coupon_code)
+    if coupon_code and not pricing.coupon:
+        request.session.pop('coupon_code', None)
 
     # -------------------------------
     # CREATE RAZORPAY ORDER (GET)
     # -------------------------------
     if request.method == 'GET':
-        client = razorpay.Client(auth=(settings.RP_KEY_ID, settings.RP_KEY_SECRET))
-        amount_in_paise = max(int(final_amount * 100), 100)
+        amount_in_paise = max(pricing.amount_in_paise, 100)
 
-        payment = client.order.create({
-            'amount': amount_in_paise,
-            'currency': 'INR',
-            'payment_capture': 1
-        })
-
-        cart.razorpay_order_id = payment['id']
-        cart.save()
+        try:
+            payment = gateway_order_for(cart, items, amount_in_paise)
+        except GatewayUnavailable:
+            messages.error(request, "Online payments are temporarily unavailable. Please try again shortly or choose Cash on Delivery.")
+            return redirect('store:cart')
 
         return render(request, 'store/checkout.html', {
             'cart': cart,
             'payment': payment,
             'items': items,
-            'subtotal': subtotal,
-            'discount_amount': discount_amount,
-            'final_amount': final_amount,
-            'applied_coupon': applied_coupon.code if applied_coupon else None,
+            'subtotal': pricing.subtotal,
+            'discount_amount': pricing.discount,
+            'final_amount': pricing.total,
+            'cod_shipping': shipping_for('cod'),
+            'applied_coupon': pricing.coupon.code if pricing.coupon else None,
         })
 
     # -------------------------------
     # PAYMENT VERIFICATION (POST)
     # -------------------------------
     if request.method == 'POST':
-        try:
-            data = request.POST  # ✅ FIX: USE request.POST
+        data = request.POST  # ✅ FIX: USE request.POST
 
-            razorpay_order_id = data.get('razorpay_order_id')
-            razorpay_payment_id = data.get('razorpay_payment_id')
-            razorpay_signature = data.get('razorpay_signature')
+        razorpay_order_id = data.get('razorpay_order_id')
+        razorpay_payment_id = data.get('razorpay_payment_id')
+        razorpay_signature = data.get('razorpay_signature')
 
-            first_name = data.get('first_name', '').strip()
-            last_name = data.get('last_name', '').strip()
-            email = data.get('email', '').strip()
-            address = data.get('address', '').strip()
-            zipcode = data.get('zipcode', '').strip()
-            city = data.get('city', '').strip()
+        first_name = data.get('first_name', '').strip()
+        last_name = data.get('last_name', '').strip()
+        email = data.get('email', '').strip()
+        address = data.get('address', '').strip()
+        zipcode = data.get('zipcode', '').strip()
+        city = data.get('city', '').strip()
 
-            if not all([first_name, last_name, email, address, zipcode, city]):
-                return JsonResponse({'status': 'failure', 'message': 'Missing address details'})
+        if not all([first_name, last_name, email, address, zipcode, city]):
+            return JsonResponse({'status': 'failure', 'message': 'Missing address details'})
 
-            if not all([razorpay_order_id, razorpay_payment_id, razorpay_signature]):
-                return JsonResponse({'status': 'failure', 'message': 'Missing Razorpay payment details'})
+        if not all([razorpay_order_id, razorpay_payment_id, razorpay_signature]):
+            return JsonResponse({'status': 'failure', 'message': 'Missing Razorpay payment details'})
 
-            client = razorpay.Client(auth=(settings.RP_KEY_ID, settings.RP_KEY_SECRET))
-            client.utility.verify_payment_signature({
-                'razorpay_order_id': razorpay_order_id,
-                'razorpay_payment_id': razorpay_payment_id,
-                'razorpay_signature': razorpay_signature
-            })
+        try:
+            get_gateway().verify_payment_signature(razorpay_order_id, razorpay_payment_id, razorpay_signature)
+        except razorpay.errors.SignatureVerificationError:
+            return JsonResponse({'status': 'failure', 'message': 'Invalid signature'})
 
-            # Create Order
-            order = Order.objects.create(
-                user=request.user,
+        # The payment webhook may have placed this order already
+        if Order.objects.filter(razorpay_order_id=razorpay_order_id).exists():
+            store_cart_summary(request)
+            request.session.pop('coupon_code', None)
+            return JsonResponse({'status': 'success'})
+
+        # The customer has paid, so a shortage backorders the order instead of failing it
+        try:
+            place_order(
+                request.user, items,
+                backorder=True,
                 first_name=first_name,
                 last_name=last_name,
                 email=email,
                 address=address,
                 city=city,
                 zipcode=zipcode,
-                paid_amount=final_amount,
-                discount_amount=discount_amount,
-                coupon=applied_coupon.code if applied_coupon else None,
+                **pricing.order_fields(),
                 status='processing',
                 razorpay_order_id=razorpay_order_id,
                 razorpay_payment_id=razorpay_payment_id,
                 razorpay_payment_status='paid'
             )
+        except IntegrityError:
+            # The webhook placed it between the check above and this insert
+            pass
+        forget_gateway_order(cart)
+        store_cart_summary(request)
+        request.session.pop('coupon_code', None)
 
-            # Save items
-            for item in items:
-                price = item.unit_price or item.product.get_display_price()
-                OrderItem.objects.create(
-                    order=order,
-                    product=item.product,
-                    quantity=item.quantity,
-                    price=price
-                )
-                if item.product.stock >= item.quantity:
-                    item.product.stock -= item.quantity
-                    item.product.save()
-
-            cart.items.all().delete()
-            request.session.pop('coupon_code', None)
-
-            return JsonResponse({'status': 'success'})
-
-        except Exception as e:
-            print("Payment verification failed:", e)
-            return JsonResponse({'status': 'failure', 'message': str(e)})
+        return JsonResponse({'status': 'success'})
 
 
 @login_required
 def reorder_items(request, order_id):
     order = get_object_or_404(Order, id=order_id, user=request.user)
-    print("CART AFTER REORDER:", request.session.get("cart"))
-
-    # Get cart from session or create empty
-    cart = request.session.get("cart", {})
-
-    for item in order.items.all():
-        product = item.product
-        product_id = str(product.id)
-
-        if product_id in cart:
-            # Increase quantity if already in cart
-            cart[product_id]["quantity"] += item.quantity
-        else:
-            # Add fresh product
-            cart[product_id] = {
-                "quantity": item.quantity,
-                "price": float(item.unit_price) if item.unit_price else float(product.price)
-            }
-
-    # Save cart back to session
-    request.session["cart"] = cart
-    request.session.modified = True  # 🔴 VERY IMPORTANT
+    cart = active_cart(request.user)
+    with changing(cart):
+        for item in order.items.select_related('product', 'combo_deal'):
+            if item.product and not item.product.is_available:
+                continue
+            add_line(cart, product=item.product, combo_deal=item.combo_deal, quantity=item.quantity)
+        store_cart_summary(request, cart)
+    messages.success(request, f"Items from order #{order.id} added to your cart.")
 
     return redirect("store:cart")
 
@@ -830,36 +725,155 @@ def cancel_order(request, order_id):
 
 
 
-@login_required
 def update_cart(request, item_id):
-    item = get_object_or_404(CartItem, id=item_id, cart__user=request.user)
+    item = get_object_or_404(CartItem.objects.select_related('cart'), id=item_id, cart=current_cart(request))
     if request.method == 'POST':
         action = request.POST.get('action')
-        if action == 'increase':
-            item.quantity += 1
-            item.save()
-        elif action == 'decrease':
-            if item.quantity > 1:
-                item.quantity -= 1
-                item.save()
-            else:
-                item.delete()  # remove item if qty goes below 1
+        with changing(item.cart):
+            # Written against the stored quantity, not the one loaded above
+            lines = CartItem.objects.filter(pk=item.pk)
+            if action == 'increase':
+                lines.update(quantity=F('quantity') + 1)
+            elif action == 'decrease':
+                if not lines.filter(quantity__gt=1).update(quantity=F('quantity') - 1):
+                    lines.filter(quantity=1).delete()  # remove item if qty goes below 1
+            store_cart_summary(request, item.cart)
     return redirect('store:cart')
     
 
 
-@login_required
 def remove_from_cart(request, item_id):
-    item = get_object_or_404(CartItem, id=item_id, cart__user=request.user)
+    item = get_object_or_404(CartItem.objects.select_related('cart'), id=item_id, cart=current_cart(request))
     if request.method == 'POST':
-        item.delete()
+        with changing(item.cart):
+            item.delete()
+            store_cart_summary(request, item.cart)
     return redirect('store:cart')
 
+
+# JSON cart API for the cart buttons. Each change runs in one transaction
+# with the cart's version bump, and answers with the changed line, the
+# subtotal and the badge count as they stand in that transaction. Sending
+# the `version` from the last answer makes a change to a cart that has
+# since moved on fail with 409 and the current cart instead.
+
+def _cart_line_json(line):
+    return {
+        'id': line.pk,
+        'name': line.get_name(),
+        'quantity': line.quantity,
+        'line_total': str(line.line_total()),
+    }
+
+
+def _cart_json(request, cart, lines=False, **line):
+    """The cart's version and badge summary, plus the line matching `line` or, with `lines`, all of them."""
+    data = {'version': cart.version if cart else 0}
+    if lines:
+        items = list(cart.items.select_related('product', 'combo_deal').order_by('id')) if cart else []
+        data.update(remember_cart_summary(request, cart, items) if cart else EMPTY_CART_SUMMARY)
+        data['lines'] = [_cart_line_json(item) for item in items]
+        return data
+    data.update(store_cart_summary(request, cart))
+    if line:
+        item = cart.items.select_related('product', 'combo_deal').filter(**line).first()
+        data['line'] = _cart_line_json(item) if item else None
+    return data
+
+
+def _cart_api_error(message, status):
+    return JsonResponse({'status': 'failure', 'message': message}, status=status)
+
+
+def _cart_conflict(request, cart):
+    return JsonResponse({
+        'status': 'conflict',
+        'message': 'Your cart has changed since this page was loaded.',
+        **_cart_json(request, cart, lines=True),
+    }, status=409)
+
+
+def _posted_int(request, name, default=None):
+    value = request.POST.get(name, '').strip()
+    return int(value) if value else default
+
+
+def cart_api(request):
+    """Every line of the cart, with the subtotal, badge count and version."""
+    return JsonResponse({'status': 'success', **_cart_json(request, current_cart(request), lines=True)})
+
+
+@require_POST
+def cart_api_add(request):
+    try:
+        quantity = _posted_int(request, 'quantity', 1)
+        version = _posted_int(request, 'version')
+    except ValueError:
+        return _cart_api_error('Invalid quantity or version', 400)
+    if quantity < 1:
+        return _cart_api_error('Quantity must be at least 1', 400)
+    if request.POST.get('product'):
+        column = 'product'
+        target = Product.objects.filter(slug=request.POST['product'], is_available=True).first()
+    else:
+        column = 'combo_deal'
+        target = ComboDeal.objects.filter(slug=request.POST.get('combo', '')).first()
+    if target is None:
+        return _cart_api_error('No such product', 404)
+    cart = current_cart(request, create=True)
+    try:
+        with changing(cart, version):
+            add_line(cart, quantity=quantity, **{column: target})
+            data = _cart_json(request, cart, **{column: target})
+    except StaleCart:
+        return _cart_conflict(request, cart)
+    return JsonResponse({'status': 'success', **data})
+
+
+def _change_line(request, item_id, quantity, version):
+    """Set line `item_id` to `quantity`, removing it at 0, and answer as the cart API does."""
+    cart = current_cart(request)
+    if cart is None:
+        return _cart_api_error('No such cart line', 404)
+    try:
+        with changing(cart, version):
+            lines = cart.items.filter(pk=item_id)
+            if not (lines.update(quantity=quantity) if quantity else lines.delete()[0]):
+                # Rolls back the version bump
+                raise CartItem.DoesNotExist
+            data = _cart_json(request, cart, pk=item_id)
+    except StaleCart:
+        return _cart_conflict(request, cart)
+    except CartItem.DoesNotExist:
+        return _cart_api_error('No such cart line', 404)
+    return JsonResponse({'status': 'success', **data})
+
+
+@require_POST
+def cart_api_set_quantity(request, item_id):
+    try:
+        quantity = _posted_int(request, 'quantity')
+        version = _posted_int(request, 'version')
+    except ValueError:
+        return _cart_api_error('Invalid quantity or version', 400)
+    if quantity is None or quantity < 0:
+        return _cart_api_error('Quantity must be 0 or more', 400)
+    return _change_line(request, item_id, quantity, version)
+
+
+@require_POST
+def cart_api_remove(request, item_id):
+    try:
+        version = _posted_int(request, 'version')
+    except ValueError:
+        return _cart_api_error('Invalid version', 400)
+    return _change_line(request, item_id, 0, version)
+
 from django.conf import settings
 
 @login_required
 def payment_view(request):
-    cart = get_object_or_404(Cart, user=request.user)
+    cart = active_cart(request.user)
     items = cart.items.select_related('product', 'combo_deal').all()
     checkout_data = request.session.get('checkout_data')
     if not checkout_data or not items:
@@ -868,54 +882,30 @@ def payment_view(request):
 
     # Placeholder payment step. In real integration, redirect to gateway and verify webhook/callback.
     if request.method == 'POST':
-        order = Order.objects.create(
-            user=request.user,
-            first_name=checkout_data['first_name'],
-            last_name=checkout_data['last_name'],
-            email=checkout_data['email'],
-            address=checkout_data['address'],
-            zipcode=checkout_data['zipcode'],
-            city=checkout_data['city'],
-            paid_amount=sum([i.line_total() for i in items]),
-            status='processing',
-        )
-        for item in items:
-            if item.combo_deal:
-                # For combo deals, create order item with combo reference
-                OrderItem.objects.create(
-                    order=order,
-                    combo_deal=item.combo_deal,
-                    price=item.combo_deal.discounted_price,
-                    quantity=item.quantity,
-                )
-                # Reduce stock for all products in the combo
-                for product in item.combo_deal.products.all():
-                    if product.stock >= item.quantity:
-                        product.stock -= item.quantity
-                        product.save()
-            else:
-                # For individual products
-                OrderItem.objects.create(
-                    order=order,
-                    product=item.product,
-                    price=(item.unit_price if item.unit_price is not None else item.product.get_display_price()),
-                    quantity=item.quantity,
-                )
-                # reduce stock
-                if item.product.stock >= item.quantity:
-                    item.product.stock -= item.quantity
-                    item.product.save()
-        # clear cart
-        cart.items.all().delete()
+        try:
+            place_order(
+                request.user, items,
+                first_name=checkout_data['first_name'],
+                last_name=checkout_data['last_name'],
+                email=checkout_data['email'],
+                address=checkout_data['address'],
+                zipcode=checkout_data['zipcode'],
+                city=checkout_data['city'],
+                **quote(items, request.session.get('coupon_code')).order_fields(),
+                status='processing',
+            )
+        except OutOfStock as e:
+            messages.error(request, str(e))
+            return redirect('store:cart')
+        store_cart_summary(request)
         messages.success(request, 'Payment successful! Order placed.')
         request.session.pop('checkout_data', None)
         return redirect('store:home')
     
 
-    subtotal = sum([i.line_total() for i in items])
     return render(request, 'store/payment.html', {
         'items': items,
-        'subtotal': subtotal,
+        'subtotal': quote(items).subtotal,
         'checkout': checkout_data,
     })
 
@@ -928,74 +918,63 @@ import json
 @login_required
 def verify_payment(request):
     if request.method == "POST":
-        data = json.loads(request.body)
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            return JsonResponse({'status': 'failure', 'message': 'Invalid request'})
         razorpay_order_id = data.get('razorpay_order_id')
         razorpay_payment_id = data.get('razorpay_payment_id')
         razorpay_signature = data.get('razorpay_signature')
 
-        client = razorpay.Client(auth=(settings.RP_KEY_ID, settings.RP_KEY_SECRET))
+        if not all([razorpay_order_id, razorpay_payment_id, razorpay_signature]):
+            return JsonResponse({'status': 'failure', 'message': 'Missing Razorpay payment details'})
 
         try:
             # 1️⃣ Verify payment signature
-            client.utility.verify_payment_signature({
-                'razorpay_order_id': razorpay_order_id,
-                'razorpay_payment_id': razorpay_payment_id,
-                'razorpay_signature': razorpay_signature
-            })
-
-            # 2️⃣ Fetch cart and checkout data
-            cart = Cart.objects.get(user=request.user)
-            items = cart.items.select_related('product', 'combo_deal').all()
-            checkout_data = request.session.get('checkout_data')
+            get_gateway().verify_payment_signature(razorpay_order_id, razorpay_payment_id, razorpay_signature)
+        except razorpay.errors.SignatureVerificationError:
+            return JsonResponse({'status': 'failure', 'message': 'Invalid signature'})
 
-            # 3️⃣ Create the Order
-            order = Order.objects.create(
-                user=request.user,
-                first_name=checkout_data.get('first_name'),
-                last_name=checkout_data.get('last_name'),
-                email=checkout_data.get('email'),
-                address=checkout_data.get('address'),
-                zipcode=checkout_data.get('zipcode'),
-                city=checkout_data.get('city'),
-                paid_amount=sum([i.line_total() for i in items]),
-                status='processing',
-                razorpay_order_id=razorpay_order_id
-            )
+        # The payment webhook may have placed this order already
+        existing = Order.objects.filter(razorpay_order_id=razorpay_order_id).first()
+        if existing:
+            store_cart_summary(request)
+            return JsonResponse({'status': 'success', 'order_id': existing.id})
 
-            # 4️⃣ Transfer cart items → order items
-            for item in items:
-                if item.combo_deal:
-                    OrderItem.objects.create(
-                        order=order,
-                        combo_deal=item.combo_deal,
-                        price=item.combo_deal.discounted_price,
-                        quantity=item.quantity,
-                    )
-                    for product in item.combo_deal.products.all():
-                        product.stock = max(product.stock - item.quantity, 0)
-                        product.save()
-                else:
-                    OrderItem.objects.create(
-                        order=order,
-                        product=item.product,
-                        price=item.unit_price or item.product.get_display_price(),
-                        quantity=item.quantity,
-                    )
-                    item.product.stock = max(item.product.stock - item.quantity, 0)
-                    item.product.save()
+        # 2️⃣ Fetch cart and checkout data; without the address the webhook places the order from the payment notes
+        cart = active_cart(request.user)
+        items = cart.items.select_related('product', 'combo_deal').all()
+        checkout_data = request.session.get('checkout_data')
+        if not checkout_data:
+            return JsonResponse({'status': 'failure', 'message': 'Checkout session expired'})
 
-            # 5️⃣ Clear the cart
-            cart.items.all().delete()
-            cart.is_paid = True
-            cart.save()
-            request.session.pop('checkout_data', None)
+        try:
+            with transaction.atomic():
+                # 3️⃣ Create the Order; its items replace the cart lines. The
+                # customer has paid, so a shortage backorders it instead of failing
+                order = place_order(
+                    request.user, items,
+                    backorder=True,
+                    first_name=checkout_data.get('first_name'),
+                    last_name=checkout_data.get('last_name'),
+                    email=checkout_data.get('email'),
+                    address=checkout_data.get('address'),
+                    zipcode=checkout_data.get('zipcode'),
+                    city=checkout_data.get('city'),
+                    **quote(items, request.session.get('coupon_code')).order_fields(),
+                    status='processing',
+                    razorpay_order_id=razorpay_order_id
+                )
+                cart.is_paid = True
+                cart.razorpay_order_key = ''
+                cart.save()
+        except IntegrityError:
+            # The webhook placed it between the check above and this insert
+            order = Order.objects.get(razorpay_order_id=razorpay_order_id)
+        store_cart_summary(request)
+        request.session.pop('checkout_data', None)
 
-            return JsonResponse({'status': 'success', 'order_id': order.id})
-
-        except razorpay.errors.SignatureVerificationError:
-            return JsonResponse({'status': 'failure', 'message': 'Invalid signature'})
-        except Exception as e:
-            return JsonResponse({'status': 'failure', 'message': str(e)})
+        return JsonResponse({'status': 'success', 'order_id': order.id})
 
     return JsonResponse({'status': 'failure', 'message': 'Invalid request'})
 
@@ -1013,24 +992,25 @@ def cancel_order_request(request, order_id):
         reason = request.POST.get("reason")
         photo = request.FILES.get("photo")
 
-        # Save cancellation
-        CancellationRequest.objects.create(
+        # Save cancellation; the photo is uploaded by the task worker
+        cancellation = CancellationRequest.objects.create(
             order=order,
+            user=request.user,
             reason=reason,
-            photo=photo
         )
+        if photo:
+            stage_upload(cancellation, 'photo', photo)
 
         # Update order status
         order.status = "cancel_requested"
         order.save()
 
-        # Send Email
-        send_mail(
+        # Send Email from the task worker, not this request
+        send_email.delay(
             subject="Order Cancellation Request Received",
             message=f"Your cancellation request for Order #{order.id} has been received.\n\nReason:\n{reason}",
             from_email="support@prachisorganics.com",
             recipient_list=[request.user.email],
-            fail_silently=True,
         )
 
         return redirect(f"/cancel-order/{order.id}/confirmed/")
@@ -1082,7 +1062,7 @@ def place_cod_order(request):
     if request.method != "POST":
         return JsonResponse({"status": "failure", "message": "Invalid request"}, status=400)
 
-    cart = Cart.objects.filter(user=request.user).first()
+    cart = current_cart(request)
     items = cart.items.select_related('product', 'combo_deal') if cart else None
 
     if not items or not items.exists():
@@ -1099,50 +1079,46 @@ def place_cod_order(request):
     if not all([first_name, last_name, email, address, zipcode, city]):
         return JsonResponse({"status": "failure", "message": "Missing address details"}, status=400)
 
-    subtotal = sum(item.line_total() for item in items)
-    shipping_charge = 50
-    final_amount = subtotal + shipping_charge
-
-    # Create ORDER (✅ FIXED)
-    order = Order.objects.create(
-        user=request.user,
-        first_name=first_name,
-        last_name=last_name,
-        email=email,
-        address=address,
-        city=city,
-        zipcode=zipcode,
-
-        paid_amount=final_amount,
-        shipping_charge=shipping_charge,
-
-        payment_method='cod',        # ✅ FIX
-        payment_status='cod',        # ✅ FIX
-        status='processing',
-    )
-
-    # Save order items
-    for item in items:
-        if item.combo_deal:
-            OrderItem.objects.create(
-                order=order,
-                combo_deal=item.combo_deal,
-                quantity=item.quantity,
-                price=item.combo_deal.discounted_price
-            )
-        else:
-            OrderItem.objects.create(
-                order=order,
-                product=item.product,
-                quantity=item.quantity,
-                price=item.unit_price or item.product.get_display_price()
-            )
+    pricing = quote(items, request.session.get('coupon_code'), payment_method='cod')
 
-    # Clear cart
-    items.delete()
+    try:
+        # Create ORDER (✅ FIXED)
+        place_order(
+            request.user, items,
+            first_name=first_name,
+            last_name=last_name,
+            email=email,
+            address=address,
+            city=city,
+            zipcode=zipcode,
+            **pricing.order_fields(),
+
+            payment_method='cod',        # ✅ FIX
+            payment_status='cod',        # ✅ FIX
+            status='processing',
+        )
+    except OutOfStock as e:
+        return JsonResponse({"status": "failure", "message": str(e)}, status=409)
+    store_cart_summary(request)
     request.session.pop('coupon_code', None)
 
     return JsonResponse({
         "status": "success",
         "redirect_url": "/order-success/"
     })
+
+
+@csrf_exempt
+@require_POST
+def razorpay_webhook(request):
+    """Check the signature and queue the event; a task worker applies it."""
+    if not valid_signature(request.body, request.headers.get('X-Razorpay-Signature')):
+        return JsonResponse({'status': 'failure', 'message': 'Invalid signature'}, status=400)
+    try:
+        payload = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({'status': 'failure', 'message': 'Invalid payload'}, status=400)
+    if payload.get('event') in HANDLED_EVENTS:
+        record_event(request.headers.get('X-Razorpay-Event-Id'), request.body, payload)
+        process_payment_events.delay()
+    return JsonResponse({'status': 'ok'})
@@ -0,0 +1,149 @@
+# store/webhooks.py
+"""
+Razorpay webhooks, so payments are confirmed even when the customer's
+browser never reports back.
+
+The endpoint only checks the signature and appends the delivery to the
+PaymentEvent inbox, one INSERT, before answering. Razorpay redelivers
+events and may send them twice, so the inbox is keyed on the event id
+and a repeat is dropped. It then queues a task (store/tasks.py) for the
+worker to work through the inbox; `manage.py process_payment_events`
+does the same by hand.
+
+Processing is idempotent. For payment.captured, an order that already
+exists for the Razorpay order is marked paid. If none exists, because
+the browser dropped after paying, it is placed from the cart that owns
+the Razorpay order, using the shipping details and coupon the checkout
+page passed as payment notes. It is priced by pricing.quote() like the
+browser path, and records the amount Razorpay actually captured. The
+money is already taken, so if stock ran out meanwhile the order is still
+placed, as backordered, for staff to restock or refund.
+
+payment.failed marks existing orders failed and leaves the cart alone so
+the customer can try again.
+
+Order.razorpay_order_id is unique, so when the webhook and the browser
+callback race to place the same order, the loser's insert fails and it
+treats the order as already placed.
+"""
+import hashlib
+import hmac
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import Cart, Order, PaymentEvent
+from .orders import place_order
+from .pricing import quote
+
+HANDLED_EVENTS = ('payment.captured', 'payment.failed')
+SHIPPING_FIELDS = ('first_name', 'last_name', 'email', 'address', 'city', 'zipcode')
+
+
+def valid_signature(body, signature, secret=None):
+    """Whether `signature` is the HMAC-SHA256 of the raw request `body`."""
+    secret = settings.RAZORPAY_WEBHOOK_SECRET if secret is None else secret
+    if not secret or not signature:
+        return False
+    expected = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+def record_event(event_id, body, payload):
+    """Add a delivery to the inbox in one INSERT; a repeat of an event id is ignored."""
+    event_id = event_id or hashlib.sha256(body).hexdigest()
+    PaymentEvent.objects.bulk_create(
+        [PaymentEvent(event_id=event_id, event=payload.get('event', ''), payload=payload)],
+        ignore_conflicts=True,
+    )
+
+
+def _payment(event):
+    return event.payload.get('payload', {}).get('payment', {}).get('entity', {})
+
+
+def _captured(payment):
+    orders = Order.objects.filter(razorpay_order_id=payment['order_id'])
+    if orders.exists():
+        orders.update(payment_status='paid', razorpay_payment_status='captured', razorpay_payment_id=payment['id'])
+        return
+    cart = Cart.objects.select_for_update().filter(razorpay_order_id=payment['order_id']).select_related('user').first()
+    if cart is None:
+        raise LookupError(f"No cart or order for {payment['order_id']}")
+    items = list(cart.items.select_related('product', 'combo_deal'))
+    if not items:
+        raise LookupError(f"Cart #{cart.pk} for {payment['order_id']} is empty")
+    notes = payment.get('notes') or {}
+    user = cart.user
+    fields = {
+        'first_name': user.first_name, 'last_name': user.last_name, 'email': user.email,
+        'address': user.shipping_address, 'city': '', 'zipcode': '',
+    }
+    fields.update({name: notes[name] for name in SHIPPING_FIELDS if notes.get(name)})
+    fields.update(quote(items, notes.get('coupon')).order_fields())
+    fields['paid_amount'] = Decimal(payment['amount']) / 100
+    try:
+        place_order(
+            user, items, backorder=True, **fields,
+            status='processing',
+            payment_status='paid',
+            razorpay_order_id=payment['order_id'],
+            razorpay_payment_id=payment['id'],
+            razorpay_payment_status='captured',
+        )
+    except IntegrityError:
+        # The browser callback placed it since the check above
+        orders.update(payment_status='paid', razorpay_payment_status='captured', razorpay_payment_id=payment['id'])
+        return
+    Cart.objects.filter(pk=cart.pk).update(is_paid=True, razorpay_order_key='')
+
+
+def _failed(payment):
+    Order.objects.filter(razorpay_order_id=payment['order_id']).exclude(payment_status='paid').update(
+        payment_status='failed', razorpay_payment_status='failed', razorpay_payment_id=payment['id'],
+    )
+
+
+def process_event(event):
+    """Apply one inbox event. Safe to run again on an event already applied."""
+    with transaction.atomic():
+        event = PaymentEvent.objects.select_for_update().get(pk=event.pk)
+        if event.processed_at is not None:
+            return
+        payment = _payment(event)
+        if event.event == 'payment.captured':
+            _captured(payment)
+        elif event.event == 'payment.failed':
+            _failed(payment)
+        event.processed_at = timezone.now()
+        event.attempts += 1
+        event.last_error = ''
+        event.save(update_fields=['processed_at', 'attempts', 'last_error'])
+
+
+def process_pending(limit=100):
+    """
+    Process up to `limit` unprocessed events, oldest first. Returns (done, failed).
+
+    An event that fails is tried again on later runs until it has failed
+    PAYMENT_EVENT_MAX_ATTEMPTS times. It is then marked failed and skipped,
+    left for staff to look into and retry from the admin.
+    """
+    done = failed = 0
+    pending = PaymentEvent.objects.filter(processed_at__isnull=True, failed_at__isnull=True).order_by('id')
+    for event in pending[:limit]:
+        try:
+            process_event(event)
+        except (LookupError, KeyError) as e:
+            attempts = event.attempts + 1
+            PaymentEvent.objects.filter(pk=event.pk).update(
+                attempts=attempts,
+                last_error=str(e),
+                failed_at=timezone.now() if attempts >= settings.PAYMENT_EVENT_MAX_ATTEMPTS else None,
+            )
+            failed += 1
+        else:
+            done += 1
+    return done, failed